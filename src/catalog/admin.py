@@ -0,0 +1,17 @@
+from catalog.models import Instrument, Proposal, Run
+from django.contrib import admin
+
+class InstrumentAdmin(admin.ModelAdmin):
+    list_display = ('id', 'name', 'last_sync')
+
+class ProposalAdmin(admin.ModelAdmin):
+    list_filter = ('instrument',)
+    list_display = ('id', 'instrument', 'name', 'title', 'create_time', 'last_sync')
+
+class RunAdmin(admin.ModelAdmin):
+    list_filter = ('instrument',)
+    list_display = ('id', 'instrument', 'proposal', 'run_number', 'title', 'start_time', 'end_time')
+
+admin.site.register(Instrument, InstrumentAdmin)
+admin.site.register(Proposal, ProposalAdmin)
+admin.site.register(Run, RunAdmin)
@@ -0,0 +1,192 @@
+"""
+    Stale-while-revalidate cache for slow ICAT calls.
+
+    Fresh entries are returned directly. Stale entries are returned
+    immediately while a background thread fetches a new copy. Only one
+    request per key fetches from ICAT at any given time.
+
+    @author: M. Doucet, Oak Ridge National Laboratory
+    @copyright: 2014 Oak Ridge National Laboratory
+"""
+from django.core.cache import cache
+from django.conf import settings
+from multiprocessing.pool import ThreadPool
+import threading
+import time
+import logging
+import sys
+
+import icat_server_communication
+
+# Time, in seconds, after which an entry is refreshed
+ICAT_CACHE_TTL = {'instruments': 3600,
+                  'experiments': 300,
+                  'ipts_runs': 120,
+                  'run_info': 120}
+if hasattr(settings, 'ICAT_CACHE_TTL'):
+    ICAT_CACHE_TTL.update(settings.ICAT_CACHE_TTL)
+
+# Time, in seconds, after which a stale entry is no longer served
+ICAT_CACHE_MAX_AGE = getattr(settings, 'ICAT_CACHE_MAX_AGE', 7*24*3600)
+
+# Maximum number of concurrent ICAT calls for a batch of runs
+ICAT_RUN_INFO_WORKERS = getattr(settings, 'ICAT_RUN_INFO_WORKERS', 8)
+
+# Maximum time, in seconds, a refresh lock is held
+_LOCK_TIMEOUT = 60
+
+# Lifetime of the hit/miss counters, in seconds
+_STATS_TIMEOUT = 30*24*3600
+
+_local_locks = {}
+_local_locks_lock = threading.Lock()
+
+def _get_local_lock(key):
+    with _local_locks_lock:
+        if key not in _local_locks:
+            _local_locks[key] = threading.Lock()
+        return _local_locks[key]
+
+def _count(call_type, counter, delta=1):
+    """
+        Increment a shared hit/miss counter
+        @param call_type: key into ICAT_CACHE_TTL
+        @param counter: name of the counter
+        @param delta: increment
+    """
+    key = 'icat_stats:%s:%s' % (call_type, counter)
+    try:
+        cache.add(key, 0, _STATS_TIMEOUT)
+        cache.incr(key, delta)
+    except:
+        logging.debug("Could not update cache counter %s: %s" % (key, sys.exc_value))
+
+def get_cache_stats():
+    """
+        Return the hit/stale/miss counters for each call type
+    """
+    stats = {}
+    for call_type in ICAT_CACHE_TTL:
+        stats[call_type] = {}
+        for counter in ['hit', 'stale', 'miss']:
+            stats[call_type][counter] = cache.get('icat_stats:%s:%s' % (call_type, counter), 0)
+    return stats
+
+def _fetch(key, func, args):
+    """
+        Call ICAT and store the result. Empty results are
+        treated as failures and are not cached.
+    """
+    value = func(*args)
+    if len(value)>0:
+        cache.set(key, (time.time(), value), ICAT_CACHE_MAX_AGE)
+    return value
+
+def _background_refresh(key, func, args):
+    lock_key = '%s:lock' % key
+    # Only one worker process refreshes a given entry
+    if not cache.add(lock_key, 1, _LOCK_TIMEOUT):
+        return
+    def _run():
+        try:
+            _fetch(key, func, args)
+        except:
+            logging.error("Could not refresh %s: %s" % (key, sys.exc_value))
+        finally:
+            cache.delete(lock_key)
+    thread = threading.Thread(target=_run)
+    thread.daemon = True
+    thread.start()
+
+def cached_call(call_type, func, *args):
+    """
+        Return the result of func(*args), using the cache
+        @param call_type: key into ICAT_CACHE_TTL
+        @param func: ICAT communication function
+        @param args: arguments passed to the function
+    """
+    key = 'icat:%s:%s' % (call_type, ':'.join([str(a).upper() for a in args]))
+    entry = cache.get(key)
+    if entry is not None:
+        timestamp, value = entry
+        if time.time()-timestamp < ICAT_CACHE_TTL[call_type]:
+            _count(call_type, 'hit')
+        else:
+            _count(call_type, 'stale')
+            _background_refresh(key, func, args)
+        return value
+
+    _count(call_type, 'miss')
+    # Concurrent misses wait for the first request to fill the cache
+    with _get_local_lock(key):
+        entry = cache.get(key)
+        if entry is not None:
+            return entry[1]
+        return _fetch(key, func, args)
+
+def get_instruments():
+    """
+        Cached version of icat_server_communication.get_instruments
+    """
+    return cached_call('instruments', icat_server_communication.get_instruments)
+
+def get_experiments(instrument):
+    """
+        Cached version of icat_server_communication.get_experiments
+        @param instrument: instrument name
+    """
+    return cached_call('experiments', icat_server_communication.get_experiments, instrument.upper())
+
+def get_ipts_runs(instrument, ipts):
+    """
+        Cached version of icat_server_communication.get_ipts_runs
+        @param instrument: instrument name
+        @param ipts: experiment name
+    """
+    return cached_call('ipts_runs', icat_server_communication.get_ipts_runs, instrument.upper(), ipts.upper())
+
+def get_run_info_batch(instrument, run_numbers):
+    """
+        Return the ICAT info for a list of runs, as a dictionary keyed
+        by run number. Runs that are not in the cache are fetched from
+        ICAT concurrently.
+        @param instrument: instrument name
+        @param run_numbers: list of run numbers
+    """
+    keys = {}
+    for run_number in run_numbers:
+        keys['icat:run_info:%s:%s' % (instrument.upper(), run_number)] = run_number
+    cached = cache.get_many(keys.keys())
+    results = {}
+    misses = []
+    for key, run_number in keys.items():
+        if key in cached:
+            results[run_number] = cached[key]
+        else:
+            misses.append(run_number)
+    _count('run_info', 'hit', len(results))
+
+    if len(misses)>0:
+        _count('run_info', 'miss', len(misses))
+        pool = ThreadPool(min(len(misses), ICAT_RUN_INFO_WORKERS))
+        try:
+            info_list = pool.map(lambda r: icat_server_communication.get_run_info(instrument, r), misses)
+        finally:
+            pool.close()
+            pool.join()
+        to_store = {}
+        for run_number, info in zip(misses, info_list):
+            results[run_number] = info
+            # Don't cache failed calls
+            if not 'icat_error' in info:
+                to_store['icat:run_info:%s:%s' % (instrument.upper(), run_number)] = info
+        cache.set_many(to_store, ICAT_CACHE_TTL['run_info'])
+    return results
+
+def get_run_info(instrument, run_number):
+    """
+        Cached version of icat_server_communication.get_run_info
+        @param instrument: instrument name
+        @param run_number: run number
+    """
+    return get_run_info_batch(instrument, [run_number])[run_number]
@@ -1,12 +1,13 @@
-import httplib
 import urllib
 import xml.dom.minidom
+from xml.etree.cElementTree import iterparse
 import logging
 import sys
 import time
 import datetime
 from django.conf import settings
 import catalog.view_util
+from reduction_service.connection_pool import get_pool
 
 if hasattr(settings, 'ICAT_DOMAIN'):
     ICAT_DOMAIN = settings.ICAT_DOMAIN
@@ -16,6 +17,27 @@ else:
     ICAT_DOMAIN = 'icat.sns.gov'
     ICAT_PORT = 2080
 
+# Timeouts, in seconds, for each type of ICAT call
+ICAT_TIMEOUTS = {'ipts_info': 0.5,
+                 'instruments': 0.5,
+                 'experiments': 20,
+                 'ipts_runs': 10,
+                 'run_info': 1.0}
+if hasattr(settings, 'ICAT_TIMEOUTS'):
+    ICAT_TIMEOUTS.update(settings.ICAT_TIMEOUTS)
+
+def icat_request(url, call_type):
+    """
+        Send a GET request to ICAT over a pooled keep-alive connection
+        and return the response object. A CircuitOpenError is raised
+        without contacting ICAT if the endpoint is unhealthy.
+        @param url: path of the ICAT resource
+        @param call_type: key into ICAT_TIMEOUTS
+    """
+    pool = get_pool(ICAT_DOMAIN, ICAT_PORT)
+    return pool.request('GET', url, timeout=ICAT_TIMEOUTS[call_type],
+                        endpoint='icat:%s' % call_type)
+
 def get_text_from_xml(nodelist):
     rc = []
     for node in nodelist:
@@ -46,11 +68,8 @@ def get_ipts_info(instrument, ipts):
     
     # Get basic run info
     try:
-        conn = httplib.HTTPConnection(ICAT_DOMAIN, 
-                                      ICAT_PORT, timeout=0.5)
-        conn.request('GET', '/icat-rest-ws/experiment/SNS/%s/%s/meta' % (instrument.upper(),
-                                                                         ipts.upper()))
-        r = conn.getresponse()
+        r = icat_request('/icat-rest-ws/experiment/SNS/%s/%s/meta' % (instrument.upper(),
+                                                                      ipts.upper()), 'ipts_info')
         dom = xml.dom.minidom.parseString(r.read())
         metadata = dom.getElementsByTagName('proposal')
         if len(metadata)>0:
@@ -76,10 +95,7 @@ def get_instruments():
     """
     instruments = []
     try:
-        conn = httplib.HTTPConnection(ICAT_DOMAIN, 
-                                      ICAT_PORT, timeout=0.5)
-        conn.request('GET', '/icat-rest-ws/experiment/SNS/')
-        r = conn.getresponse()
+        r = icat_request('/icat-rest-ws/experiment/SNS/', 'instruments')
         dom = xml.dom.minidom.parseString(r.read())
         elements = dom.getElementsByTagName('instrument')
         for element in elements:
@@ -92,6 +108,61 @@ def get_instruments():
     return instruments
     
 
+def iter_elements(source, tag):
+    """
+        Incrementally parse an XML document and yield each element
+        with the given tag as soon as it is complete. Elements are
+        removed from the tree once consumed so that memory use does
+        not grow with the size of the document.
+        @param source: file-like object to read from
+        @param tag: name of the elements to yield
+    """
+    parents = []
+    for event, elem in iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            parents.append(elem)
+            continue
+        parents.pop()
+        if elem.tag.rsplit('}', 1)[-1] == tag:
+            yield elem
+            elem.clear()
+            if len(parents)>0:
+                parents[-1].remove(elem)
+
+def _child_values(elem):
+    """
+        Return (tag, text) pairs for the non-empty children of an element
+        @param elem: ElementTree element
+    """
+    for child in elem:
+        if child.text is not None and len(child.text)>0:
+            yield child.tag.rsplit('}', 1)[-1], child.text
+
+def iter_experiments(instrument):
+    """
+        Generator yielding the experiments for a given instrument
+        as they are read from the ICAT response.
+        @param instrument: instrument name
+    """
+    t0 = time.time()
+    url = '/icat-rest-ws/experiment/SNS/%s/meta' % instrument.upper()
+    r = icat_request(url, 'experiments')
+    logging.debug("Catalog request %s:%s%s took %g sec" % (ICAT_DOMAIN, ICAT_PORT, url, (time.time()-t0)))
+    try:
+        for e in iter_elements(r, 'proposal'):
+            expt = {'id': e.get('id')}
+            for name, text_value in _child_values(e):
+                if name == 'title':
+                    expt[name] = urllib.unquote(text_value)
+                elif name == 'createTime':
+                    expt[name] = decode_time(text_value)
+                elif name == 'runRange':
+                    expt[name] = text_value
+            yield expt
+    finally:
+        r.release()
+    logging.debug("ICAT %s: %s" % (url, str(time.time()-t0)))
+
 def get_experiments(instrument):
     """
     http://icat-testing.sns.gov:2080/icat-rest-ws/experiment/SNS/NOM/meta
@@ -105,31 +176,50 @@ def get_experiments(instrument):
     """
     experiments = []
     try:
-        t0 = time.time()
-        url = '/icat-rest-ws/experiment/SNS/%s/meta' % instrument.upper()
-        conn = httplib.HTTPConnection(ICAT_DOMAIN, 
-                                      ICAT_PORT, timeout=20)
-        conn.request('GET', url)
-        r = conn.getresponse()
-        logging.debug("Catalog request %s:%s%s took %g sec" % (ICAT_DOMAIN, ICAT_PORT, url, (time.time()-t0)))
-        dom = xml.dom.minidom.parseString(r.read())
-        for e in  dom.getElementsByTagName('proposal'):
-            expt = {'id': e.attributes['id'].value}
-            for n in e.childNodes:
-                if n.hasChildNodes():
-                    if n.nodeName == 'title':
-                        expt[n.nodeName] = urllib.unquote(get_text_from_xml(n.childNodes))
-                    elif n.nodeName == 'createTime':
-                        timestr = get_text_from_xml(n.childNodes)
-                        expt[n.nodeName] = decode_time(timestr)
-                        
+        for expt in iter_experiments(instrument):
             experiments.append(expt)
-        logging.debug("ICAT %s: %s" % (url, str(time.time()-t0)))
     except:
         logging.error("Could not get list of experiments from ICAT: %s" % sys.exc_value)
     return experiments
     
-    
+def iter_ipts_runs(instrument, ipts, return_raw=False):
+    """
+        Generator yielding the runs of a given experiment
+        as they are read from the ICAT response.
+        @param instrument name [string]
+        @param ipts: experiment name [string]
+        @param return_raw: if True, numbers are returned as floats and no URLs are added
+    """
+    t0 = time.time()
+    url = '/icat-rest-ws/experiment/SNS/%s/%s/all' % (instrument.upper(), ipts.upper())
+    r = icat_request(url, 'ipts_runs')
+    logging.debug("Catalog request %s:%s%s took %g sec" % (ICAT_DOMAIN, ICAT_PORT, url, (time.time()-t0)))
+    try:
+        for e in iter_elements(r, 'run'):
+            run_id = e.get('id')
+            run_info = {'id': run_id}
+            if not return_raw:
+                run_info.update({'webmon_url': catalog.view_util.get_webmon_url(instrument, run_id, ipts),
+                                 'reduce_url': catalog.view_util.get_new_reduction_url(instrument, run_id, ipts),
+                                 'batch_url': catalog.view_util.get_new_batch_url(instrument, run_id, ipts)})
+            for name, text_value in _child_values(e):
+                if name in ['title']:
+                    run_info[name] = urllib.unquote(text_value)
+                elif name in ['duration', 'protonCharge', 'totalCounts']:
+                    try:
+                        if return_raw:
+                            run_info[name] = float(text_value)
+                        else:
+                            run_info[name] = "%.4G" % float(text_value)
+                    except:
+                        if not return_raw:
+                            run_info[name] = text_value
+                elif name in ['startTime', 'endTime']:
+                    run_info[name] = decode_time(text_value)
+            yield run_info
+    finally:
+        r.release()
+
 def get_ipts_runs(instrument, ipts):
     """
         Get the list of runs and basic meta data for
@@ -148,32 +238,7 @@ def get_ipts_runs(instrument, ipts):
     """
     run_data = []
     try:
-        t0 = time.time()
-        url = '/icat-rest-ws/experiment/SNS/%s/%s/all' % (instrument.upper(), ipts.upper())
-        conn = httplib.HTTPConnection(ICAT_DOMAIN, 
-                                      ICAT_PORT, timeout=10)
-        conn.request('GET', url)
-        r = conn.getresponse()
-        logging.debug("Catalog request %s:%s%s took %g sec" % (ICAT_DOMAIN, ICAT_PORT, url, (time.time()-t0)))
-        dom = xml.dom.minidom.parseString(r.read())
-        for r in dom.getElementsByTagName('run'):
-            run_info = {'id': r.attributes['id'].value,
-                        'webmon_url': catalog.view_util.get_webmon_url(instrument, r.attributes['id'].value, ipts),
-                        'reduce_url': catalog.view_util.get_new_reduction_url(instrument, r.attributes['id'].value, ipts),
-                        'batch_url': catalog.view_util.get_new_batch_url(instrument, r.attributes['id'].value, ipts)}
-            for n in r.childNodes:
-                if n.hasChildNodes():
-                    if n.nodeName in ['title']:
-                        run_info[n.nodeName] = urllib.unquote(get_text_from_xml(n.childNodes))
-                    elif n.nodeName in ['duration', 'protonCharge', 'totalCounts']:
-                        text_value = get_text_from_xml(n.childNodes)
-                        try:
-                            run_info[n.nodeName] = "%.4G" % float(text_value)
-                        except:
-                            run_info[n.nodeName] = text_value
-                    elif n.nodeName in ['startTime', 'endTime']:
-                        text_value = get_text_from_xml(n.childNodes)
-                        run_info[n.nodeName] = decode_time(text_value)
+        for run_info in iter_ipts_runs(instrument, ipts):
             run_data.append(run_info)
     except:
         logging.error("Communication with ICAT server failed: %s" % sys.exc_value)
@@ -187,11 +252,8 @@ def get_run_info(instrument, run_number):
     """
     run_info = {}
     try:
-        conn = httplib.HTTPConnection(ICAT_DOMAIN,
-                                      ICAT_PORT, timeout=1.0)
         url = '/icat-rest-ws/dataset/SNS/%s/%s' % (instrument.upper(), run_number)
-        conn.request('GET', url)
-        r = conn.getresponse()
+        r = icat_request(url, 'run_info')
         dom = xml.dom.minidom.parseString(r.read())
         metadata = dom.getElementsByTagName('metadata')
         if len(metadata)>0:
@@ -0,0 +1,25 @@
+"""
+    Rebuild the run search index from the local catalog tables.
+
+    @author: M. Doucet, Oak Ridge National Laboratory
+    @copyright: 2014 Oak Ridge National Laboratory
+"""
+from django.core.management.base import BaseCommand
+
+from catalog.models import Proposal, Run
+from catalog.search import index_runs
+
+class Command(BaseCommand):
+    args = '[instrument instrument ...]'
+    help = 'Rebuild the run search index for the given instruments, or all of them'
+
+    def handle(self, *args, **options):
+        proposals = Proposal.objects.all()
+        if len(args)>0:
+            proposals = proposals.filter(instrument__name__in=[a.upper() for a in args])
+        n_runs = 0
+        for proposal in proposals:
+            runs = Run.objects.filter(proposal=proposal).select_related('proposal')
+            index_runs(runs)
+            n_runs += len(runs)
+        self.stdout.write("Indexed %d runs\n" % n_runs)
@@ -0,0 +1,166 @@
+"""
+    Synchronize the local catalog tables with ICAT.
+
+    Only proposals created or active since the last synchronization
+    of an instrument, or whose run range reported by ICAT changed,
+    have their run list fetched again, and only runs that are new
+    or were still running are written.
+
+    When ICAT doesn't report run ranges, a quiet proposal that gets
+    new runs is only seen by a full synchronization. Run the command
+    with --full periodically (e.g. weekly) in addition to the
+    incremental runs.
+
+    @author: M. Doucet, Oak Ridge National Laboratory
+    @copyright: 2014 Oak Ridge National Laboratory
+"""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+from optparse import make_option
+import datetime
+import logging
+import sys
+
+from catalog.models import Instrument, Proposal, Run, to_db_time
+from catalog.search import index_runs
+from catalog import run_index
+from catalog.icat_server_communication import get_instruments, iter_experiments, iter_ipts_runs, get_ipts_info
+
+# Largest number of runs selected by run number for re-indexing
+_MAX_INDEX_LIST = 500
+
+class Command(BaseCommand):
+    args = '[instrument instrument ...]'
+    help = 'Incrementally copy ICAT proposal and run meta-data into the local catalog tables'
+    option_list = BaseCommand.option_list + (
+        make_option('--full', action='store_true', dest='full', default=False,
+                    help='Ignore the sync watermark and re-read every proposal. Run periodically to pick up '
+                         'new runs of quiet proposals when ICAT does not report run ranges'),
+        make_option('--active-days', type='int', dest='active_days', default=14,
+                    help='Proposals with runs within this many days of the watermark are re-read'),
+    )
+
+    def handle(self, *args, **options):
+        instruments = args if len(args)>0 else get_instruments()
+        for instrument in instruments:
+            try:
+                self.sync_instrument(instrument, options['full'], options['active_days'])
+            except:
+                logging.error("Could not synchronize %s: %s" % (instrument, sys.exc_value))
+
+    def sync_instrument(self, instrument, full=False, active_days=14):
+        """
+            Synchronize the proposals and runs of an instrument
+            @param instrument: instrument name
+            @param full: if True, all proposals are re-read
+            @param active_days: activity window around the watermark, in days
+        """
+        instrument_obj, _ = Instrument.objects.get_or_create(name=instrument.upper())
+        sync_start = timezone.now()
+        watermark = None
+        if not full and instrument_obj.last_sync is not None:
+            watermark = instrument_obj.last_sync - datetime.timedelta(days=active_days)
+
+        n_proposals = 0
+        for expt in iter_experiments(instrument):
+            proposal, created = Proposal.objects.get_or_create(instrument=instrument_obj,
+                                                               name=expt['id'])
+            create_time = to_db_time(expt.get('createTime', None))
+            title_changed = proposal.title != expt.get('title', '')
+            if created or title_changed or proposal.create_time != create_time:
+                proposal.title = expt.get('title', '')
+                proposal.create_time = create_time
+                proposal.save()
+            if self._needs_update(proposal, watermark, expt.get('runRange', None)):
+                self.sync_runs(instrument_obj, proposal, reindex_all=title_changed)
+                self.sync_run_range(proposal, expt.get('runRange', None))
+                n_proposals += 1
+            elif title_changed and not created:
+                index_runs(Run.objects.filter(proposal=proposal).select_related('proposal'))
+
+        instrument_obj.last_sync = sync_start
+        instrument_obj.save()
+        if n_proposals>0:
+            run_index.invalidate(instrument_obj.name)
+        self.stdout.write("%s: updated runs for %d proposals\n" % (instrument_obj.name, n_proposals))
+
+    def sync_run_range(self, proposal, run_range=None):
+        """
+            Store the run range of a proposal, used by the run number index.
+            The experiment list does not always report it, in which case
+            the proposal meta-data is queried.
+            @param proposal: Proposal object
+            @param run_range: run range from the experiment list, if available
+        """
+        if run_range is None:
+            run_range = get_ipts_info(proposal.instrument.name, proposal.name).get('run_range', None)
+        if run_range is not None and run_range != proposal.run_range:
+            proposal.run_range = run_range
+            proposal.save()
+
+    def _needs_update(self, proposal, watermark, run_range=None):
+        """
+            Determine whether the runs of a proposal should be fetched
+            @param proposal: Proposal object
+            @param watermark: time before which activity is considered final
+            @param run_range: run range from the experiment list, if available
+        """
+        if watermark is None or proposal.last_sync is None:
+            return True
+        # A new run extends the run range, however long the proposal was quiet
+        if run_range is not None and run_range != proposal.run_range:
+            return True
+        if proposal.create_time is not None and proposal.create_time >= watermark:
+            return True
+        latest = Run.objects.filter(proposal=proposal).aggregate(Max('start_time'))['start_time__max']
+        return latest is not None and latest >= watermark
+
+    @transaction.commit_on_success
+    def sync_runs(self, instrument_obj, proposal, reindex_all=False):
+        """
+            Store new runs and update those that had not ended,
+            then update the search index for those runs
+            @param instrument_obj: Instrument object
+            @param proposal: Proposal object
+            @param reindex_all: if True, all the runs of the proposal are re-indexed
+        """
+        sync_start = timezone.now()
+        existing = {}
+        for item in Run.objects.filter(instrument=instrument_obj, proposal=proposal):
+            existing[item.run_number] = item
+
+        new_runs = []
+        changed = []
+        for run_info in iter_ipts_runs(instrument_obj.name, proposal.name, return_raw=True):
+            try:
+                run_number = int(run_info['id'])
+            except ValueError:
+                continue
+            run_obj = existing.get(run_number, None)
+            if run_obj is not None and run_obj.end_time is not None:
+                continue
+            if run_obj is None:
+                run_obj = Run(instrument=instrument_obj, proposal=proposal, run_number=run_number)
+            run_obj.title = run_info.get('title', '')
+            run_obj.start_time = to_db_time(run_info.get('startTime', None))
+            run_obj.end_time = to_db_time(run_info.get('endTime', None))
+            run_obj.duration = run_info.get('duration', None)
+            run_obj.proton_charge = run_info.get('protonCharge', None)
+            run_obj.total_counts = run_info.get('totalCounts', None)
+            if run_obj.pk is None:
+                new_runs.append(run_obj)
+            else:
+                run_obj.save()
+            changed.append(run_number)
+        Run.objects.bulk_create(new_runs)
+
+        # Index only the runs we wrote, unless there are too many to list
+        runs = Run.objects.filter(proposal=proposal).select_related('proposal')
+        if not reindex_all and len(changed) <= _MAX_INDEX_LIST:
+            runs = runs.filter(run_number__in=changed)
+        if reindex_all or len(changed)>0:
+            index_runs(runs)
+        proposal.last_sync = sync_start
+        proposal.save()
@@ -0,0 +1,186 @@
+"""
+    Local mirror of the ICAT meta-data used by the catalog views.
+    The tables are filled by the sync_catalog management command.
+
+    @author: M. Doucet, Oak Ridge National Laboratory
+    @copyright: 2014 Oak Ridge National Laboratory
+"""
+from django.db import models
+from django.utils import timezone
+import catalog.view_util
+
+def to_db_time(value):
+    """
+        Convert a naive time stamp decoded from ICAT to an aware datetime
+        @param value: datetime object or None
+    """
+    if value is not None and timezone.is_naive(value):
+        return timezone.make_aware(value, timezone.get_default_timezone())
+    return value
+
+def from_db_time(value):
+    """
+        Convert a stored time stamp back to the naive
+        local time returned by the ICAT communication layer
+        @param value: datetime object or None
+    """
+    if value is not None and timezone.is_aware(value):
+        return timezone.make_naive(value, timezone.get_default_timezone())
+    return value
+
+class Instrument(models.Model):
+    """
+        Instrument known to the catalog
+    """
+    name = models.CharField(max_length=24, unique=True)
+    last_sync = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return self.name
+
+class ProposalManager(models.Manager):
+
+    def get_experiments(self, instrument):
+        """
+            Return the list of experiments for an instrument in the format
+            returned by icat_server_communication.get_experiments, or None
+            if the instrument has not been synchronized yet.
+            @param instrument: instrument name
+        """
+        try:
+            instrument_obj = Instrument.objects.get(name=instrument.upper())
+        except Instrument.DoesNotExist:
+            return None
+        if instrument_obj.last_sync is None:
+            return None
+        experiments = []
+        for item in self.filter(instrument=instrument_obj).order_by('-create_time'):
+            experiments.append(item.as_dict())
+        return experiments
+
+class Proposal(models.Model):
+    """
+        Experiment (IPTS) entry
+    """
+    instrument = models.ForeignKey(Instrument)
+    name = models.CharField(max_length=24, db_index=True)
+    title = models.TextField(blank=True)
+    create_time = models.DateTimeField(null=True, blank=True)
+    # Run range as reported by ICAT, e.g. '12801-12850, 12900'
+    run_range = models.TextField(blank=True)
+    last_sync = models.DateTimeField(null=True, blank=True)
+    objects = ProposalManager()
+
+    class Meta:
+        unique_together = ('instrument', 'name')
+
+    def __str__(self):
+        return self.name
+
+    def as_dict(self):
+        """
+            Return a dictionary in the format used by the catalog templates
+        """
+        return {'id': self.name,
+                'title': self.title,
+                'createTime': from_db_time(self.create_time)}
+
+class RunManager(models.Manager):
+
+    # Model fields corresponding to the sort keys of the run list API
+    SORT_FIELDS = {'id': 'run_number',
+                   'start': 'start_time',
+                   'counts': 'total_counts'}
+
+    def query_runs(self, instrument, ipts, sort='id', title=None, run_min=None, run_max=None):
+        """
+            Return a query set of runs for an experiment, or None if the runs
+            for that experiment have not been synchronized yet.
+            @param instrument: instrument name
+            @param ipts: experiment name
+            @param sort: one of SORT_FIELDS, prefixed with '-' for descending order
+            @param title: only keep runs with a title containing this string
+            @param run_min: smallest run number to keep
+            @param run_max: largest run number to keep
+        """
+        proposals = Proposal.objects.filter(instrument__name=instrument.upper(),
+                                            name=ipts.upper())
+        if len(proposals)==0 or proposals[0].last_sync is None:
+            return None
+        query_set = self.filter(proposal=proposals[0]).select_related('instrument')
+        if title is not None:
+            query_set = query_set.filter(title__icontains=title)
+        if run_min is not None:
+            query_set = query_set.filter(run_number__gte=run_min)
+        if run_max is not None:
+            query_set = query_set.filter(run_number__lte=run_max)
+        order = '-' if sort.startswith('-') else ''
+        return query_set.order_by(order+self.SORT_FIELDS[sort.lstrip('-')])
+
+    def get_ipts_runs(self, instrument, ipts):
+        """
+            Return the list of runs for an experiment in the format returned
+            by icat_server_communication.get_ipts_runs, or None if the runs
+            for that experiment have not been synchronized yet.
+            @param instrument: instrument name
+            @param ipts: experiment name
+        """
+        query_set = self.query_runs(instrument, ipts, sort='id')
+        if query_set is None:
+            return None
+        return [item.as_dict(ipts) for item in query_set]
+
+class Run(models.Model):
+    """
+        Run entry
+    """
+    instrument = models.ForeignKey(Instrument)
+    proposal = models.ForeignKey(Proposal)
+    run_number = models.IntegerField(db_index=True)
+    title = models.TextField(blank=True)
+    start_time = models.DateTimeField(null=True, blank=True, db_index=True)
+    end_time = models.DateTimeField(null=True, blank=True)
+    duration = models.FloatField(null=True, blank=True)
+    proton_charge = models.FloatField(null=True, blank=True)
+    total_counts = models.FloatField(null=True, blank=True)
+    objects = RunManager()
+
+    class Meta:
+        unique_together = ('instrument', 'run_number')
+
+    def __str__(self):
+        return "%s_%s" % (self.instrument, self.run_number)
+
+    def as_dict(self, ipts):
+        """
+            Return a dictionary in the format used by the catalog templates
+            @param ipts: experiment name used to build the run URLs
+        """
+        instrument = self.instrument.name
+        run_info = {'id': str(self.run_number),
+                    'title': self.title,
+                    'startTime': from_db_time(self.start_time),
+                    'endTime': from_db_time(self.end_time),
+                    'webmon_url': catalog.view_util.get_webmon_url(instrument, self.run_number, ipts),
+                    'reduce_url': catalog.view_util.get_new_reduction_url(instrument, self.run_number, ipts),
+                    'batch_url': catalog.view_util.get_new_batch_url(instrument, self.run_number, ipts)}
+        for key, value in [('duration', self.duration),
+                           ('protonCharge', self.proton_charge),
+                           ('totalCounts', self.total_counts)]:
+            if value is not None:
+                run_info[key] = "%.4G" % value
+        return run_info
+
+class SearchTerm(models.Model):
+    """
+        Inverted index entry used to search runs by title,
+        proposal title or proposal name
+    """
+    term = models.CharField(max_length=64, db_index=True)
+    run = models.ForeignKey(Run)
+
+    class Meta:
+        unique_together = ('term', 'run')
+
+    def __str__(self):
+        return self.term
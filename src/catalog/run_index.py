@@ -0,0 +1,129 @@
+"""
+    Reverse index from run number to experiment (IPTS).
+
+    The index for an instrument is built from the run ranges stored
+    in the local catalog and kept in memory as sorted arrays of
+    interval boundaries, so that a lookup is a binary search.
+
+    @author: M. Doucet, Oak Ridge National Laboratory
+    @copyright: 2014 Oak Ridge National Laboratory
+"""
+from django.core.cache import cache
+from django.db.models import Min, Max
+from array import array
+import bisect
+import threading
+import time
+import re
+
+from catalog.models import Proposal, Run
+
+# Time, in seconds, between checks for a newer version of the index
+_VERSION_CHECK_INTERVAL = 60
+
+def parse_run_range(run_range):
+    """
+        Parse an ICAT run range such as '12801-12850, 12900'
+        and return a list of (first, last) tuples
+        @param run_range: run range string
+    """
+    intervals = []
+    if run_range is None:
+        return intervals
+    for first, last in re.findall(r'(\d+)(?:\s*-\s*(\d+))?', run_range):
+        first = int(first)
+        last = int(last) if len(last)>0 else first
+        intervals.append((min(first, last), max(first, last)))
+    return intervals
+
+class RunIndex(object):
+    """
+        Sorted, non-overlapping run intervals for one instrument
+    """
+    def __init__(self, intervals):
+        """
+            @param intervals: list of (first, last, ipts) tuples
+        """
+        intervals = sorted(intervals)
+        self._firsts = array('l')
+        self._lasts = array('l')
+        self._ipts = []
+        for first, last, ipts in intervals:
+            # Overlapping ranges are trimmed so that each run maps to one experiment
+            if len(self._lasts)>0 and first <= self._lasts[-1]:
+                first = self._lasts[-1]+1
+                if first > last:
+                    continue
+            self._firsts.append(first)
+            self._lasts.append(last)
+            self._ipts.append(ipts)
+
+    def __len__(self):
+        return len(self._ipts)
+
+    def lookup(self, run_number):
+        """
+            Return the experiment containing a run, or None
+            @param run_number: run number [integer]
+        """
+        i = bisect.bisect_right(self._firsts, run_number) - 1
+        if i >= 0 and run_number <= self._lasts[i]:
+            return self._ipts[i]
+        return None
+
+def _build_index(instrument):
+    """
+        Build the index for an instrument from the local catalog.
+        Proposals without a run range use the span of their mirrored runs.
+        @param instrument: instrument name
+    """
+    intervals = []
+    missing = []
+    for name, run_range in Proposal.objects.filter(instrument__name=instrument).values_list('name', 'run_range'):
+        ranges = parse_run_range(run_range)
+        if len(ranges)==0:
+            missing.append(name)
+        for first, last in ranges:
+            intervals.append((first, last, name))
+    if len(missing)>0:
+        spans = Run.objects.filter(instrument__name=instrument, proposal__name__in=missing) \
+            .values('proposal__name').annotate(first=Min('run_number'), last=Max('run_number'))
+        for item in spans:
+            intervals.append((item['first'], item['last'], item['proposal__name']))
+    return RunIndex(intervals)
+
+def _version_key(instrument):
+    return 'run_index_version:%s' % instrument
+
+def invalidate(instrument):
+    """
+        Signal all worker processes that the index of an instrument must be rebuilt
+        @param instrument: instrument name
+    """
+    cache.set(_version_key(instrument.upper()), time.time(), None)
+
+_indices = {}
+_indices_lock = threading.Lock()
+
+def get_ipts_for_run(instrument, run_number):
+    """
+        Return the experiment a run belongs to, or None if it is unknown
+        @param instrument: instrument name
+        @param run_number: run number [string or integer]
+    """
+    try:
+        run_number = int(str(run_number).strip())
+    except ValueError:
+        return None
+    instrument = instrument.upper()
+    now = time.time()
+    with _indices_lock:
+        entry = _indices.get(instrument, None)
+        if entry is None or now - entry['checked'] > _VERSION_CHECK_INTERVAL:
+            version = cache.get(_version_key(instrument), 0)
+            if entry is None or entry['version'] != version:
+                entry = {'index': _build_index(instrument),
+                         'version': version}
+                _indices[instrument] = entry
+            entry['checked'] = now
+    return entry['index'].lookup(run_number)
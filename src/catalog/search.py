@@ -0,0 +1,79 @@
+"""
+    Search index over the runs of the local catalog.
+
+    Each run is indexed under the words of its title, of its proposal
+    title and of its proposal name. The index is kept up to date by the
+    sync_catalog command and can be rebuilt with rebuild_search_index.
+
+    @author: M. Doucet, Oak Ridge National Laboratory
+    @copyright: 2014 Oak Ridge National Laboratory
+"""
+from django.db import transaction
+from django.db.models import Q
+import datetime
+import re
+
+from catalog.models import Run, SearchTerm
+
+# Number of index entries written in a single query
+_BATCH_SIZE = 500
+
+# Maximum length of an indexed word
+_MAX_TERM_LENGTH = 64
+
+def tokenize(text):
+    """
+        Split a string into the lower-case words used by the index
+        @param text: string to split
+    """
+    if text is None:
+        return []
+    return [t[:_MAX_TERM_LENGTH] for t in re.findall(r'[a-z0-9]+', text.lower())]
+
+@transaction.commit_on_success
+def index_runs(runs):
+    """
+        (Re)index a list of runs
+        @param runs: list or query set of Run objects
+    """
+    runs = list(runs)
+    for i in range(0, len(runs), _BATCH_SIZE):
+        chunk = runs[i:i+_BATCH_SIZE]
+        SearchTerm.objects.filter(run__in=[r.id for r in chunk]).delete()
+        entries = []
+        for run in chunk:
+            terms = set(tokenize(run.title))
+            terms.update(tokenize(run.proposal.title))
+            terms.update(tokenize(run.proposal.name))
+            for term in terms:
+                entries.append(SearchTerm(term=term, run=run))
+        SearchTerm.objects.bulk_create(entries, batch_size=_BATCH_SIZE)
+
+def search_runs(query, instrument=None, year=None, start=None, end=None, limit=500):
+    """
+        Return the runs matching all the words of a query.
+        A word matches the beginning of an indexed word, and a
+        number also matches the run with that run number.
+        @param query: search string
+        @param instrument: instrument name, or None for all instruments
+        @param year: only return runs started during this year
+        @param start: only return runs started on or after this date
+        @param end: only return runs started before this date
+        @param limit: maximum number of runs to return
+    """
+    query_set = Run.objects.all()
+    for term in tokenize(query):
+        term_filter = Q(searchterm__term__startswith=term)
+        if term.isdigit():
+            term_filter = term_filter | Q(run_number=int(term))
+        query_set = query_set.filter(term_filter)
+    if instrument is not None:
+        query_set = query_set.filter(instrument__name=instrument.upper())
+    if year is not None:
+        query_set = query_set.filter(start_time__year=year)
+    if start is not None:
+        query_set = query_set.filter(start_time__gte=start)
+    if end is not None:
+        query_set = query_set.filter(start_time__lt=end)
+    query_set = query_set.distinct().select_related('instrument', 'proposal')
+    return query_set.order_by('-start_time')[:limit]
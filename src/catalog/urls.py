@@ -4,8 +4,12 @@ admin.autodiscover()
 
 urlpatterns = patterns('',
     url(r'^$', 'catalog.views.instrument_list', name='catalog'),
+    url(r'^search/$', 'catalog.views.run_search', name='catalog_run_search'),
+    url(r'^cache/stats$', 'catalog.views.cache_stats', name='catalog_cache_stats'),
     url(r'^(?P<instrument>[\w]+)/$', 'catalog.views.experiment_list', name='catalog_experiments'),
+    url(r'^(?P<instrument>[\w]+)/run/batch/$', 'catalog.views.run_info_batch', name='catalog_run_info_batch'),
     url(r'^(?P<instrument>[\w]+)/(?P<ipts>[\w\-\.]+)/$', 'catalog.views.experiment_run_list', name='catalog_runs'),
+    url(r'^(?P<instrument>[\w]+)/(?P<ipts>[\w\-\.]+)/runs$', 'catalog.views.experiment_run_list_json', name='catalog_runs_json'),
     url(r'^(?P<instrument>[\w]+)/(?P<ipts>[\w\-\.]+)/autoreduced$', 'catalog.views.download_autoreduced', name='catalog_get_autoreduced'),
     url(r'^(?P<instrument>[\w]+)/run/(?P<run_number>\d+)/', 'catalog.views.run_info', name='catalog_run_info'),
     url(r'^download/(?P<job_id>\d+)/(?P<filename>[\w\-\.]+)$', 'catalog.views.download_link', name='catalog_download_link'),
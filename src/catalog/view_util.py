@@ -1,4 +1,7 @@
 from django.conf import settings
+from django.core.urlresolvers import reverse
+import threading
+import json
 import logging
 import sys
 
@@ -13,19 +16,105 @@ def fill_template_values(request, **template_args):
         template_args['remote_url'] = get_remote_jobs_url(instrument)
     return template_args
 
+# Place holders used to turn the URLs returned by instrument apps into templates
+_RUN_MARKER = '__RUN__'
+_IPTS_MARKER = '__IPTS__'
+
+# Functions an instrument app may provide to link to its pages
+_URL_HOOKS = ['get_new_reduction_url', 'get_new_batch_url',
+              'get_reduction_url', 'get_remote_jobs_url']
+
+class InstrumentURLs(object):
+    """
+        URL hooks of an instrument app, resolved once per process.
+        Hooks that take a run and an experiment are turned into string
+        templates when possible, so that building the URL of a run
+        does not require calling reverse().
+    """
+    def __init__(self, instrument_app):
+        self.app = instrument_app
+        self.reduction_url = self._static_url('get_reduction_url')
+        self.remote_jobs_url = self._static_url('get_remote_jobs_url')
+        self.new_reduction_template = self._url_template('get_new_reduction_url')
+        self.new_batch_template = self._url_template('get_new_batch_url')
+
+    def _static_url(self, hook):
+        if hasattr(self.app, hook):
+            try:
+                return getattr(self.app, hook)()
+            except:
+                logging.error('Error getting URL: %s' % sys.exc_value)
+        return None
+
+    def _url_template(self, hook):
+        """
+            Return the URL produced by the hook with place holders for
+            the run and experiment, or None if it can't be templated
+        """
+        if hasattr(self.app, hook):
+            try:
+                url = getattr(self.app, hook)(_RUN_MARKER, _IPTS_MARKER)
+                if url is not None and _RUN_MARKER in url:
+                    return url
+            except:
+                pass
+        return None
+
+    def run_url(self, hook, template, run, ipts):
+        """
+            Return the URL for a given run
+            @param hook: name of the app function to fall back to
+            @param template: URL template for that hook, or None
+            @param run: run number
+            @param ipts: experiment name
+        """
+        if run is None or template is None:
+            if not hasattr(self.app, hook):
+                return None
+            try:
+                return getattr(self.app, hook)(run, ipts)
+            except:
+                logging.error('Error getting URL: %s' % sys.exc_value)
+                return None
+        return template.replace(_RUN_MARKER, str(run)).replace(_IPTS_MARKER, str(ipts))
+
+_registry = None
+_registry_lock = threading.Lock()
+
+def _get_instrument_urls(instrument):
+    """
+        Return the InstrumentURLs object for an instrument, or None
+        if there is no app for that instrument. The registry is built
+        the first time it is needed.
+        @param instrument: instrument name
+    """
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                registry = {}
+                for app in settings.INSTALLED_APPS:
+                    if '.' in app:
+                        continue
+                    try:
+                        instrument_app = __import__(app)
+                        for hook in _URL_HOOKS:
+                            if hasattr(instrument_app, hook):
+                                registry[app] = InstrumentURLs(instrument_app)
+                                break
+                    except:
+                        logging.error('Error loading URL hooks for %s: %s' % (app, sys.exc_value))
+                _registry = registry
+    return _registry.get(instrument.lower(), None)
+
 def get_new_reduction_url(instrument, run=None, ipts=None):
     """
         Return link to new reduction page if available
     """
-    url = None
-    if instrument.lower() in settings.INSTALLED_APPS:
-        try:
-            instrument_app = __import__(instrument.lower())
-            if hasattr(instrument_app, 'get_new_reduction_url'):
-                url = instrument_app.get_new_reduction_url(run, ipts)
-        except:
-            logging.error('Error getting URL: %s' % sys.exc_value)
-    return url
+    urls = _get_instrument_urls(instrument)
+    if urls is None:
+        return None
+    return urls.run_url('get_new_reduction_url', urls.new_reduction_template, run, ipts)
 
 def get_webmon_url(instrument, run=None, ipts=None):
     """
@@ -36,34 +125,76 @@ def get_webmon_url(instrument, run=None, ipts=None):
     return None
 
 def get_remote_jobs_url(instrument):
-    url = None
-    if instrument.lower() in settings.INSTALLED_APPS:
-        try:
-            instrument_app = __import__(instrument.lower())
-            if hasattr(instrument_app, 'get_remote_jobs_url'):
-                url = instrument_app.get_remote_jobs_url()
-        except:
-            logging.error('Error getting URL: %s' % sys.exc_value)
-    return url
+    urls = _get_instrument_urls(instrument)
+    if urls is None:
+        return None
+    return urls.remote_jobs_url
 
 def get_reduction_url(instrument):
-    url = None
-    if instrument.lower() in settings.INSTALLED_APPS:
-        try:
-            instrument_app = __import__(instrument.lower())
-            if hasattr(instrument_app, 'get_reduction_url'):
-                url = instrument_app.get_reduction_url()
-        except:
-            logging.error('Error getting URL: %s' % sys.exc_value)
-    return url
+    urls = _get_instrument_urls(instrument)
+    if urls is None:
+        return None
+    return urls.reduction_url
 
 def get_new_batch_url(instrument, run=None, ipts=None):
-    url = None
-    if instrument.lower() in settings.INSTALLED_APPS:
-        try:
-            instrument_app = __import__(instrument.lower())
-            if hasattr(instrument_app, 'get_new_batch_url'):
-                url = instrument_app.get_new_batch_url(run, ipts)
-        except:
-            logging.error('Error getting URL: %s' % sys.exc_value)
-    return url
\ No newline at end of file
+    urls = _get_instrument_urls(instrument)
+    if urls is None:
+        return None
+    return urls.run_url('get_new_batch_url', urls.new_batch_template, run, ipts)
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except:
+        return None
+
+# Sort keys accepted by the run list API.
+# Runs without a valid start time can't be compared with
+# a datetime, so they are sorted apart from the others.
+RUN_SORT_KEYS = {'id': lambda r: _to_float(r.get('id', None)),
+                 'start': lambda r: (r.get('startTime', None) is None, r.get('startTime', None)),
+                 'counts': lambda r: _to_float(r.get('totalCounts', None))}
+
+def sort_and_filter_runs(run_data, sort='-id', title=None, run_min=None, run_max=None):
+    """
+        Filter and sort a list of run dictionaries
+        as returned by get_ipts_runs
+        @param run_data: list of run dictionaries
+        @param sort: one of RUN_SORT_KEYS, prefixed with '-' for descending order
+        @param title: only keep runs with a title containing this string
+        @param run_min: smallest run number to keep
+        @param run_max: largest run number to keep
+    """
+    if title is not None:
+        title = title.lower()
+        run_data = [r for r in run_data if title in r.get('title', '').lower()]
+    if run_min is not None:
+        run_data = [r for r in run_data if _to_float(r['id']) >= run_min]
+    if run_max is not None:
+        run_data = [r for r in run_data if _to_float(r['id']) <= run_max]
+    reverse = sort.startswith('-')
+    return sorted(run_data, key=RUN_SORT_KEYS[sort.lstrip('-')], reverse=reverse)
+
+def outbox_submit_autoreduced(submission, transaction, submit):
+    """
+        Outbox handler submitting a job that zips the auto-reduced
+        files of an experiment. See remote.outbox.
+        @param submission: Submission object, with the instrument and experiment in its payload
+        @param transaction: Transaction object
+        @param submit: function sending the job script to Fermi
+    """
+    payload = json.loads(submission.payload)
+    instrument = payload['instrument'].upper()
+    ipts = payload['ipts'].upper()
+    file_name = "%s_%s.zip" % (instrument, payload['ipts'])
+    code =  'import os\n'
+    code += 'import zipfile\n'
+    code += 'output_zip_file = zipfile.ZipFile("%s", "w")\n' % file_name
+    code += 'for f in os.listdir("/SNS/%s/%s/shared/autoreduce"):\n' % (instrument, ipts)
+    code += '    output_zip_file.write("/SNS/%s/%s/shared/autoreduce/"+f, f)\n' % (instrument, ipts)
+    code += 'output_zip_file.close()\n'
+    job_id = submit(code)
+    if job_id is not None:
+        submission.result_url = reverse('catalog.views.download_link', args=[job_id, file_name])
+    return job_id
@@ -7,15 +7,26 @@
 from django.contrib.auth.decorators import login_required
 from django.shortcuts import render_to_response, redirect
 from django.core.urlresolvers import reverse
-from django.views.decorators.cache import cache_page
 from django.conf import settings
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseForbidden, HttpResponseBadRequest
+from django.core.serializers.json import DjangoJSONEncoder
 
-from icat_server_communication import get_ipts_runs, get_instruments, get_experiments, get_run_info
+from icat_cache import get_instruments, get_experiments, get_ipts_runs, get_run_info, get_run_info_batch, get_cache_stats
+from catalog.models import Proposal, Run
+from catalog.search import search_runs
 import catalog.view_util
 import remote.view_util
+from remote import outbox
 import reduction_service.view_util
+from catalog.templatetags.catalog_tags import timeperiod
 import json
+import datetime
+
+# Maximum number of runs returned by the run list API in a single page
+MAX_RUNS_PER_PAGE = 1000
+
+# Maximum number of runs in a single batch run info call
+MAX_BATCH_RUNS = 100
 
 @login_required
 def instrument_list(request):
@@ -43,7 +54,10 @@ def experiment_list(request, instrument):
         @param instrument: instrument name
     """
     breadcrumbs = "<a href='%s'>home</a> &rsaquo; %s catalog" % (reverse('home'), instrument.lower())
-    experiments = get_experiments(instrument.upper())
+    # Use the local copy of the catalog if it has been synchronized
+    experiments = Proposal.objects.get_experiments(instrument)
+    if experiments is None:
+        experiments = get_experiments(instrument.upper())
     template_values = {'experiments': experiments,
                        'instrument': instrument,
                        'title': '%s experiments' % instrument.upper(),
@@ -68,21 +82,68 @@ def experiment_run_list(request, instrument, ipts):
                                                                                              instrument.lower(),
                                                                                              ipts.lower(),
                                                                                              )
-    runs = get_ipts_runs(instrument.upper(), ipts)
-    template_values = {'run_data': runs,
-                       'instrument': instrument,
+    template_values = {'instrument': instrument,
                        'experiment': ipts,
+                       'run_list_url': reverse('catalog.views.experiment_run_list_json', args=[instrument, ipts]),
                        'title': '%s %s' % (instrument.upper(), ipts.upper()),
                        'breadcrumbs': breadcrumbs}
-    if len(runs)==0:
-        template_values['user_alert'] = ['No runs were found for instrument %s experiment %s' % (instrument, ipts)]
     template_values = reduction_service.view_util.fill_template_values(request, **template_values)
     template_values = catalog.view_util.fill_template_values(request, **template_values)
     return render_to_response('catalog/experiment_run_list.html',
                               template_values)
     
 @login_required
-@cache_page(120)
+def experiment_run_list_json(request, instrument, ipts):
+    """
+        Ajax call returning one page of the list of runs for a given experiment
+        @param request: request object
+        @param instrument: instrument name
+        @param ipts: experiment name
+        
+        Query parameters:
+            page: page number, starting at 1
+            per_page: number of runs per page
+            sort: id, start or counts, prefixed with '-' for descending order
+            title: only return runs with a title containing this string
+            run_min, run_max: range of run numbers to return
+    """
+    try:
+        page = max(int(request.GET.get('page', 1)), 1)
+        per_page = min(max(int(request.GET.get('per_page', 100)), 1), MAX_RUNS_PER_PAGE)
+        run_min = int(request.GET['run_min']) if len(request.GET.get('run_min', ''))>0 else None
+        run_max = int(request.GET['run_max']) if len(request.GET.get('run_max', ''))>0 else None
+    except ValueError:
+        return HttpResponseBadRequest("Invalid page or run range")
+    sort = request.GET.get('sort', '-id')
+    if not sort.lstrip('-') in catalog.view_util.RUN_SORT_KEYS:
+        return HttpResponseBadRequest("Invalid sort key: %s" % sort)
+    title = request.GET.get('title', '')
+    if len(title)==0:
+        title = None
+
+    start = (page-1)*per_page
+    query_set = Run.objects.query_runs(instrument, ipts, sort=sort, title=title,
+                                       run_min=run_min, run_max=run_max)
+    if query_set is not None:
+        total = query_set.count()
+        runs = [item.as_dict(ipts) for item in query_set[start:start+per_page]]
+    else:
+        # The proposal isn't in the local tables: page through one cached copy of the ICAT list
+        runs = get_ipts_runs(instrument.upper(), ipts)
+        runs = catalog.view_util.sort_and_filter_runs(runs, sort=sort, title=title,
+                                                      run_min=run_min, run_max=run_max)
+        total = len(runs)
+        runs = runs[start:start+per_page]
+    for r in runs:
+        r['time_period'] = timeperiod(r.get('startTime', None), r.get('endTime', None))
+
+    info_dict = {'page': page,
+                 'per_page': per_page,
+                 'total': total,
+                 'runs': runs}
+    return HttpResponse(json.dumps(info_dict, cls=DjangoJSONEncoder), content_type="application/json")
+    
+@login_required
 def run_info(request, instrument, run_number):
     """
          Ajax call to get run information (retrieved from ICAT)
@@ -95,6 +156,84 @@ def run_info(request, instrument, run_number):
     response['Connection'] = 'close'
     return response
 
+@login_required
+def run_info_batch(request, instrument):
+    """
+         Ajax call to get information for several runs at once.
+         The runs are passed as one or more 'runs' query parameters,
+         each of which may be a comma-separated list of run numbers.
+         Entries that are not run numbers are ignored.
+         @param request: request object
+         @param instrument: instrument name
+    """
+    run_numbers = []
+    for item in request.GET.getlist('runs'):
+        for run_number in item.split(','):
+            run_number = run_number.strip()
+            if run_number.isdigit() and not run_number in run_numbers:
+                run_numbers.append(run_number)
+    if len(run_numbers)>MAX_BATCH_RUNS:
+        return HttpResponseBadRequest("Too many runs requested: the maximum is %s" % MAX_BATCH_RUNS)
+    info_dict = get_run_info_batch(instrument, run_numbers)
+    return HttpResponse(json.dumps(info_dict), content_type="application/json")
+
+@login_required
+def run_search(request):
+    """
+        Search the local catalog for runs.
+        @param request: request object
+        
+        Query parameters:
+            q: words to look for in run titles, proposal titles or proposal names
+            instrument: instrument name
+            year: year the run started
+            start, end: range of start dates, as YYYY-MM-DD
+            format: 'json' to get the results as json
+    """
+    query = request.GET.get('q', '').strip()
+    instrument = request.GET.get('instrument', '').strip()
+    try:
+        year = int(request.GET['year']) if len(request.GET.get('year', ''))>0 else None
+        start = datetime.datetime.strptime(request.GET['start'], '%Y-%m-%d') if len(request.GET.get('start', ''))>0 else None
+        end = datetime.datetime.strptime(request.GET['end'], '%Y-%m-%d') if len(request.GET.get('end', ''))>0 else None
+    except ValueError:
+        return HttpResponseBadRequest("Invalid year or date")
+
+    run_data = []
+    if len(query)>0 or year is not None or start is not None or end is not None:
+        for item in search_runs(query, instrument=instrument if len(instrument)>0 else None,
+                                year=year, start=start, end=end):
+            run_info = item.as_dict(item.proposal.name)
+            run_info['instrument'] = item.instrument.name
+            run_info['experiment'] = item.proposal.name
+            run_data.append(run_info)
+
+    if request.GET.get('format', '') == 'json':
+        return HttpResponse(json.dumps(run_data, cls=DjangoJSONEncoder), content_type="application/json")
+
+    breadcrumbs = "<a href='%s'>home</a> &rsaquo; search" % reverse('catalog.views.instrument_list')
+    template_values = {'run_data': run_data,
+                       'query': query,
+                       'search_instrument': instrument,
+                       'year': request.GET.get('year', ''),
+                       'start': request.GET.get('start', ''),
+                       'end': request.GET.get('end', ''),
+                       'title': 'Run search',
+                       'breadcrumbs': breadcrumbs}
+    template_values = reduction_service.view_util.fill_template_values(request, **template_values)
+    return render_to_response('catalog/run_search.html',
+                              template_values)
+
+@login_required
+def cache_stats(request):
+    """
+         Return the ICAT cache hit/miss counters
+         @param request: request object
+    """
+    if not request.user.is_staff:
+        return HttpResponseForbidden()
+    return HttpResponse(json.dumps(get_cache_stats()), content_type="application/json")
+
 @login_required
 def download_autoreduced(request, instrument, ipts):
     """
@@ -103,9 +242,8 @@ def download_autoreduced(request, instrument, ipts):
         @param instrument: instrument name
         @param ipts: experiment name
     """
-    # Start a new transaction
-    transaction = remote.view_util.transaction(request, start=True)
-    if transaction is None:
+    # The job is sent to Fermi by the process_outbox command
+    if remote.view_util.get_authentication_status(request) is None:
         breadcrumbs = "<a href='%s'>home</a>" % reverse(settings.LANDING_VIEW)
         breadcrumbs += " &rsaquo; <a href='%s'>%s reduction</a>" % (reverse('catalog.views.experiment_list', args=[instrument]), instrument)
         template_values = {'message':"Could not connect to Fermi and establish transaction",
@@ -115,16 +253,11 @@ def download_autoreduced(request, instrument, ipts):
         return render_to_response('remote/failed_connection.html',
                                   template_values)
 
-    file_name = "%s_%s.zip" % (instrument.upper(), ipts)
-    code =  'import os\n'
-    code += 'import zipfile\n'
-    code += 'output_zip_file = zipfile.ZipFile("%s", "w")\n' % file_name
-    code += 'for f in os.listdir("/SNS/%s/%s/shared/autoreduce"):\n' % (instrument.upper(), ipts.upper())
-    code += '    output_zip_file.write("/SNS/%s/%s/shared/autoreduce/"+f, f)\n' % (instrument.upper(), ipts.upper())
-    code += 'output_zip_file.close()\n'
-    jobID = remote.view_util.submit_job(request, transaction, code)
-
-    return redirect(reverse('catalog.views.download_link', args=[jobID, file_name]))
+    submission = outbox.enqueue(request, 'catalog.view_util.outbox_submit_autoreduced',
+                                "Auto-reduced files for %s %s" % (instrument.upper(), ipts),
+                                {'instrument': instrument, 'ipts': ipts},
+                                key=request.GET.get('key', None))
+    return redirect(reverse('remote.views.submission_status', args=[submission.id]))
 
 @login_required
 def download_link(request, job_id, filename):
@@ -6,7 +6,8 @@
 """
 from django import forms
 from django.shortcuts import get_object_or_404
-from models import ReductionProcess, Instrument, Experiment, ReductionConfiguration
+from models import ReductionProcess, Instrument, Experiment, ReductionConfiguration, UNCATEGORIZED
+from catalog.run_index import get_ipts_for_run
 import time
 import sys
 import json
@@ -14,13 +15,20 @@ import logging
 import copy
 logger = logging.getLogger('eqsans.forms')
 
-def _process_experiment(reduction_obj, expt_string):
+def _process_experiment(reduction_obj, expt_string, data_file=None):
     """
         Process the experiment string of a form and find/create
         the appropriate Experiment object
         @param reduction_obj: ReductionProcess or ReductionConfiguration object
         @param expt_string: string taken from the reduction form
+        @param data_file: run number used to find the experiment when none is given
     """
+    # If no experiment was given, look it up from the run number
+    if data_file is not None and expt_string.strip().lower() in ['', UNCATEGORIZED]:
+        run_ipts = get_ipts_for_run('EQSANS', data_file)
+        if run_ipts is not None:
+            expt_string = run_ipts
+
     # Find experiment
     uncategorized_expt = Experiment.objects.get_uncategorized('eqsans')
     expts = expt_string.split(',')
@@ -74,6 +82,12 @@ class ReductionConfigurationForm(forms.Form):
     sample_thickness = forms.FloatField(required=False, initial=1.0)
     transmission_empty = forms.CharField(required=True)
 
+    # Compute resources. Leave empty to size the job from the run meta-data.
+    num_nodes = forms.IntegerField(required=False, min_value=1, label='Nodes',
+                                   help_text='Number of compute nodes [automatic if empty]')
+    cores_per_node = forms.IntegerField(required=False, min_value=1, label='Cores per node',
+                                        help_text='Number of cores on each node [automatic if empty]')
+
     @classmethod
     def data_from_db(cls, user, reduction_config):
         """
@@ -176,6 +190,12 @@ class ReductionOptions(forms.Form):
     background_file = forms.CharField(required=False, initial='')
     background_transmission_sample = forms.CharField(label='Transmission sample', required=False, initial='')
     background_transmission_empty = forms.CharField(label='Transmission empty', required=False, initial='')
+
+    # Compute resources. Leave empty to size the job from the run meta-data.
+    num_nodes = forms.IntegerField(required=False, min_value=1, label='Nodes',
+                                   help_text='Number of compute nodes [automatic if empty]')
+    cores_per_node = forms.IntegerField(required=False, min_value=1, label='Cores per node',
+                                        help_text='Number of cores on each node [automatic if empty]')
     
     @classmethod
     def as_xml(cls, data):
@@ -349,7 +369,8 @@ class ReductionOptions(forms.Form):
             logger.error("Could not process reduction properties: %s" % sys.exc_value)
         
         # Find experiment
-        _process_experiment(reduction_proc, self.cleaned_data['experiment'])
+        _process_experiment(reduction_proc, self.cleaned_data['experiment'],
+                            data_file=self.cleaned_data['data_file'])
                 
         return reduction_proc.pk
     
@@ -373,11 +394,13 @@ class ReductionOptions(forms.Form):
         return data
     
     @classmethod
-    def as_mantid_script(cls, data, output_path='/tmp'):
+    def as_mantid_script(cls, data, output_path='/tmp', cores_per_node=None):
         """
             Return the Mantid script associated with the current parameters
             @param data: dictionary of reduction properties
             @param output_path: output path to use in the script
+            @param cores_per_node: number of cores Mantid may use for multi-threaded
+                                   loading and binning [Mantid default if None]
         """
         script =  "# EQSANS reduction script\n"
         script += "import mantid\n"
@@ -385,6 +408,8 @@ class ReductionOptions(forms.Form):
         script += "from reduction_workflow.instruments.sans.sns_command_interface import *\n"
         script += "config = ConfigService.Instance()\n"
         script += "config['instrumentName']='EQSANS'\n"
+        if cores_per_node is not None:
+            script += "config['MultiThreaded.MaxCores']='%d'\n" % cores_per_node
 
         if 'mask_file' in data and len(data['mask_file'])>0:
             script += "mask_ws = Load(Filename=\"%s\")\n" % data['mask_file']
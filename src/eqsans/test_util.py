@@ -61,18 +61,15 @@ def get_dummy_data(request, job_id):
                 
     # Do we read this data already?
     plot_object = remote_job.get_first_plot(filename='4065_Iq.txt', owner=request.user)
-    if plot_object is not None and plot_object.first_data_layout() is not None:
-        data_str = plot_object.first_data_layout().dataset.data
-    else:
+    if plot_object is None:
         # If we don't have data stored, read it from file
         file_content = open(f,'r').read()
-        data_str = view_util.process_Iq_data(file_content)
+        data = view_util.process_Iq_data(file_content, return_raw=True)
         plot_object = Plot1D.objects.create_plot(request.user,
-                                                 data=data_str,
+                                                 data=data,
                                                  filename='4065_Iq.txt')
         remote_job.plots.add(plot_object)
     
-    template_values['plot_1d'] = data_str
     template_values['plot_object'] = plot_object
     template_values['plot_1d_id'] = plot_object.id if plot_object is not None else None
     
@@ -80,21 +77,15 @@ def get_dummy_data(request, job_id):
     f = os.path.join(os.path.split(__file__)[0],'..','plotting','data','4065_Iqxy.nxs')
     plot_object2d = remote_job.get_plot_2d(filename='4065_Iqxy.nxs', owner=request.user)
     if plot_object2d is None:
-        numpy.set_printoptions(threshold='nan', nanstr='0', infstr='0')
         fd = h5py.File(f, 'r')
         g = fd['mantid_workspace_1']
-        y = g['workspace']['axis1']
-        x = g['workspace']['axis2']
-        values = g['workspace']['values']
+        y = g['workspace']['axis1'][:]
+        x = g['workspace']['axis2'][:]
+        values = g['workspace']['values'][:]
+        fd.close()
         z_max = numpy.amax(values)
-        numpy.set_string_function( lambda x: '['+','.join(map(lambda y:'['+','.join(map(lambda z: "%.4g" % z,y))+']',x))+']' )
-        data_str_2d = values[:].__repr__()
-        numpy.set_string_function( lambda x: '['+','.join(map(lambda z: "%.4g" % z,x))+']' )
-
-        y_str = y[:].__repr__()
-        x_str = x[:].__repr__()
-        plot_object2d = Plot2D.objects.create_plot(user=request.user, data=data_str_2d,
-                                                   x_axis=x_str, y_axis=y_str,
+        plot_object2d = Plot2D.objects.create_plot(user=request.user, data=values,
+                                                   x_axis=x, y_axis=y,
                                                    z_min=0.0, z_max=z_max, filename='4065_Iqxy.nxs')
         remote_job.plots2d.add(plot_object2d)
 
@@ -5,15 +5,59 @@
     @copyright: 2014 Oak Ridge National Laboratory
 """
 from plotting.models import Plot1D, Plot2D
-from models import RemoteJob
+from django.conf import settings
+from django.db import transaction as db_transaction
+from django.core.urlresolvers import reverse
+from models import RemoteJob, ReductionProcess
 import remote.view_util
+from catalog.models import Run
+from catalog.run_index import parse_run_range
+from catalog import icat_cache
+from reduction_service.concurrency import iter_bounded
+from . import forms
+import zipfile
 import h5py
 import tempfile
 import numpy
+import time
+import math
+import json
+import re
 import sys
 import logging
 logger = logging.getLogger('eqsans.view_util')
 
+# Maximum number of files downloaded at once when streaming a zip file
+ZIP_FETCH_WORKERS = 4
+
+# Maximum number of jobs submitted at once for a configuration
+SUBMIT_WORKERS = 4
+
+# Size of the blocks of text parsed at once when reading an I(q) file, in bytes
+IQ_READ_CHUNK_SIZE = 256*1024
+
+# A row of an I(q) file holds q, I(q), dI(q) and optionally the q resolution,
+# separated by white space or commas. Any other line is a comment, a header
+# or a malformed row, and is skipped.
+_NUMBER = r'[-+]?(?:(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?|nan|inf(?:inity)?)'
+_SEPARATOR = r'(?:[ \t]*,[ \t]*|[ \t]+)'
+_IQ_ROW = re.compile(r'^[ \t]*(%(n)s)%(s)s(%(n)s)%(s)s(%(n)s)(?:%(s)s(%(n)s))?[ \t\r]*$' % {'n': _NUMBER, 's': _SEPARATOR},
+                     re.MULTILINE | re.IGNORECASE)
+
+# Parameters used to size jobs from the run meta-data, which can be
+# overridden with the EQSANS_JOB_SHAPE setting
+#   counts_per_core: number of events given to each core
+#   max_cores_per_node: number of cores available on a compute node
+#   max_runs: maximum number of runs looked up to size a job
+JOB_SHAPE = {'counts_per_core': 2e7,
+             'max_cores_per_node': 16,
+             'max_runs': 50}
+if hasattr(settings, 'EQSANS_JOB_SHAPE'):
+    JOB_SHAPE.update(settings.EQSANS_JOB_SHAPE)
+
+# Data file entry made only of run numbers and ranges, such as '1234, 1236-1240'
+_RUN_LIST = re.compile(r'^\s*\d+(\s*-\s*\d+)?(\s*,\s*\d+(\s*-\s*\d+)?)*\s*$')
+
 def get_latest_job(request, reduction_process):
     """
         Return the latest completed job for this reduction
@@ -24,11 +68,190 @@ def get_latest_job(request, reduction_process):
     if len(latest_jobs)>0:
         latest_job = latest_jobs.latest('id')
         # Check whether the job completed
-        job_info = remote.view_util.query_job(request, latest_job.remote_id)
+        job_info = remote.view_util.get_job_info(request, latest_job.remote_id)
         if job_info is not None and 'JobStatus' in job_info and job_info['JobStatus']=='COMPLETED':
             return latest_job
     return None
 
+def get_total_counts(data_file):
+    """
+        Return the total number of events in the runs of a reduction,
+        or None if it is not known. The local catalog is used first,
+        and ICAT is queried for runs that are not in it.
+        @param data_file: run number, or list of runs such as '1234, 1236-1240'
+    """
+    # File paths and other entries also contain digits, but no run list
+    if data_file is None or _RUN_LIST.match(data_file) is None:
+        return None
+    run_numbers = []
+    for first, last in parse_run_range(data_file):
+        remaining = JOB_SHAPE['max_runs'] - len(run_numbers)
+        run_numbers.extend(range(first, min(last, first + remaining - 1) + 1))
+        if len(run_numbers) >= JOB_SHAPE['max_runs']:
+            break
+    if len(run_numbers)==0:
+        return None
+
+    counts = {}
+    for run_number, total_counts in Run.objects.filter(instrument__name='EQSANS', run_number__in=run_numbers) \
+                                              .values_list('run_number', 'total_counts'):
+        if total_counts is not None:
+            counts[run_number] = total_counts
+    missing = [str(r) for r in run_numbers if r not in counts]
+    if len(missing)>0:
+        for run_number, run_info in icat_cache.get_run_info_batch('EQSANS', missing).items():
+            try:
+                counts[int(run_number)] = float(run_info['totalCounts'])
+            except (KeyError, ValueError):
+                pass
+    if len(counts)==0:
+        return None
+    return sum(counts.values())
+
+def get_job_shape(data):
+    """
+        Return the number of nodes and of cores per node to request for
+        a reduction. Values set by the user are kept, and the number of cores
+        is otherwise chosen from the number of events to process.
+        The number of cores is None if it can't be determined, in which
+        case one core is requested and Mantid picks its own thread count.
+        Since the reduction script is multi-threaded rather than distributed,
+        jobs are only given several nodes when requested explicitly.
+        @param data: dictionary of reduction properties
+    """
+    num_nodes = data.get('num_nodes', None)
+    cores_per_node = data.get('cores_per_node', None)
+    if num_nodes is None:
+        num_nodes = 1
+    if cores_per_node is None:
+        total_counts = get_total_counts(data.get('data_file', ''))
+        if total_counts is not None:
+            cores_per_node = int(math.ceil(total_counts/JOB_SHAPE['counts_per_core']))
+            cores_per_node = min(max(cores_per_node, 1), JOB_SHAPE['max_cores_per_node'])
+    return num_nodes, cores_per_node
+
+def submit_reductions(request, transaction, reductions):
+    """
+        Submit a list of reductions to Fermi, with up to SUBMIT_WORKERS
+        submissions in flight at once.
+        Returns a list of (reduction, job ID) tuples, with a job ID of
+        None for reductions that could not be submitted.
+        @param request: request object
+        @param transaction: Transaction object
+        @param reductions: list of ReductionProcess objects
+    """
+    def _submit(reduction_proc):
+        try:
+            data = forms.ReductionOptions.data_from_db(request.user, reduction_proc.id)
+            num_nodes, cores_per_node = get_job_shape(data)
+            code = forms.ReductionOptions.as_mantid_script(data, transaction.directory,
+                                                           cores_per_node=cores_per_node)
+            # Each job of the transaction gets its own script
+            return remote.view_util.submit_job(request, transaction, code,
+                                               script_name='reduction_%s.py' % reduction_proc.id,
+                                               num_nodes=num_nodes, cores_per_node=cores_per_node,
+                                               save_in_session=False)
+        except:
+            logger.error("Could not submit reduction %s: %s" % (reduction_proc.id, sys.exc_value))
+        return None
+
+    t0 = time.time()
+    job_ids = list(iter_bounded(_submit, [(item,) for item in reductions], SUBMIT_WORKERS))
+    delta_t = time.time()-t0
+    n_submitted = len([j for j in job_ids if j is not None])
+    logger.info("Submitted %d of %d jobs in %g sec (%g jobs/sec)" % (n_submitted, len(job_ids), delta_t,
+                                                                     n_submitted/delta_t if delta_t>0 else 0))
+    return zip(reductions, job_ids)
+
+def outbox_submit_reduction(submission, transaction, submit):
+    """
+        Outbox handler submitting a single reduction. See remote.outbox.
+        @param submission: Submission object, with the pk of the ReductionProcess in its payload
+        @param transaction: Transaction object
+        @param submit: function sending the job script to Fermi
+    """
+    reduction_id = json.loads(submission.payload)['reduction_id']
+    reduction_proc = ReductionProcess.objects.get(pk=reduction_id, owner=submission.owner)
+    data = forms.ReductionOptions.data_from_db(submission.owner, reduction_id)
+    num_nodes, cores_per_node = get_job_shape(data)
+    code = forms.ReductionOptions.as_mantid_script(data, transaction.directory,
+                                                   cores_per_node=cores_per_node)
+    job_id = submit(code, num_nodes=num_nodes, cores_per_node=cores_per_node)
+    if job_id is not None:
+        RemoteJob.objects.get_or_create(remote_id=job_id,
+                                        defaults={'reduction': reduction_proc,
+                                                  'properties': reduction_proc.properties,
+                                                  'transaction': transaction})
+        submission.result_url = reverse('eqsans.views.job_details', args=[job_id])
+    return job_id
+
+@db_transaction.commit_on_success
+def record_job_set(job_set, submitted):
+    """
+        Create the RemoteJob entries for the submitted jobs of a job set
+        @param job_set: RemoteJobSet object
+        @param submitted: list of (ReductionProcess, job ID) tuples
+    """
+    jobs = [RemoteJob(reduction=item,
+                      remote_id=job_id,
+                      properties=item.properties,
+                      transaction=job_set.transaction)
+            for item, job_id in submitted if job_id is not None]
+    if len(jobs)==0:
+        return
+    RemoteJob.objects.bulk_create(jobs)
+    # Bulk creation does not set primary keys, so read the jobs back
+    job_set.jobs.add(*RemoteJob.objects.filter(remote_id__in=[j.remote_id for j in jobs]))
+
+class ZipStreamBuffer(object):
+    """
+        Write-only file object collecting the output of a ZipFile
+        so that it can be sent to the client piece by piece
+    """
+    def __init__(self):
+        self._data = []
+        self._position = 0
+
+    def write(self, data):
+        self._data.append(data)
+        self._position += len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        """
+            Return the data written since the last call
+        """
+        data = ''.join(self._data)
+        self._data = []
+        return data
+
+def stream_remote_zip(request, trans_id, file_names):
+    """
+        Generator yielding a zip file containing files of a remote transaction.
+        Files are downloaded concurrently, and each zip entry is sent
+        as soon as its file is available.
+        @param request: request object
+        @param trans_id: remote name of the transaction
+        @param file_names: list of files to include
+    """
+    buffer = ZipStreamBuffer()
+    output_zip_file = zipfile.ZipFile(buffer, 'w')
+    args_list = [(request, trans_id, f) for f in file_names]
+    for f, file_data in zip(file_names, iter_bounded(remote.view_util.download_file,
+                                                       args_list, ZIP_FETCH_WORKERS)):
+        if file_data is None:
+            logger.error("Could not add %s to zip file" % f)
+            continue
+        output_zip_file.writestr(f, file_data)
+        yield buffer.drain()
+    output_zip_file.close()
+    yield buffer.drain()
+
 def process_iq_output(request, remote_job, trans_id, filename):
     """
         @param request: request object
@@ -36,25 +259,31 @@ def process_iq_output(request, remote_job, trans_id, filename):
         @param filename: data file containing plot data
     """
     template_values = {}
-    # Do we read this data already?
+    # Do we read this data already? The data itself is fetched
+    # by the client from the plotting app.
     plot_object = remote_job.get_first_plot(filename=filename, owner=request.user)
-    if plot_object is not None and plot_object.first_data_layout() is not None:
-        data_str = plot_object.first_data_layout().dataset.data
-    else:
+    if plot_object is None:
         # If we don't have data stored, read it from file
         logger.warning("Retrieving %s from compute resource" % filename)
-        file_content = remote.view_util.download_file(request, trans_id, filename)
-        if file_content is not None:
+        download = remote.view_util.stream_file(request, trans_id, filename)
+        if download is not None:
+            chunks, _, content_length = download
             try:
-                data_str = process_Iq_data(file_content)
+                reader = _CountingReader(chunks)
+                data = process_Iq_data(reader, return_raw=True)
+                # Don't store a plot for a download that was cut short
+                if content_length is not None and reader.n_bytes != int(content_length):
+                    raise RuntimeError, "incomplete download: %s of %s bytes" % (reader.n_bytes, content_length)
                 plot_object = Plot1D.objects.create_plot(request.user,
-                                                         data=data_str,
+                                                         data=data,
                                                          filename=filename)
                 remote_job.plots.add(plot_object)
             except:
                 logger.error("Could not process I(q) file: %s" % sys.exc_value)
+            finally:
+                if hasattr(chunks, 'close'):
+                    chunks.close()
     
-    template_values['plot_1d'] = data_str
     template_values['plot_object'] = plot_object
     template_values['plot_1d_id'] = plot_object.id if plot_object is not None else None
     return template_values
@@ -75,9 +304,9 @@ def process_iqxy_output(request, remote_job, trans_id, filename):
         file_content = remote.view_util.download_file(request, trans_id, filename)
         if file_content is not None:
             try:
-                data_str_2d, x_str, y_str, z_min, z_max = process_Iqxy_data(file_content)
-                plot_object2d = Plot2D.objects.create_plot(user=request.user, data=data_str_2d,
-                                                           x_axis=x_str, y_axis=y_str,
+                data_2d, x_axis, y_axis, z_min, z_max = process_Iqxy_data(file_content)
+                plot_object2d = Plot2D.objects.create_plot(user=request.user, data=data_2d,
+                                                           x_axis=x_axis, y_axis=y_axis,
                                                            z_min=z_min, z_max=z_max, 
                                                            filename=filename)
                 remote_job.plots2d.add(plot_object2d)
@@ -87,50 +316,104 @@ def process_iqxy_output(request, remote_job, trans_id, filename):
     template_values['plot_2d'] = plot_object2d
     return template_values
 
+class _CountingReader(object):
+    """
+        File-like object reading from an iterator over chunks
+        of data, and counting the number of bytes read
+    """
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self.n_bytes = 0
+
+    def read(self, size=-1):
+        # Return the next chunk, whatever its size
+        chunk = next(self._chunks, '')
+        self.n_bytes += len(chunk)
+        return chunk
+
+def _iter_line_blocks(source, chunk_size=IQ_READ_CHUNK_SIZE):
+    """
+        Generator yielding blocks of complete lines read from a string
+        or from a file-like object
+        @param source: string or object with a read() method
+        @param chunk_size: number of bytes to read at once
+    """
+    if isinstance(source, basestring):
+        yield source
+        return
+    remainder = ''
+    while True:
+        chunk = source.read(chunk_size)
+        if len(chunk)==0:
+            break
+        block = remainder + chunk
+        end = block.rfind('\n') + 1
+        remainder = block[end:]
+        if end > 0:
+            yield block[:end]
+    if len(remainder)>0:
+        yield remainder
+
+def read_Iq_data(source, with_resolution=False):
+    """
+        Read the I(q) output of Mantid and return the data as an array with
+        one (q, I, dI) row per point. Each block of text is matched in one
+        pass and converted by numpy, and the text is read chunk by chunk so
+        that the whole file is never held in memory.
+        @param source: content of the data file, or file-like object to read it from
+        @param with_resolution: if True, add a fourth column for the q resolution,
+                                set to NaN when the file doesn't provide it
+    """
+    n_cols = 4 if with_resolution else 3
+    arrays = []
+    for text in _iter_line_blocks(source):
+        rows = _IQ_ROW.findall(text)
+        if len(rows)==0:
+            continue
+        rows = numpy.array(rows)
+        data = rows[:, :3].astype(numpy.float64)
+        if with_resolution:
+            dq = numpy.empty(len(rows))
+            dq.fill(numpy.nan)
+            has_dq = rows[:, 3] != ''
+            dq[has_dq] = rows[has_dq, 3].astype(numpy.float64)
+            data = numpy.column_stack((data, dq))
+        arrays.append(data)
+    if len(arrays)==0:
+        return numpy.zeros((0, n_cols))
+    return numpy.concatenate(arrays)
+
 def process_Iq_data(file_content, return_raw=False):
     """
         Process the content of an I(q) file and return a string representation
         of the data that we can ship to the client for plotting.
-        @param file_content: content of the data file
-        @param return_raw: if True, return the array instead of a string
+        @param file_content: content of the data file, or file-like object to read it from
+        @param return_raw: if True, return the N x 3 array instead of a string
     """
-    data = []
-    for l in file_content.split('\n'):
-        toks = l.split()
-        if len(toks)>=3:
-            try:
-                q = float(toks[0])
-                iq = float(toks[1])
-                diq = float(toks[2])
-                data.append([q, iq, diq])
-            except:
-                pass
+    data = read_Iq_data(file_content)
     if return_raw:
         return data
-    return str(data)
+    return json.dumps(numpy.nan_to_num(data).tolist())
 
 def process_Iqxy_data(file_content):
     """
-        Process the content of an I(qx,qy) file and return a string representation
-        of the data that we can ship to the client for plotting.
+        Process the content of an I(qx,qy) file and return the
+        intensity array, the x and y axes, and the z range.
         @param file_content: content of the data file
     """
     fd = tempfile.NamedTemporaryFile()
     fd.write(file_content)
-    fd.seek(0)
+    fd.flush()
     
-    numpy.set_printoptions(threshold='nan', nanstr='0', infstr='0')
-    fd = h5py.File(fd.name, 'r')
-    g = fd['mantid_workspace_1']
-    y = g['workspace']['axis1']
-    x = g['workspace']['axis2']
-    values = g['workspace']['values']
+    h5_file = h5py.File(fd.name, 'r')
+    try:
+        g = h5_file['mantid_workspace_1']
+        y = g['workspace']['axis1'][:]
+        x = g['workspace']['axis2'][:]
+        values = g['workspace']['values'][:]
+    finally:
+        h5_file.close()
+        fd.close()
     z_max = numpy.amax(values)
-    numpy.set_string_function( lambda x: '['+','.join(map(lambda y:'['+','.join(map(lambda z: "%.4g" % z,y))+']',x))+']' )
-    data_str_2d = values[:].__repr__()
-    numpy.set_string_function( lambda x: '['+','.join(map(lambda z: "%.4g" % z,x))+']' )
-
-    y_str = y[:].__repr__()
-    x_str = x[:].__repr__()
-    return data_str_2d, x_str, y_str, 0.0, z_max
+    return values, x, y, 0.0, z_max
         
\ No newline at end of file
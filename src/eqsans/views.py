@@ -4,7 +4,7 @@
     @author: M. Doucet, Oak Ridge National Laboratory
     @copyright: 2014 Oak Ridge National Laboratory
 """
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import render_to_response, get_object_or_404, redirect
 from django.contrib.auth.decorators import login_required
 from django.core.urlresolvers import reverse
@@ -13,13 +13,16 @@ from django.conf import settings
 from models import ReductionProcess, Experiment, RemoteJob, Instrument, ReductionConfiguration, RemoteJobSet
 import reduction_service.view_util
 import remote.view_util
+from remote.models import ReductionJob
+from remote import outbox
 import view_util
 from catalog.icat_server_communication import get_ipts_info
+from catalog.run_index import get_ipts_for_run
+from catalog.views import MAX_BATCH_RUNS
+from reduction_service.concurrency import gather
 from . import forms
 from django.forms.formsets import formset_factory
 import copy
-import zipfile
-import StringIO
 
 @login_required
 def experiment(request, ipts):
@@ -41,10 +44,6 @@ def experiment(request, ipts):
 
     reduction_start_form = forms.ReductionStart(request.GET)
 
-    icat_ipts = {}
-    if not IS_UNCATEGORIZED:
-        icat_ipts = get_ipts_info('EQSANS', ipts)
-
     # Get all the user's reductions
     red_list = []
     if 'run_number' in request.GET:
@@ -55,6 +54,10 @@ def experiment(request, ipts):
             create_url +=  '?reduction_name=Reduction for r%s' % request.GET['run_number']
             create_url +=  '&expt_id=%d' % experiment_obj.id
             create_url +=  '&data_file=%s' % request.GET['run_number']
+            # Tag the new reduction with the experiment the run belongs to
+            run_ipts = get_ipts_for_run('EQSANS', request.GET['run_number'])
+            if run_ipts is not None:
+                create_url +=  '&expt_name=%s' % run_ipts
             return redirect(create_url)
     else:
         for item in ReductionProcess.objects.filter(owner=request.user,
@@ -62,12 +65,20 @@ def experiment(request, ipts):
             if not item in red_list:
                 red_list.append(item)
 
+    # Get the experiment info and the latest job of each reduction concurrently
+    calls = [(view_util.get_latest_job, (request, r)) for r in red_list]
+    if not IS_UNCATEGORIZED:
+        calls.append((get_ipts_info, ('EQSANS', ipts)))
+    results = gather(calls)
+    icat_ipts = {}
+    if not IS_UNCATEGORIZED:
+        icat_ipts = results.pop() or {}
+
     reductions = []
-    for r in red_list:
+    for r, latest_job in zip(red_list, results):
         data_dict = r.get_data_dict()
         data_dict['id'] = r.id
         data_dict['config'] = r.get_config()
-        latest_job = view_util.get_latest_job(request, r)
         if latest_job is not None:
             data_dict['completed_job'] = reverse('eqsans.views.job_details', args=[latest_job.remote_id])
         try:
@@ -164,12 +175,15 @@ def reduction_options(request, reduction_id=None):
     # ICAT info url
     icat_url = reverse('catalog.views.run_info', args=['EQSANS', '0000'])
     icat_url = icat_url.replace('/0000','')
+    icat_batch_url = reverse('catalog.views.run_info_batch', args=['EQSANS'])
     #TODO: add New an Save-As functionality
     template_values = {'options_form': options_form,
                        'title': 'EQSANS Reduction',
                        'breadcrumbs': breadcrumbs,
                        'reduction_id': reduction_id,
-                       'icat_url': icat_url }
+                       'icat_url': icat_url,
+                       'icat_batch_url': icat_batch_url,
+                       'max_batch_runs': MAX_BATCH_RUNS }
     # Get existing jobs for this reduction
     if reduction_id is not None:
         existing_jobs = RemoteJob.objects.filter(reduction=reduction_proc)
@@ -255,6 +269,7 @@ def reduction_configuration(request, config_id=None):
     # ICAT info url
     icat_url = reverse('catalog.views.run_info', args=['EQSANS', '0000'])
     icat_url = icat_url.replace('/0000','')
+    icat_batch_url = reverse('catalog.views.run_info_batch', args=['EQSANS'])
     #TODO: add New an Save-As functionality
     template_values = {'config_id': config_id,
                        'options_form': options_form,
@@ -263,7 +278,12 @@ def reduction_configuration(request, config_id=None):
                        'existing_job_sets': job_list,
                        'title': 'EQSANS Reduction',
                        'breadcrumbs': breadcrumbs,
-                       'icat_url': icat_url }
+                       'icat_url': icat_url,
+                       'icat_batch_url': icat_batch_url,
+                       'max_batch_runs': MAX_BATCH_RUNS }
+    # Report failures from the last submission
+    if 'eqsans_submit_alerts' in request.session:
+        template_values['user_alert'] = request.session.pop('eqsans_submit_alerts')
 
     template_values = reduction_service.view_util.fill_template_values(request, **template_values)
     return render_to_response('eqsans/reduction_table.html',
@@ -284,18 +304,13 @@ def reduction_configuration_submit(request, config_id):
         job_set = RemoteJobSet(transaction=transaction,
                                configuration=reduction_config)
         job_set.save()
-        # Loop through the reductions and submit them
-        for item in reductions:
-            data = forms.ReductionOptions.data_from_db(request.user, item.id)
-            code = forms.ReductionOptions.as_mantid_script(data, transaction.directory)
-            jobID = remote.view_util.submit_job(request, transaction, code)
-            if jobID is not None:
-                job = RemoteJob(reduction=item,
-                                remote_id=jobID,
-                                properties=item.properties,
-                                transaction=transaction)
-                job.save()
-                job_set.jobs.add(job)
+        # Submit the reductions concurrently
+        submitted = view_util.submit_reductions(request, transaction, list(reductions))
+        view_util.record_job_set(job_set, submitted)
+        failed = [item.name for item, job_id in submitted if job_id is None]
+        if len(failed)>0:
+            request.session['eqsans_submit_alerts'] = ["%d of %d reductions could not be submitted: %s" % \
+                                                       (len(failed), len(submitted), ', '.join(failed))]
     return redirect(reverse('eqsans.views.reduction_configuration', args=[config_id]))
     
 @login_required
@@ -325,8 +340,10 @@ def reduction_configuration_query(request, remote_set_id):
     # Get status of each job
     job_set_info = []
     first_job = None
-    for item in job_set.jobs.all():
-        job_info = remote.view_util.query_job(request, item.remote_id)
+    jobs = job_set.jobs.all().select_related('reduction')
+    job_status = remote.view_util.query_jobs(request, [item.remote_id for item in jobs])
+    for item in jobs:
+        job_info = job_status.get(str(item.remote_id), None)
         if job_info is not None:
             first_job = item
             job_info['reduction_name'] = item.reduction.name
@@ -361,22 +378,16 @@ def reduction_configuration_iq(request, remote_set_id):
         @param remote_id: pk of RemoteJobSet object
     """
     job_set = get_object_or_404(RemoteJobSet, pk=remote_set_id)
-    files = remote.view_util.query_files(request, job_set.transaction.trans_id)
+    trans_id = job_set.transaction.trans_id
+    files = remote.view_util.query_files(request, trans_id)
+    if files is None:
+        files = []
+    iq_files = [f for f in files if f.endswith('_Iq.txt')]
     
-    str_io = StringIO.StringIO()
-    output_zip_file = zipfile.ZipFile(str_io, 'w')
-    for f in files:
-        if f.endswith('_Iq.txt'):
-            file_data = remote.view_util.download_file(request, job_set.transaction, f)
-            fd = StringIO.StringIO()
-            fd.write(file_data)
-            output_zip_file.writestr(f, fd.getvalue())
-            fd.close()
-    output_zip_file.close()
-    # Create response with correct MIME-type
-    resp = HttpResponse(str_io.getvalue(), mimetype = "application/x-zip-compressed")
-    resp['Content-Disposition'] = 'attachment; filename=%s' % 'iq_transaction_%s.zip' % job_set.transaction.trans_id
-    str_io.close()
+    # Stream the zip file as the I(q) files are retrieved
+    resp = StreamingHttpResponse(view_util.stream_remote_zip(request, trans_id, iq_files),
+                                 content_type="application/x-zip-compressed")
+    resp['Content-Disposition'] = 'attachment; filename=%s' % 'iq_transaction_%s.zip' % trans_id
     return resp
 
 @login_required
@@ -424,9 +435,11 @@ def reduction_script(request, reduction_id):
     breadcrumbs += " &rsaquo; <a href='%s'>eqsans reduction</a>" % reverse('eqsans.views.reduction_home')
     breadcrumbs += " &rsaquo; <a href='.'>reduction %s</a> &rsaquo; script" % reduction_id
     
+    # Show the script as it would be submitted
+    _, cores_per_node = view_util.get_job_shape(data)
     template_values = {'reduction_name': data['reduction_name'],
                        'breadcrumbs': breadcrumbs,
-                       'code': forms.ReductionOptions.as_mantid_script(data) }
+                       'code': forms.ReductionOptions.as_mantid_script(data, cores_per_node=cores_per_node) }
     template_values = reduction_service.view_util.fill_template_values(request, **template_values)
     return render_to_response('eqsans/reduction_script.html',
                               template_values)
@@ -440,7 +453,8 @@ def py_reduction_script(request, reduction_id):
         @param reduction_id: pk of the ReductionProcess object
     """
     data = forms.ReductionOptions.data_from_db(request.user, reduction_id) 
-    response = HttpResponse(forms.ReductionOptions.as_mantid_script(data))
+    _, cores_per_node = view_util.get_job_shape(data)
+    response = HttpResponse(forms.ReductionOptions.as_mantid_script(data, cores_per_node=cores_per_node))
     response['Content-Disposition'] = 'attachment; filename="eqsans_reduction.py"'
     return response
 
@@ -469,9 +483,8 @@ def submit_job(request, reduction_id):
     #TODO: Make sure the submission errors are clearly reported
     reduction_proc = get_object_or_404(ReductionProcess, pk=reduction_id, owner=request.user)
 
-    # Start a new transaction
-    transaction = remote.view_util.transaction(request, start=True)
-    if transaction is None:
+    # The job is sent to Fermi by the process_outbox command
+    if remote.view_util.get_authentication_status(request) is None:
         breadcrumbs = "<a href='%s'>home</a>" % reverse(settings.LANDING_VIEW)
         breadcrumbs += " &rsaquo; <a href='%s'>eqsans reduction</a>" % reverse('eqsans.views.reduction_home')
         breadcrumbs += " &rsaquo; <a href='%s'>reduction</a>" % reverse('eqsans.views.reduction_options', args=[reduction_id])
@@ -482,16 +495,10 @@ def submit_job(request, reduction_id):
         return render_to_response('remote/failed_connection.html',
                                   template_values)
 
-    data = forms.ReductionOptions.data_from_db(request.user, reduction_id)
-    code = forms.ReductionOptions.as_mantid_script(data, transaction.directory)
-    jobID = remote.view_util.submit_job(request, transaction, code)
-    if jobID is not None:
-        job = RemoteJob(reduction=reduction_proc,
-                        remote_id=jobID,
-                        properties=reduction_proc.properties,
-                        transaction=transaction)
-        job.save()
-    return redirect(reverse('eqsans.views.reduction_options', args=[reduction_id]))
+    outbox.enqueue(request, 'eqsans.view_util.outbox_submit_reduction',
+                   reduction_proc.name, {'reduction_id': reduction_proc.id},
+                   key=request.GET.get('key', None))
+    return redirect(reverse('eqsans.views.reduction_jobs'))
 
 @login_required
 def job_details(request, job_id):
@@ -515,21 +522,24 @@ def job_details(request, job_id):
                        'reduction_id': remote_job.reduction.id,
                        'breadcrumbs': breadcrumbs,
                        'back_url': request.path}
-    template_values = remote.view_util.fill_job_dictionary(request, job_id, **template_values)
+    template_values = remote.view_util.fill_job_dictionary(request, job_id,
+                                                           trans_id=remote_job.transaction.trans_id,
+                                                           **template_values)
     template_values = reduction_service.view_util.fill_template_values(request, **template_values)
     template_values['title'] = "EQSANS job results"
     
-    # Go through the files and find data to plot
-    if 'job_files' in template_values and 'trans_id' in template_values:
+    # Go through the files and find data to plot, fetching the files concurrently
+    if template_values.get('job_files', None) is not None and 'trans_id' in template_values:
+        calls = []
         for f in template_values['job_files']:
             if f.endswith('_Iq.txt'):
-                plot_info = view_util.process_iq_output(request, remote_job, 
-                                                        template_values['trans_id'], f)
-                template_values.update(plot_info)
+                calls.append((view_util.process_iq_output, (request, remote_job, 
+                                                            template_values['trans_id'], f)))
             elif f.endswith('_Iqxy.nxs'):
-                plot_info = view_util.process_iqxy_output(request, remote_job, 
-                                                          template_values['trans_id'], f)
-                template_values.update(plot_info)
+                calls.append((view_util.process_iqxy_output, (request, remote_job, 
+                                                              template_values['trans_id'], f)))
+        for plot_info in gather(calls, timeout=remote.view_util.FERMI_TIMEOUTS['download'], default={}):
+            template_values.update(plot_info)
     
     return render_to_response('eqsans/reduction_job_details.html',
                               template_values)
@@ -553,12 +563,17 @@ def reduction_jobs(request):
         
         @param request: request object
     """
-    jobs = RemoteJob.objects.filter(transaction__owner=request.user)
+    jobs = RemoteJob.objects.filter(transaction__owner=request.user).select_related('transaction', 'reduction')
+    # Job status as last recorded by the job poller
+    job_status = {}
+    for job_obj in ReductionJob.objects.filter(owner=request.user).select_related('status'):
+        job_status[str(job_obj.job_id)] = job_obj.status.status
     status_data = []
     for job in jobs:
         if not job.transaction.is_active or job.reduction.get_config() is not None:
             continue
         j_data = {'id': job.remote_id,
+                  'status': job_status.get(job.remote_id, ''),
                   'name': job.reduction.name,
                   'reduction_id': job.reduction.id,
                   'start_date': job.transaction.start_time,
@@ -586,6 +601,7 @@ def reduction_jobs(request):
     breadcrumbs += " &rsaquo; <a href='%s'>eqsans reduction</a>" % reverse('eqsans.views.reduction_home')
     breadcrumbs += " &rsaquo; jobs"
     template_values = {'status_data': status_data,
+                       'submissions': outbox.get_user_submissions(request.user),
                        'config_data': config_data,
                        'back_url': request.path,
                        'breadcrumbs': breadcrumbs}
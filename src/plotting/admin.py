@@ -8,7 +8,7 @@ class Plot2DAdmin(admin.ModelAdmin):
     list_display = ('id', 'owner', 'filename')
     
 class DataSetAdmin(admin.ModelAdmin):
-    list_display = ('id', 'owner', 'data')
+    list_display = ('id', 'owner')
     
 class DataLayoutAdmin(admin.ModelAdmin):
     list_display = ('id', 'owner', 'color', 'size')
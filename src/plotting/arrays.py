@@ -0,0 +1,83 @@
+"""
+    Compact storage of plot arrays.
+
+    Arrays are serialized in the .npy format, which keeps their shape
+    and dtype, optionally compressed with zlib, and base64-encoded so
+    that they fit in a text column. Reading an array back is a copy
+    from the decoded buffer: no number is parsed from text.
+
+    @author: M. Doucet, Oak Ridge National Laboratory
+    @copyright: 2014 Oak Ridge National Laboratory
+"""
+from django.conf import settings
+import numpy
+import base64
+import zlib
+import json
+import re
+import StringIO
+
+# Set PLOT_ARRAY_COMPRESSION to False to store arrays uncompressed
+PLOT_ARRAY_COMPRESSION = getattr(settings, 'PLOT_ARRAY_COMPRESSION', True)
+
+# Prefixes identifying the encoding of a stored array
+_COMPRESSED = 'z:'
+_RAW = 'n:'
+
+def encode_array(array, dtype=numpy.float64, compress=None):
+    """
+        Return the text representation of an array to be stored in the DB
+        @param array: array or nested list of numbers
+        @param dtype: type of the stored values
+        @param compress: if True, compress the data [PLOT_ARRAY_COMPRESSION if None]
+    """
+    if compress is None:
+        compress = PLOT_ARRAY_COMPRESSION
+    array = numpy.ascontiguousarray(array, dtype=dtype)
+    buffer = StringIO.StringIO()
+    numpy.save(buffer, array)
+    if compress:
+        return _COMPRESSED + base64.b64encode(zlib.compress(buffer.getvalue()))
+    return _RAW + base64.b64encode(buffer.getvalue())
+
+def decode_array(value):
+    """
+        Return the array stored by encode_array, or None if there is none
+        @param value: stored representation of the array
+    """
+    if value is None or len(value)==0:
+        return None
+    content = base64.b64decode(value[len(_COMPRESSED):])
+    if value.startswith(_COMPRESSED):
+        content = zlib.decompress(content)
+    return numpy.load(StringIO.StringIO(content))
+
+def parse_legacy_text(text):
+    """
+        Parse the text representation of an array that was stored before
+        arrays were kept in binary form, such as '[[0.1, 2.0], [0.2, nan]]'
+        @param text: text representation of the array
+    """
+    if text is None or len(text.strip())==0:
+        return numpy.zeros(0)
+    # Python and numpy write nan and inf, which JSON spells differently
+    text = re.sub(r'\bnan\b', 'NaN', text)
+    text = re.sub(r'\binf\b', 'Infinity', text)
+    return numpy.asarray(json.loads(text), dtype=numpy.float64)
+
+def array_to_json(array, number_format=None):
+    """
+        Return a JSON representation of an array for the client
+        @param array: numpy array
+        @param number_format: format used for each value, such as '%.4g',
+                              or None to keep full precision
+    """
+    # Non-finite values are not valid JSON numbers
+    array = numpy.nan_to_num(array)
+    if number_format is None:
+        return json.dumps(array.tolist())
+    def _format(values):
+        if values.ndim > 1:
+            return '[' + ','.join([_format(row) for row in values]) + ']'
+        return '[' + ','.join([number_format % v for v in values]) + ']'
+    return _format(array)
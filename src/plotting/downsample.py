@@ -0,0 +1,58 @@
+"""
+    Level-of-detail reduction of 1D data sets for display.
+
+    The q range is divided into one bucket per pixel of the plot, and
+    only the points with the lowest and highest intensity of each bucket
+    are kept, along with their errors. The shape of the curve, including
+    its spikes and dips, is preserved while the number of points drawn
+    never exceeds twice the plot width.
+
+    @author: M. Doucet, Oak Ridge National Laboratory
+    @copyright: 2014 Oak Ridge National Laboratory
+"""
+import numpy
+
+def select_range(data, q_min=None, q_max=None):
+    """
+        Return the points of an N x 3 (q, I, dI) array with q within a range
+        @param data: N x 3 array
+        @param q_min: lowest q value to keep, or None
+        @param q_max: highest q value to keep, or None
+    """
+    mask = numpy.ones(len(data), dtype=bool)
+    if q_min is not None:
+        mask &= data[:,0] >= q_min
+    if q_max is not None:
+        mask &= data[:,0] <= q_max
+    return data[mask]
+
+def min_max_buckets(data, n_buckets):
+    """
+        Downsample an N x 3 (q, I, dI) array by keeping the points of
+        lowest and highest I in each of n_buckets equal q intervals.
+        The first and last points are always kept.
+        @param data: N x 3 array
+        @param n_buckets: number of q intervals, typically the plot width in pixels
+    """
+    # Points that can't be drawn would take the place of valid ones
+    data = data[numpy.all(numpy.isfinite(data), axis=1)]
+    n_points = len(data)
+    if n_buckets < 1 or n_points <= 2*n_buckets:
+        return data
+    data = data[numpy.argsort(data[:,0], kind='mergesort')]
+
+    q = data[:,0]
+    q_span = q[-1] - q[0]
+    if q_span <= 0:
+        return data[[0, -1]]
+    buckets = ((q - q[0]) / q_span * n_buckets).astype(int)
+    numpy.clip(buckets, 0, n_buckets-1, out=buckets)
+
+    # Sort by bucket, then by intensity within each bucket, so that the
+    # first and last entries of each bucket are its minimum and maximum
+    order = numpy.lexsort((data[:,1], buckets))
+    sorted_buckets = buckets[order]
+    _, starts = numpy.unique(sorted_buckets, return_index=True)
+    ends = numpy.append(starts[1:], n_points) - 1
+    keep = numpy.unique(numpy.concatenate((order[starts], order[ends], [0, n_points-1])))
+    return data[keep]
@@ -0,0 +1,88 @@
+"""
+    Convert stored plot data to its binary representation.
+
+    Adds the columns holding the binary arrays when the tables were
+    created before they existed, then converts the entries that still
+    hold the text representation of their data, and builds the tile
+    pyramid of 2D plots that don't have one.
+
+    @author: M. Doucet, Oak Ridge National Laboratory
+    @copyright: 2014 Oak Ridge National Laboratory
+"""
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from optparse import make_option
+import logging
+import sys
+
+from plotting.models import DataSet, Plot2D
+
+def add_missing_columns(model):
+    """
+        Add the columns of a model that are missing from its table.
+        New columns are nullable so that existing rows remain valid.
+        @param model: model class
+    """
+    cursor = connection.cursor()
+    table = model._meta.db_table
+    columns = [c[0] for c in connection.introspection.get_table_description(cursor, table)]
+    added = []
+    for field in model._meta.local_fields:
+        if field.column not in columns:
+            cursor.execute("ALTER TABLE %s ADD COLUMN %s %s NULL" % (connection.ops.quote_name(table),
+                                                                    connection.ops.quote_name(field.column),
+                                                                    field.db_type(connection)))
+            added.append(field.column)
+    transaction.commit_unless_managed()
+    return added
+
+class Command(BaseCommand):
+    help = 'Convert stored plot data from text to binary arrays'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch', type='int', dest='batch', default=100,
+                    help='Number of entries converted in each database transaction'),
+    )
+
+    def handle(self, *args, **options):
+        for model in [DataSet, Plot2D]:
+            for column in add_missing_columns(model):
+                self.stdout.write("Added column %s to %s\n" % (column, model._meta.db_table))
+        n_1d = self.convert(DataSet.objects.filter(array_data__isnull=True),
+                            self._convert_dataset, options['batch'])
+        n_2d = self.convert(Plot2D.objects.filter(data_array__isnull=True),
+                            self._convert_plot2d, options['batch'])
+        self.stdout.write("Converted %d data sets and %d 2D plots\n" % (n_1d, n_2d))
+        n_pyramids = self.convert(Plot2D.objects.filter(pyramid_levels__isnull=True),
+                                  self._build_pyramid, options['batch'])
+        self.stdout.write("Built %d tile pyramids\n" % n_pyramids)
+
+    def convert(self, query_set, convert_func, batch_size):
+        """
+            Convert the entries of a query set in batches
+            @param query_set: entries to convert
+            @param convert_func: function converting one entry
+            @param batch_size: number of entries per transaction
+        """
+        ids = list(query_set.values_list('id', flat=True))
+        n_converted = 0
+        for i in range(0, len(ids), batch_size):
+            with transaction.commit_on_success():
+                for item in query_set.model.objects.filter(id__in=ids[i:i+batch_size]):
+                    try:
+                        convert_func(item)
+                        n_converted += 1
+                    except:
+                        logging.error("Could not convert %s %s: %s" % (query_set.model.__name__,
+                                                                       item.id, sys.exc_value))
+        return n_converted
+
+    def _convert_dataset(self, dataset):
+        dataset.set_array(dataset.get_array())
+        dataset.save()
+
+    def _convert_plot2d(self, plot2d):
+        plot2d.set_arrays(plot2d.get_data(), plot2d.get_x_axis(), plot2d.get_y_axis())
+        plot2d.save()
+
+    def _build_pyramid(self, plot2d):
+        plot2d.build_pyramid()
@@ -1,8 +1,12 @@
 """
     Models used to store plotting data and options
 """
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from django.contrib.auth.models import User
+import numpy
+
+from arrays import encode_array, decode_array, parse_legacy_text
+import pyramid
 
 class PlotLayout(models.Model):
     """
@@ -28,12 +32,33 @@ class DataSet(models.Model):
         Data set. Used as cache.
     """
     owner = models.ForeignKey(User)
-    data  = models.TextField()
+    # Text representation of the data, only kept for entries
+    # that were not converted with the convert_plot_data command
+    data  = models.TextField(blank=True, default='')
+    # Binary representation of the (q, I, dI) array. See plotting.arrays.
+    array_data = models.TextField(null=True, blank=True)
     #filename = models.TextField()
     
     def __str__(self):
         return str(self.owner)
     
+    def set_array(self, array):
+        """
+            Store the data points
+            @param array: N x 3 array of (q, I, dI) values
+        """
+        self.array_data = encode_array(array, dtype=numpy.float64)
+        self.data = ''
+        
+    def get_array(self):
+        """
+            Return the data points as an N x 3 array of (q, I, dI) values
+        """
+        array = decode_array(self.array_data)
+        if array is None:
+            array = parse_legacy_text(self.data)
+        return array
+    
 class DataLayout(models.Model):
     """
         Options related to the plotted data.
@@ -51,10 +76,11 @@ class Plot1DManager(models.Manager):
         """
             Create a default plot, with all associated DB entries
             @param user: owner of the plot
-            @param data: string representation of the data
+            @param data: N x 3 array of (q, I, dI) values
             @param filename: name of the file that contained the data
         """
-        dataset = DataSet(owner=user, data=data)
+        dataset = DataSet(owner=user)
+        dataset.set_array(data)
         dataset.save()
         datalayout = DataLayout(owner=user, dataset=dataset)
         datalayout.save()
@@ -91,21 +117,24 @@ class Plot2DManager(models.Manager):
         """
             Create a default plot, with all associated DB entries
             @param user: owner of the plot
-            @param data: string representation of the data
-            @param x_axis: string representation of the x axis
-            @param y_axis: string representation of the y axis
+            @param data: 2D array of intensities
+            @param x_axis: array of x values
+            @param y_axis: array of y values
             @param z_min: minimum value of the plotted data in z
             @param z_max: maximum value of the plotted data in z
             @param filename: name of the plotted data file
         """
-        plotlayout = PlotLayout(owner=user, width=550, height=550,
-                                x_label='Qx [1/&Aring;]',
-                                y_label='Qy [1/&Aring;]',)
-        plotlayout.save()
-        plot2d = Plot2D(owner=user, filename=filename, layout=plotlayout,
-                        data=data, x_axis=x_axis, y_axis=y_axis,
-                        z_min=z_min, z_max=z_max)
-        plot2d.save()
+        # A plot is only stored along with its complete pyramid
+        with transaction.commit_on_success():
+            plotlayout = PlotLayout(owner=user, width=550, height=550,
+                                    x_label='Qx [1/&Aring;]',
+                                    y_label='Qy [1/&Aring;]',)
+            plotlayout.save()
+            plot2d = Plot2D(owner=user, filename=filename, layout=plotlayout,
+                            z_min=z_min, z_max=z_max)
+            plot2d.set_arrays(data, x_axis, y_axis)
+            plot2d.save()
+            plot2d.build_pyramid()
         return plot2d
 
 class Plot2D(models.Model):
@@ -114,9 +143,15 @@ class Plot2D(models.Model):
     """
     owner = models.ForeignKey(User)
     filename = models.TextField()
-    data = models.TextField()
-    x_axis = models.TextField()
-    y_axis = models.TextField()
+    # Text representations of the data, only kept for entries
+    # that were not converted with the convert_plot_data command
+    data = models.TextField(blank=True, default='')
+    x_axis = models.TextField(blank=True, default='')
+    y_axis = models.TextField(blank=True, default='')
+    # Binary representations of the data. See plotting.arrays.
+    data_array = models.TextField(null=True, blank=True)
+    x_array = models.TextField(null=True, blank=True)
+    y_array = models.TextField(null=True, blank=True)
     z_min = models.FloatField()
     z_max = models.FloatField()
     layout = models.ForeignKey(PlotLayout, null=True, blank=True)
@@ -125,3 +160,138 @@ class Plot2D(models.Model):
     def __str__(self):
         return self.filename
     
+    def set_arrays(self, data, x_axis, y_axis):
+        """
+            Store the plot data. The intensities are stored in
+            single precision, which is plenty for display.
+            @param data: 2D array of intensities
+            @param x_axis: array of x values
+            @param y_axis: array of y values
+        """
+        self.data_array = encode_array(data, dtype=numpy.float32)
+        self.x_array = encode_array(x_axis, dtype=numpy.float64)
+        self.y_array = encode_array(y_axis, dtype=numpy.float64)
+        self.data = ''
+        self.x_axis = ''
+        self.y_axis = ''
+    
+    def get_data(self):
+        """
+            Return the 2D array of intensities
+        """
+        array = decode_array(self.data_array)
+        if array is None:
+            array = parse_legacy_text(self.data)
+        return array
+    
+    def get_x_axis(self):
+        """
+            Return the array of x values
+        """
+        array = decode_array(self.x_array)
+        if array is None:
+            array = parse_legacy_text(self.x_axis)
+        return array
+    
+    def get_y_axis(self):
+        """
+            Return the array of y values
+        """
+        array = decode_array(self.y_array)
+        if array is None:
+            array = parse_legacy_text(self.y_axis)
+        return array
+    
+    def build_pyramid(self):
+        """
+            Compute and store the tile pyramid used to display the plot
+        """
+        # Compute everything before writing, so that
+        # a failure doesn't leave levels without tiles
+        levels = pyramid.build_levels(self.get_data(), self.get_x_axis(), self.get_y_axis())
+        plot_levels = []
+        tiles = []
+        for level, (data, x_axis, y_axis) in enumerate(levels):
+            plot_level = Plot2DLevel(plot=self, level=level,
+                                     n_rows=data.shape[0], n_cols=data.shape[1])
+            plot_level.set_axes(x_axis, y_axis)
+            plot_levels.append(plot_level)
+            for row, col, tile_data in pyramid.iter_tiles(data):
+                tile = Plot2DTile(plot=self, level=level, row=row, col=col)
+                tile.set_data(tile_data)
+                tiles.append(tile)
+        Plot2DTile.objects.filter(plot=self).delete()
+        Plot2DLevel.objects.filter(plot=self).delete()
+        Plot2DLevel.objects.bulk_create(plot_levels)
+        Plot2DTile.objects.bulk_create(tiles)
+        
+    def get_pyramid(self):
+        """
+            Return the levels of the tile pyramid, from the full
+            resolution to the overview. Plots stored before pyramids
+            existed and not converted with the convert_plot_data
+            command, or whose pyramid is incomplete, get theirs
+            built on first use.
+        """
+        levels = self.pyramid_levels.order_by('level')
+        if len(levels)==0 or not self.pyramid_tiles.exists():
+            try:
+                with transaction.commit_on_success():
+                    self.build_pyramid()
+            except IntegrityError:
+                # Another request built it at the same time
+                pass
+            levels = self.pyramid_levels.order_by('level')
+        return levels
+
+class Plot2DLevel(models.Model):
+    """
+        Level of the tile pyramid of a 2D plot. Level 0 is the full
+        resolution, and level n averages blocks of 2^n x 2^n cells.
+    """
+    plot = models.ForeignKey(Plot2D, related_name='pyramid_levels')
+    level = models.IntegerField()
+    n_rows = models.IntegerField()
+    n_cols = models.IntegerField()
+    # Binary representations of the axes. See plotting.arrays.
+    x_array = models.TextField()
+    y_array = models.TextField()
+    
+    class Meta:
+        unique_together = ('plot', 'level')
+    
+    def set_axes(self, x_axis, y_axis):
+        """
+            Store the axes of the level
+            @param x_axis: array of x values
+            @param y_axis: array of y values
+        """
+        self.x_array = encode_array(x_axis, dtype=numpy.float64)
+        self.y_array = encode_array(y_axis, dtype=numpy.float64)
+        
+    def get_x_axis(self):
+        return decode_array(self.x_array)
+    
+    def get_y_axis(self):
+        return decode_array(self.y_array)
+
+class Plot2DTile(models.Model):
+    """
+        Tile of a level of the pyramid of a 2D plot, covering
+        PLOT_TILE_SIZE x PLOT_TILE_SIZE cells of that level
+    """
+    plot = models.ForeignKey(Plot2D, related_name='pyramid_tiles')
+    level = models.IntegerField()
+    row = models.IntegerField()
+    col = models.IntegerField()
+    # Binary representation of the intensities. See plotting.arrays.
+    data_array = models.TextField()
+    
+    class Meta:
+        unique_together = ('plot', 'level', 'row', 'col')
+        
+    def set_data(self, data):
+        self.data_array = encode_array(data, dtype=numpy.float32)
+        
+    def get_data(self):
+        return decode_array(self.data_array)
@@ -0,0 +1,90 @@
+"""
+    Multi-resolution tile pyramid for 2D plots.
+
+    Level 0 holds the data at full resolution. Each level above it
+    averages blocks of 2 x 2 cells of the level below, up to the first
+    level that fits in a single tile. Every level is cut into square
+    tiles stored separately, so that a view only reads the tiles it
+    shows, and the first view of a plot is a single tile whatever the
+    resolution of the detector.
+
+    @author: M. Doucet, Oak Ridge National Laboratory
+    @copyright: 2014 Oak Ridge National Laboratory
+"""
+from django.conf import settings
+import numpy
+
+# Number of cells on each side of a tile
+PLOT_TILE_SIZE = getattr(settings, 'PLOT_TILE_SIZE', 64)
+
+# Maximum number of cells shown on each side of a view. The client
+# picks the finest level that shows the view within this limit.
+PLOT_VIEW_CELLS = getattr(settings, 'PLOT_VIEW_CELLS', 128)
+
+def _block_sum(values):
+    """
+        Sum blocks of 2 x 2 cells, padding odd dimensions with zeros
+        @param values: 2D array
+    """
+    n_rows, n_cols = values.shape
+    padded = numpy.zeros((n_rows + n_rows%2, n_cols + n_cols%2), dtype=values.dtype)
+    padded[:n_rows, :n_cols] = values
+    return padded.reshape(padded.shape[0]//2, 2, padded.shape[1]//2, 2).sum(axis=3).sum(axis=1)
+
+def _block_axis(axis, n_cells):
+    """
+        Return the axis of the level above: the position of the first
+        cell of each block, followed by the closing edge if the axis
+        gives bin edges rather than one value per cell.
+        @param axis: axis values
+        @param n_cells: number of cells along the axis
+    """
+    block_axis = axis[0:n_cells:2]
+    if len(axis) > n_cells:
+        block_axis = numpy.append(block_axis, axis[n_cells])
+    return block_axis
+
+def build_levels(data, x_axis, y_axis, tile_size=PLOT_TILE_SIZE):
+    """
+        Return the levels of the pyramid as a list of (data, x_axis, y_axis)
+        tuples, from the full resolution to the overview. Rows of the data
+        go along the y axis and columns along the x axis. Cells without
+        a finite value are left out of the averages.
+        @param data: 2D array of intensities
+        @param x_axis: array of x values
+        @param y_axis: array of y values
+        @param tile_size: number of cells on each side of a tile
+    """
+    data = numpy.asarray(data, dtype=numpy.float64)
+    x_axis = numpy.asarray(x_axis, dtype=numpy.float64)
+    y_axis = numpy.asarray(y_axis, dtype=numpy.float64)
+    if data.ndim != 2:
+        data = data.reshape((0, 0))
+    levels = [(data, x_axis, y_axis)]
+
+    # Carry sums and counts rather than averages so that
+    # each level is the exact average of the cells it covers
+    valid = numpy.isfinite(data)
+    sums = numpy.where(valid, data, 0.0)
+    counts = valid.astype(numpy.float64)
+    while max(sums.shape) > tile_size:
+        n_rows, n_cols = sums.shape
+        x_axis = _block_axis(x_axis, n_cols)
+        y_axis = _block_axis(y_axis, n_rows)
+        sums = _block_sum(sums)
+        counts = _block_sum(counts)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            levels.append((sums / counts, x_axis, y_axis))
+    return levels
+
+def iter_tiles(data, tile_size=PLOT_TILE_SIZE):
+    """
+        Generator yielding the (row, column, tile) tiles of a level.
+        Tiles on the last row and column may be smaller than tile_size.
+        @param data: 2D array of intensities for the level
+        @param tile_size: number of cells on each side of a tile
+    """
+    n_rows, n_cols = data.shape
+    for row in range((n_rows + tile_size - 1) // tile_size):
+        for col in range((n_cols + tile_size - 1) // tile_size):
+            yield row, col, data[row*tile_size:(row+1)*tile_size, col*tile_size:(col+1)*tile_size]
@@ -9,4 +9,8 @@ urlpatterns = patterns('',
     url(r'^adjust1d/(?P<plot_id>\d+)/update$', 'plotting.views.updated_parameters_1d', name='updated_parameters_1d'),
     url(r'^adjust2d/(?P<plot_id>\d+)/$', 'plotting.views.adjust_2d', name='plotting_adjust_2d'),
     url(r'^adjust2d/(?P<plot_id>\d+)/update$', 'plotting.views.updated_parameters_2d', name='updated_parameters_2d'),
+    url(r'^data1d/(?P<plot_id>\d+)/$', 'plotting.views.data_1d', name='plotting_data_1d'),
+    url(r'^data2d/(?P<plot_id>\d+)/$', 'plotting.views.data_2d', name='plotting_data_2d'),
+    url(r'^data2d/(?P<plot_id>\d+)/pyramid/$', 'plotting.views.pyramid_2d', name='plotting_pyramid_2d'),
+    url(r'^data2d/(?P<plot_id>\d+)/tile/$', 'plotting.views.tile_2d', name='plotting_tile_2d'),
 )
@@ -2,17 +2,28 @@ from django.shortcuts import render_to_response, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.core.urlresolvers import reverse
 from django.conf import settings
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseBadRequest
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
 import reduction_service.view_util
-from plotting.models import Plot1D, Plot2D, PlotLayout
+from plotting.models import Plot1D, Plot2D, PlotLayout, Plot2DTile
+from plotting.pyramid import PLOT_TILE_SIZE, PLOT_VIEW_CELLS
+from plotting.arrays import array_to_json
+from plotting.downsample import select_range, min_max_buckets
+import hashlib
+import numpy
+import json
 
 import logging
 logger = logging.getLogger('plotting')
 
+# Time during which browsers may reuse plot data without asking again, in seconds.
+# Plot data doesn't change once it has been stored.
+PLOT_DATA_MAX_AGE = getattr(settings, 'PLOT_DATA_MAX_AGE', 24*3600)
+
 @login_required
 def adjust_1d(request, plot_id):
     plot_1d = get_object_or_404(Plot1D, pk=plot_id, owner=request.user)
-    data_str = plot_1d.data.all()[0].dataset.data
     
     # Get layout options
     if plot_1d.layout is None:
@@ -22,8 +33,7 @@ def adjust_1d(request, plot_id):
         plot_1d.save()
     
     breadcrumbs = "<a href='%s'>home</a> &rsaquo; plotting" % reverse(settings.LANDING_VIEW)
-    template_values = {'data': data_str,
-                       'plot1d': plot_1d,
+    template_values = {'plot1d': plot_1d,
                        'breadcrumbs': breadcrumbs}
     if 'back' in request.GET:
         template_values['back_url'] = request.GET['back']
@@ -105,3 +115,137 @@ def updated_parameters_2d(request, plot_id):
         plot_2d.layout.title = request.GET['title']
     plot_2d.layout.save()
     return HttpResponse()
+
+def _binary_response(arrays):
+    """
+        Return a response holding arrays packed one after the other
+        as little-endian float32 values. The X-Array-Shapes header lists
+        the shape of each array, e.g. '128;128;127,127'.
+        @param arrays: list of numpy arrays
+    """
+    content = ''.join([numpy.asarray(a, dtype='<f4').tostring() for a in arrays])
+    response = HttpResponse(content, content_type='application/octet-stream')
+    response['X-Array-Shapes'] = ';'.join([','.join([str(n) for n in a.shape]) for a in arrays])
+    return response
+
+def _plot_data_etag(model):
+    """
+        Return an ETag function for the data of plots of the given model.
+        Plot data is never modified, so the URL and the owner identify
+        the content. No ETag is given for plots the user doesn't own,
+        so that the view answers them with a 404 rather than a 304.
+        @param model: Plot1D or Plot2D
+    """
+    def _etag(request, plot_id):
+        if not model.objects.filter(pk=plot_id, owner=request.user).exists():
+            return None
+        return hashlib.sha1("%s:%s" % (request.user.id, request.get_full_path())).hexdigest()
+    return _etag
+
+@login_required
+@cache_control(private=True, max_age=PLOT_DATA_MAX_AGE)
+@condition(etag_func=_plot_data_etag(Plot1D))
+def data_1d(request, plot_id):
+    """
+        Return the (q, I, dI) points of a 1D plot as an N x 3 array,
+        in binary form or as JSON if format=json is requested.
+        The following optional parameters reduce the data to what
+        can be displayed:
+            width: width of the plot in pixels. The data is downsampled
+                   to at most two points per pixel.
+            q_min, q_max: q range to return
+        
+        @param request: http request object
+        @param plot_id: pk of the Plot1D entry
+    """
+    plot_1d = get_object_or_404(Plot1D, pk=plot_id, owner=request.user)
+    data_layout = plot_1d.first_data_layout()
+    data = None
+    if data_layout is not None:
+        data = data_layout.dataset.get_array()
+    if data is None or data.ndim != 2:
+        data = numpy.zeros((0, 3))
+    try:
+        q_min = float(request.GET['q_min']) if 'q_min' in request.GET else None
+        q_max = float(request.GET['q_max']) if 'q_max' in request.GET else None
+        width = int(request.GET['width']) if 'width' in request.GET else None
+    except ValueError:
+        return HttpResponseBadRequest("Invalid width or q range")
+    if q_min is not None or q_max is not None:
+        data = select_range(data, q_min, q_max)
+    if width is not None:
+        data = min_max_buckets(data, width)
+    if request.GET.get('format', 'binary') == 'json':
+        return HttpResponse('{"data": %s}' % array_to_json(data),
+                            content_type='application/json')
+    return _binary_response([data])
+
+@login_required
+@cache_control(private=True, max_age=PLOT_DATA_MAX_AGE)
+@condition(etag_func=_plot_data_etag(Plot2D))
+def data_2d(request, plot_id):
+    """
+        Return the qx axis, qy axis and intensities of a 2D plot,
+        in binary form or as JSON if format=json is requested
+        
+        @param request: http request object
+        @param plot_id: pk of the Plot2D entry
+    """
+    plot_2d = get_object_or_404(Plot2D, pk=plot_id, owner=request.user)
+    qx = plot_2d.get_x_axis()
+    qy = plot_2d.get_y_axis()
+    data = plot_2d.get_data()
+    if request.GET.get('format', 'binary') == 'json':
+        content = '{"qx": %s, "qy": %s, "data": %s, "z_max": %s}' % (array_to_json(qx, number_format='%.4g'),
+                                                                    array_to_json(qy, number_format='%.4g'),
+                                                                    array_to_json(data, number_format='%.4g'),
+                                                                    plot_2d.z_max)
+        return HttpResponse(content, content_type='application/json')
+    return _binary_response([qx, qy, data])
+
+@login_required
+@cache_control(private=True, max_age=PLOT_DATA_MAX_AGE)
+@condition(etag_func=_plot_data_etag(Plot2D))
+def pyramid_2d(request, plot_id):
+    """
+        Return a JSON description of the tile pyramid of a 2D plot:
+        the shape and axes of each level, from the full resolution
+        to the overview, and the URL of its tiles
+        
+        @param request: http request object
+        @param plot_id: pk of the Plot2D entry
+    """
+    plot_2d = get_object_or_404(Plot2D, pk=plot_id, owner=request.user)
+    levels = []
+    for item in plot_2d.get_pyramid():
+        levels.append({'level': item.level,
+                       'shape': [item.n_rows, item.n_cols],
+                       'qx': numpy.nan_to_num(item.get_x_axis()).tolist(),
+                       'qy': numpy.nan_to_num(item.get_y_axis()).tolist()})
+    pyramid = {'tile_size': PLOT_TILE_SIZE,
+               'view_cells': PLOT_VIEW_CELLS,
+               'z_max': plot_2d.z_max,
+               'tile_url': reverse('plotting_tile_2d', args=[plot_2d.id]),
+               'levels': levels}
+    return HttpResponse(json.dumps(pyramid), content_type='application/json')
+
+@login_required
+@cache_control(private=True, max_age=PLOT_DATA_MAX_AGE)
+@condition(etag_func=_plot_data_etag(Plot2D))
+def tile_2d(request, plot_id):
+    """
+        Return a tile of the pyramid of a 2D plot in binary form.
+        The tile is given by the level, row and col parameters.
+        
+        @param request: http request object
+        @param plot_id: pk of the Plot2D entry
+    """
+    try:
+        level = int(request.GET['level'])
+        row = int(request.GET['row'])
+        col = int(request.GET['col'])
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest("A tile is given by its level, row and col")
+    tile = get_object_or_404(Plot2DTile, plot__id=plot_id, plot__owner=request.user,
+                             level=level, row=row, col=col)
+    return _binary_response([tile.get_data()])
@@ -0,0 +1,180 @@
+"""
+    Circuit breakers for calls to upstream services (ICAT, Fermi).
+
+    Each upstream endpoint has its own breaker, which tracks the failure
+    rate and latency of recent calls. When too many calls fail, or take
+    longer than the endpoint's latency budget, the circuit opens and calls
+    fail immediately with a CircuitOpenError. After a cool-down period a
+    single probe call is let through (half-open state); the circuit closes
+    again if it succeeds.
+
+    Breakers live in memory and are shared by all threads of a worker process.
+
+    @author: M. Doucet, Oak Ridge National Laboratory
+    @copyright: 2014 Oak Ridge National Laboratory
+"""
+from django.conf import settings
+import collections
+import threading
+import time
+import logging
+logger = logging.getLogger('reduction_service.circuit_breaker')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+# Default breaker parameters, which can be overridden with the CIRCUIT_BREAKER setting
+#   failure_rate: fraction of failed calls that opens the circuit
+#   min_calls: minimum number of calls in the window before the circuit can open
+#   window: length of the window over which calls are counted, in seconds
+#   reset_timeout: time after which an open circuit lets a probe through, in seconds
+BREAKER_PARAMETERS = {'failure_rate': 0.5,
+                      'min_calls': 5,
+                      'window': 60,
+                      'reset_timeout': 30}
+if hasattr(settings, 'CIRCUIT_BREAKER'):
+    BREAKER_PARAMETERS.update(settings.CIRCUIT_BREAKER)
+
+# Latency budget for each endpoint, in seconds. Calls taking longer
+# count as failures. Endpoints not listed only fail on errors.
+LATENCY_BUDGETS = getattr(settings, 'CIRCUIT_BREAKER_LATENCY_BUDGETS', {})
+
+class CircuitOpenError(Exception):
+    """
+        Raised when a call is refused because its circuit is open
+    """
+    pass
+
+class CircuitBreaker(object):
+    """
+        Breaker for a single upstream endpoint
+    """
+    def __init__(self, name, latency_budget=None, failure_rate=0.5,
+                 min_calls=5, window=60, reset_timeout=30):
+        self.name = name
+        self.latency_budget = latency_budget
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.opened_at = None
+        self.probe_started = None
+        self.last_failure = None
+        self._calls = collections.deque()
+        self._lock = threading.Lock()
+
+    def _prune(self, now):
+        while len(self._calls)>0 and now - self._calls[0][0] > self.window:
+            self._calls.popleft()
+
+    def allow(self):
+        """
+            Return True if a call may be made
+        """
+        with self._lock:
+            now = time.time()
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and now - self.opened_at < self.reset_timeout:
+                return False
+            # Let a single probe through. A probe that never reported
+            # back is replaced after another reset period.
+            if self.state == HALF_OPEN and now - self.probe_started < self.reset_timeout:
+                return False
+            self.state = HALF_OPEN
+            self.probe_started = now
+            return True
+
+    def record(self, success, latency):
+        """
+            Record the outcome of a call
+            @param success: True if the call succeeded
+            @param latency: duration of the call, in seconds
+        """
+        if self.latency_budget is not None and latency > self.latency_budget:
+            success = False
+        with self._lock:
+            now = time.time()
+            if not success:
+                self.last_failure = now
+            if self.state == HALF_OPEN:
+                if success:
+                    logger.info("Circuit %s closed" % self.name)
+                    self.state = CLOSED
+                    self._calls.clear()
+                else:
+                    self.state = OPEN
+                    self.opened_at = now
+                return
+            self._calls.append((now, success, latency))
+            self._prune(now)
+            n_calls = len(self._calls)
+            n_failed = len([c for c in self._calls if not c[1]])
+            if self.state == CLOSED and n_calls >= self.min_calls \
+                and float(n_failed)/n_calls >= self.failure_rate:
+                logger.error("Circuit %s opened: %d of %d calls failed" % (self.name, n_failed, n_calls))
+                self.state = OPEN
+                self.opened_at = now
+
+    def status(self):
+        """
+            Return a dictionary describing the state of the breaker
+        """
+        with self._lock:
+            self._prune(time.time())
+            n_calls = len(self._calls)
+            n_failed = len([c for c in self._calls if not c[1]])
+            latencies = [c[2] for c in self._calls]
+            return {'name': self.name,
+                    'state': self.state,
+                    'calls': n_calls,
+                    'failures': n_failed,
+                    'failure_rate': float(n_failed)/n_calls if n_calls>0 else 0.0,
+                    'mean_latency': sum(latencies)/n_calls if n_calls>0 else None,
+                    'max_latency': max(latencies) if n_calls>0 else None,
+                    'latency_budget': self.latency_budget,
+                    'opened_at': self.opened_at if self.state != CLOSED else None,
+                    'last_failure': self.last_failure}
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def get_breaker(name):
+    """
+        Return the breaker for an upstream endpoint
+        @param name: endpoint name, e.g. 'icat:run_info'
+    """
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name, latency_budget=LATENCY_BUDGETS.get(name, None),
+                                             **BREAKER_PARAMETERS)
+        return _breakers[name]
+
+def get_breakers():
+    """
+        Return the status of all known breakers
+    """
+    with _breakers_lock:
+        breakers = _breakers.values()
+    return sorted([b.status() for b in breakers], key=lambda s: s['name'])
+
+def guarded_request(name, send):
+    """
+        Make an HTTP call through the breaker of the given endpoint.
+        Server errors (status 500 and above) count as failures.
+        @param name: endpoint name
+        @param send: function making the call and returning the response
+    """
+    breaker = get_breaker(name)
+    if not breaker.allow():
+        raise CircuitOpenError("Service %s is unavailable" % name)
+    t0 = time.time()
+    try:
+        response = send()
+    except:
+        breaker.record(False, time.time()-t0)
+        raise
+    breaker.record(response.status < 500, time.time()-t0)
+    return response
@@ -0,0 +1,102 @@
+"""
+    Run independent calls to upstream services (ICAT, Fermi) concurrently
+    so that a view waits for its slowest call rather than for all of them
+    in turn.
+
+    Calls run on a thread pool shared by all requests of a worker process.
+    A call that misses its deadline is abandoned by the caller but is
+    left to finish in the background.
+
+    @author: M. Doucet, Oak Ridge National Laboratory
+    @copyright: 2014 Oak Ridge National Laboratory
+"""
+from django.conf import settings
+from django.db import close_connection
+from multiprocessing.pool import ThreadPool
+import multiprocessing
+import collections
+import threading
+import time
+import logging
+import sys
+logger = logging.getLogger('reduction_service.concurrency')
+
+# Number of threads available to run concurrent calls in each worker process
+CONCURRENT_CALL_WORKERS = getattr(settings, 'CONCURRENT_CALL_WORKERS', 16)
+
+# Default deadline for a call, in seconds
+CONCURRENT_CALL_DEADLINE = getattr(settings, 'CONCURRENT_CALL_DEADLINE', 10)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(CONCURRENT_CALL_WORKERS)
+        return _pool
+
+def _run(func, args):
+    """
+        Execute a call on a pool thread. The database connection opened
+        by the thread, if any, is closed since no request cycle will close it.
+    """
+    try:
+        return func(*args)
+    finally:
+        close_connection()
+
+def gather(calls, timeout=CONCURRENT_CALL_DEADLINE, default=None):
+    """
+        Run independent calls concurrently and return their results
+        in the order the calls were given.
+
+        @param calls: list of (function, args) or (function, args, timeout) tuples
+        @param timeout: deadline, in seconds, for calls that don't specify their own.
+                        If None, those calls are waited for until they complete.
+        @param default: result given for calls that raise or miss their deadline
+    """
+    pool = _get_pool()
+    t0 = time.time()
+    pending = []
+    for call in calls:
+        func, args = call[0], call[1]
+        call_timeout = call[2] if len(call)>2 else timeout
+        deadline = t0 + call_timeout if call_timeout is not None else None
+        pending.append((func, pool.apply_async(_run, (func, args)), deadline))
+
+    results = []
+    for func, async_result, deadline in pending:
+        try:
+            if deadline is None:
+                results.append(async_result.get())
+            else:
+                results.append(async_result.get(max(0, deadline-time.time())))
+        except multiprocessing.TimeoutError:
+            logger.error("Call to %s did not complete in time" % func.__name__)
+            results.append(default)
+        except:
+            logger.error("Call to %s failed: %s" % (func.__name__, sys.exc_value))
+            results.append(default)
+    return results
+
+def iter_bounded(func, args_list, max_pending=4):
+    """
+        Generator applying a function to each set of arguments on the shared
+        pool and yielding the results in order. At most max_pending calls
+        are in flight, so that no more than max_pending results are held
+        in memory at any time. Exceptions raised by a call are re-raised.
+
+        @param func: function to call
+        @param args_list: iterable of argument tuples
+        @param max_pending: maximum number of calls running or waiting to be consumed
+    """
+    pool = _get_pool()
+    pending = collections.deque()
+    for args in args_list:
+        pending.append(pool.apply_async(_run, (func, args)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while len(pending)>0:
+        yield pending.popleft().get()
@@ -0,0 +1,187 @@
+"""
+    Thread-safe pool of persistent HTTP(S) connections shared
+    by all requests served by a WSGI worker.
+
+    @author: M. Doucet, Oak Ridge National Laboratory
+    @copyright: 2014 Oak Ridge National Laboratory
+"""
+import httplib
+import socket
+import threading
+import Queue
+import circuit_breaker
+import logging
+logger = logging.getLogger('reduction_service.connection_pool')
+
+# Default number of idle connections kept per host
+DEFAULT_POOL_SIZE = 10
+
+# Requests that can safely be sent again when a connection drops
+_IDEMPOTENT_METHODS = ['GET', 'HEAD']
+
+class PooledResponse(object):
+    """
+        Wrapper around an httplib response that returns its
+        connection to the pool once the body has been consumed.
+    """
+    def __init__(self, pool, conn, response):
+        self._pool = pool
+        self._conn = conn
+        self._response = response
+        self.status = response.status
+        self.reason = response.reason
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def read(self, amt=None):
+        """
+            Read from the response body. The underlying connection
+            is released as soon as the body is exhausted.
+            @param amt: maximum number of bytes to read, or None to read everything
+        """
+        if self._conn is None:
+            return ''
+        try:
+            data = self._response.read(amt)
+        except:
+            self._pool.discard(self._conn)
+            self._conn = None
+            raise
+        if amt is None or len(data) == 0 or self._response.isclosed():
+            self.release()
+        return data
+
+    def release(self):
+        """
+            Give the connection back to the pool. If the body was not
+            fully read, the connection cannot be reused and is closed.
+        """
+        if self._conn is None:
+            return
+        if self._response.isclosed() and not self._response.will_close:
+            self._pool.put(self._conn)
+        else:
+            self._pool.discard(self._conn)
+        self._conn = None
+
+    close = release
+
+class ConnectionPool(object):
+    """
+        Pool of keep-alive connections to a single host
+    """
+    def __init__(self, host, port=None, secure=False, max_size=DEFAULT_POOL_SIZE):
+        """
+            @param host: server host name
+            @param port: server port, or None for the protocol default
+            @param secure: if True, HTTPS connections will be used
+            @param max_size: maximum number of idle connections to keep
+        """
+        self.host = host
+        self.port = port
+        self.secure = secure
+        self.max_size = max_size
+        self._idle = Queue.LifoQueue(maxsize=max_size)
+
+    def _new_connection(self, timeout):
+        if self.secure:
+            return httplib.HTTPSConnection(self.host, self.port, timeout=timeout)
+        return httplib.HTTPConnection(self.host, self.port, timeout=timeout)
+
+    def get(self, timeout):
+        """
+            Return an idle connection, or a new one if none is available
+            @param timeout: socket timeout for this call, in seconds
+        """
+        try:
+            conn = self._idle.get_nowait()
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            return conn, True
+        except Queue.Empty:
+            return self._new_connection(timeout), False
+
+    def put(self, conn):
+        """
+            Return a connection to the pool
+            @param conn: connection object
+        """
+        try:
+            self._idle.put_nowait(conn)
+        except Queue.Full:
+            conn.close()
+
+    def discard(self, conn):
+        """
+            Close a connection that should not be reused
+            @param conn: connection object
+        """
+        try:
+            conn.close()
+        except:
+            pass
+
+    def request(self, method, url, body=None, headers=None, timeout=None, endpoint=None):
+        """
+            Send a request and return a PooledResponse.
+            The response body must be read (or the response released)
+            before the connection can be reused.
+
+            A request sent over a reused connection that the server
+            has since closed is retried on a fresh connection. Requests
+            that aren't idempotent, such as a job submission, are only
+            retried if nothing was sent, since the server may otherwise
+            have acted on them before dropping the connection.
+
+            @param method: HTTP method
+            @param url: path of the resource
+            @param body: request body
+            @param headers: dictionary of request headers
+            @param timeout: socket timeout, in seconds
+            @param endpoint: if given, the call goes through the circuit breaker of that name
+        """
+        if headers is None:
+            headers = {}
+        idempotent = method.upper() in _IDEMPOTENT_METHODS
+        def _send():
+            while True:
+                conn, reused = self.get(timeout)
+                try:
+                    conn.request(method, url, body=body, headers=headers)
+                    response = conn.getresponse()
+                    return PooledResponse(self, conn, response)
+                except socket.timeout:
+                    self.discard(conn)
+                    raise
+                except (httplib.BadStatusLine, httplib.CannotSendRequest, socket.error) as error:
+                    self.discard(conn)
+                    # CannotSendRequest is raised before anything is written
+                    not_sent = isinstance(error, httplib.CannotSendRequest)
+                    if not reused or not (idempotent or not_sent):
+                        raise
+                    logger.debug("Stale connection to %s, reconnecting" % self.host)
+                except:
+                    self.discard(conn)
+                    raise
+        if endpoint is None:
+            return _send()
+        return circuit_breaker.guarded_request(endpoint, _send)
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(host, port=None, secure=False, max_size=DEFAULT_POOL_SIZE):
+    """
+        Return the shared connection pool for a given host
+        @param host: server host name
+        @param port: server port
+        @param secure: if True, use HTTPS
+        @param max_size: maximum number of idle connections
+    """
+    key = (host, port, secure)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(host, port, secure=secure, max_size=max_size)
+        return _pools[key]
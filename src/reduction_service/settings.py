@@ -167,6 +167,40 @@ ALTERNATE_LANDING_VIEW = 'eqsans.views.reduction_home'
 # Fermi information
 FERMI_HOST = 'fermi.ornl.gov'
 FERMI_BASE_URL = '/MantidRemote/'
+# Per-operation Fermi timeouts, in seconds. Overrides the defaults in remote.view_util.
+#FERMI_TIMEOUTS = {'query_all': 30, 'download': 60}
+# Maximum number of idle keep-alive connections to Fermi per worker process
+#FERMI_POOL_SIZE = 10
+# Retry policy of the job submission outbox. See remote.outbox.
+#OUTBOX_MAX_ATTEMPTS = 8
+#OUTBOX_RETRY_DELAY = 10
+# Local cache of files downloaded from Fermi. See remote.file_cache.
+#DOWNLOAD_CACHE_DIR = '/var/cache/reduction_service/files'
+#DOWNLOAD_CACHE_SIZE = 2*1024*1024*1024
+# Fermi job status polling, in seconds. See the poll_jobs command.
+#JOB_POLL_INTERVALS = {'RUNNING': 15, 'QUEUED': 60}
+#JOB_STATUS_MAX_AGE = 300
+# Time after which a stored Fermi session is no longer used in the background, in seconds. See remote.models.
+#FERMI_SESSION_LIFETIME = 24*3600
+# Sizing of EQSANS reduction jobs from the number of events. See eqsans.view_util.
+#EQSANS_JOB_SHAPE = {'counts_per_core': 2e7, 'max_cores_per_node': 16}
+# Set to False to store plot arrays uncompressed. See plotting.arrays.
+#PLOT_ARRAY_COMPRESSION = True
+# Time during which browsers may reuse plot data, in seconds. See plotting.views.
+#PLOT_DATA_MAX_AGE = 24*3600
+# Tile pyramids of 2D plots: cells per tile side, and maximum cells per view side. See plotting.pyramid.
+#PLOT_TILE_SIZE = 64
+#PLOT_VIEW_CELLS = 128
+
+# Per-call ICAT timeouts, in seconds. Overrides the defaults
+# in catalog.icat_server_communication.
+#ICAT_TIMEOUTS = {'experiments': 20, 'ipts_runs': 10}
+# Time, in seconds, before cached ICAT lists are refreshed
+#ICAT_CACHE_TTL = {'instruments': 3600, 'experiments': 300}
+
+# Circuit breakers for ICAT and Fermi calls. See reduction_service.circuit_breaker.
+#CIRCUIT_BREAKER = {'failure_rate': 0.5, 'min_calls': 5, 'window': 60, 'reset_timeout': 30}
+#CIRCUIT_BREAKER_LATENCY_BUDGETS = {'icat:experiments': 10, 'fermi:query': 1.0}
 
 LOGGING = {
    'version': 1,
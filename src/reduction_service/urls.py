@@ -11,6 +11,7 @@ urlpatterns = patterns('',
     url(r'^plotting/', include('plotting.urls')),
     url(r'^users/', include('users.urls')),
     url(r'^database/doc/', include('django.contrib.admindocs.urls')),
+    url(r'^database/status/$', 'reduction_service.views.upstream_status', name='upstream_status'),
     url(r'^database/', include(admin.site.urls)),
 )
 
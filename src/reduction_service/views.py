@@ -1,6 +1,27 @@
 from django.http import HttpResponseRedirect
 from django.core.urlresolvers import reverse
+from django.shortcuts import render_to_response
+from django.template import RequestContext
+from django.contrib.admin.views.decorators import staff_member_required
+from reduction_service.circuit_breaker import get_breakers
+import datetime
 
 def home(request):
     return HttpResponseRedirect(reverse('catalog.views.instrument_list'))
 
+@staff_member_required
+def upstream_status(request):
+    """
+        Admin page showing the circuit breaker state of each
+        upstream service endpoint, as seen by this worker process.
+        @param request: request object
+    """
+    breakers = get_breakers()
+    for item in breakers:
+        for key in ['opened_at', 'last_failure']:
+            if item[key] is not None:
+                item[key] = datetime.datetime.fromtimestamp(item[key])
+    template_values = {'breakers': breakers,
+                       'title': 'Upstream services'}
+    return render_to_response('admin/upstream_status.html', template_values,
+                              context_instance=RequestContext(request))
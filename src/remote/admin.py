@@ -1,7 +1,17 @@
-from models import Transaction
+from models import Transaction, ReductionJob, Submission
 from django.contrib import admin
 
 class TransactionAdmin(admin.ModelAdmin):
     list_display = ('id', 'trans_id', 'directory', 'owner', 'start_time')
     
+class ReductionJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'job_id', 'status', 'owner', 'trans_id', 'submit_time', 'end_time', 'next_poll')
+    list_filter = ('status',)
+    
+class SubmissionAdmin(admin.ModelAdmin):
+    list_display = ('id', 'title', 'owner', 'status', 'attempts', 'job_id', 'created', 'next_attempt')
+    list_filter = ('status',)
+    
 admin.site.register(Transaction, TransactionAdmin)
+admin.site.register(ReductionJob, ReductionJobAdmin)
+admin.site.register(Submission, SubmissionAdmin)
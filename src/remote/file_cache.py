@@ -0,0 +1,274 @@
+"""
+    On-disk cache of files downloaded from Fermi transactions.
+
+    Files are stored once per content hash under objects/, and each
+    (transaction, file name) pair has a reference under refs/ holding
+    the hash of its content. All writes go to a temporary file that is
+    renamed into place, so that worker processes sharing the cache
+    never see partial files.
+
+    The least recently used objects are removed when the total size
+    of the cache exceeds DOWNLOAD_CACHE_SIZE. Each process keeps a
+    running estimate of that size and only scans the cache when the
+    estimate is over budget, or every _SCAN_INTERVAL seconds to account
+    for the files written by other processes.
+
+    @author: M. Doucet, Oak Ridge National Laboratory
+    @copyright: 2014 Oak Ridge National Laboratory
+"""
+from django.conf import settings
+import hashlib
+import tempfile
+import os
+import time
+import threading
+import logging
+import sys
+logger = logging.getLogger('remote.file_cache')
+
+# Location of the cache. Set DOWNLOAD_CACHE_DIR to None to disable the cache.
+DOWNLOAD_CACHE_DIR = getattr(settings, 'DOWNLOAD_CACHE_DIR',
+                             os.path.join(tempfile.gettempdir(), 'reduction_service_files'))
+
+# Maximum total size of the cached files, in bytes
+DOWNLOAD_CACHE_SIZE = getattr(settings, 'DOWNLOAD_CACHE_SIZE', 2*1024*1024*1024)
+
+# Only files with these extensions are cached. Log files such as
+# the job's standard output change while the job runs.
+DOWNLOAD_CACHE_EXTENSIONS = getattr(settings, 'DOWNLOAD_CACHE_EXTENSIONS',
+                                    ['.txt', '.nxs', '.zip'])
+
+# Age, in seconds, after which an uncommitted temporary file is removed
+_TMP_MAX_AGE = 24*3600
+
+# Maximum time between two scans of the cache, in seconds
+_SCAN_INTERVAL = 600
+
+# Fraction of the size budget left used after trimming the cache,
+# so that a full cache isn't scanned again on the next write
+_TRIM_TARGET = 0.9
+
+# Size of the cache found by the last scan, plus the size of the objects
+# added by this process since then, and time of the last scan
+_size_lock = threading.Lock()
+_estimated_size = None
+_last_scan = 0
+
+def is_enabled(filename):
+    """
+        Return True if a file should go through the cache
+        @param filename: name of the file
+    """
+    if DOWNLOAD_CACHE_DIR is None:
+        return False
+    return os.path.splitext(filename)[1].lower() in DOWNLOAD_CACHE_EXTENSIONS
+
+def _ref_path(trans_id, filename):
+    key = hashlib.sha1("%s/%s" % (trans_id, filename)).hexdigest()
+    return os.path.join(DOWNLOAD_CACHE_DIR, 'refs', key[:2], key)
+
+def _object_path(digest):
+    return os.path.join(DOWNLOAD_CACHE_DIR, 'objects', digest[:2], digest)
+
+def _atomic_write(path, data):
+    """
+        Write a small file so that readers see either nothing or all of it
+        @param path: destination path
+        @param data: file content
+    """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Another process may have created it
+            if not os.path.isdir(directory):
+                raise
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp')
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+    os.rename(tmp_path, path)
+
+def get_path(trans_id, filename):
+    """
+        Return the path of the cached content of a file, or None if it
+        is not in the cache. The entry is marked as recently used.
+        @param trans_id: remote name of the transaction
+        @param filename: name of the file
+    """
+    try:
+        with open(_ref_path(trans_id, filename), 'r') as fd:
+            digest = fd.read().strip()
+        path = _object_path(digest)
+        os.utime(path, None)
+        return path
+    except (IOError, OSError):
+        return None
+
+def read(trans_id, filename):
+    """
+        Return the cached content of a file, or None
+        @param trans_id: remote name of the transaction
+        @param filename: name of the file
+    """
+    path = get_path(trans_id, filename)
+    if path is None:
+        return None
+    try:
+        with open(path, 'rb') as fd:
+            return fd.read()
+    except (IOError, OSError):
+        # The object was evicted after we found it
+        return None
+
+class CacheWriter(object):
+    """
+        Incrementally write a file to the cache, e.g. while it is
+        being relayed to a client. Nothing is visible to other
+        readers until commit() is called.
+    """
+    def __init__(self, trans_id, filename):
+        self.trans_id = trans_id
+        self.filename = filename
+        self._hash = hashlib.sha256()
+        self._size = 0
+        tmp_dir = os.path.join(DOWNLOAD_CACHE_DIR, 'tmp')
+        if not os.path.isdir(tmp_dir):
+            try:
+                os.makedirs(tmp_dir)
+            except OSError:
+                if not os.path.isdir(tmp_dir):
+                    raise
+        fd, self._tmp_path = tempfile.mkstemp(dir=tmp_dir)
+        self._file = os.fdopen(fd, 'wb')
+
+    def write(self, data):
+        self._file.write(data)
+        self._hash.update(data)
+        self._size += len(data)
+
+    def commit(self):
+        """
+            Move the file into the cache and point its reference to it
+        """
+        self._file.close()
+        digest = self._hash.hexdigest()
+        path = _object_path(digest)
+        added_size = 0
+        try:
+            if os.path.isfile(path):
+                # Same content already stored
+                os.remove(self._tmp_path)
+                os.utime(path, None)
+            else:
+                added_size = self._size
+                if not os.path.isdir(os.path.dirname(path)):
+                    try:
+                        os.makedirs(os.path.dirname(path))
+                    except OSError:
+                        if not os.path.isdir(os.path.dirname(path)):
+                            raise
+                os.rename(self._tmp_path, path)
+            _atomic_write(_ref_path(self.trans_id, self.filename), digest)
+        except:
+            logger.error("Could not cache %s: %s" % (self.filename, sys.exc_value))
+            self.abort()
+            return
+        _add_to_size(added_size)
+
+    def abort(self):
+        """
+            Discard the partially written file
+        """
+        try:
+            self._file.close()
+            os.remove(self._tmp_path)
+        except (IOError, OSError):
+            pass
+
+def store(trans_id, filename, content):
+    """
+        Store the content of a file in the cache
+        @param trans_id: remote name of the transaction
+        @param filename: name of the file
+        @param content: file content
+    """
+    try:
+        writer = CacheWriter(trans_id, filename)
+    except:
+        logger.error("Could not cache %s: %s" % (filename, sys.exc_value))
+        return
+    writer.write(content)
+    writer.commit()
+
+def _add_to_size(n_bytes):
+    """
+        Account for an object added to the cache, and trim
+        the cache if it may have grown over its budget
+        @param n_bytes: size of the object
+    """
+    global _estimated_size, _last_scan
+    with _size_lock:
+        if _estimated_size is not None:
+            _estimated_size += n_bytes
+        if _estimated_size is not None and _estimated_size <= DOWNLOAD_CACHE_SIZE \
+            and time.time() - _last_scan < _SCAN_INTERVAL:
+            return
+        # Keep other threads from starting the same scan
+        _last_scan = time.time()
+    evict()
+
+def evict(max_size=None):
+    """
+        Remove the least recently used objects when the cache exceeds its
+        size budget, until it fits within _TRIM_TARGET of that budget.
+        References to removed objects are left behind and are treated as misses.
+        @param max_size: size budget in bytes, or None for DOWNLOAD_CACHE_SIZE
+    """
+    if max_size is None:
+        max_size = DOWNLOAD_CACHE_SIZE
+    objects = []
+    total_size = 0
+    for dir_path, _, file_names in os.walk(os.path.join(DOWNLOAD_CACHE_DIR, 'objects')):
+        for name in file_names:
+            path = os.path.join(dir_path, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            objects.append((stat.st_mtime, stat.st_size, path))
+            total_size += stat.st_size
+    # Remove temporary files left behind by interrupted downloads
+    for dir_path, _, file_names in os.walk(os.path.join(DOWNLOAD_CACHE_DIR, 'tmp')):
+        for name in file_names:
+            path = os.path.join(dir_path, name)
+            try:
+                if time.time() - os.stat(path).st_mtime > _TMP_MAX_AGE:
+                    os.remove(path)
+            except OSError:
+                pass
+    if total_size > max_size:
+        objects.sort()
+        for _, size, path in objects:
+            try:
+                os.remove(path)
+            except OSError:
+                # Already removed by another process
+                pass
+            total_size -= size
+            if total_size <= _TRIM_TARGET*max_size:
+                break
+        logger.info("Download cache trimmed to %d bytes" % total_size)
+    _set_size(total_size)
+
+def _set_size(total_size):
+    """
+        Record the size of the cache found by a scan
+        @param total_size: size of the cached objects, in bytes
+    """
+    global _estimated_size, _last_scan
+    with _size_lock:
+        _estimated_size = total_size
+        _last_scan = time.time()
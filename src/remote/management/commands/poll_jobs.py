@@ -0,0 +1,51 @@
+"""
+    Update the local status table of Fermi jobs.
+
+    Each user with unfinished jobs due for a poll is queried with a
+    single call to Fermi. Poll intervals depend on the job status,
+    and jobs in a terminal state are not polled again.
+
+    @author: M. Doucet, Oak Ridge National Laboratory
+    @copyright: 2014 Oak Ridge National Laboratory
+"""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from optparse import make_option
+import logging
+import time
+import sys
+
+from remote.models import ReductionJob, FermiSession
+from remote.view_util import poll_user_jobs
+
+class Command(BaseCommand):
+    help = 'Poll Fermi for the status of unfinished jobs'
+    option_list = BaseCommand.option_list + (
+        make_option('--loop', action='store_true', dest='loop', default=False,
+                    help='Keep polling instead of exiting after one pass'),
+        make_option('--sleep', type='int', dest='sleep', default=5,
+                    help='Time between passes when looping, in seconds'),
+    )
+
+    def handle(self, *args, **options):
+        while True:
+            self.poll()
+            if not options['loop']:
+                break
+            time.sleep(options['sleep'])
+
+    def poll(self):
+        """
+            Update the jobs of every user with jobs due for a poll
+        """
+        FermiSession.objects.delete_expired()
+        owners = ReductionJob.objects.filter(next_poll__lte=timezone.now()) \
+            .values_list('owner', flat=True).distinct()
+        for fermi_session in FermiSession.objects.active().filter(owner__in=list(owners)).select_related('owner'):
+            try:
+                with transaction.commit_on_success():
+                    n_jobs = poll_user_jobs(fermi_session)
+                logging.debug("Updated %d jobs for %s" % (n_jobs, fermi_session.owner))
+            except:
+                logging.error("Could not poll jobs for %s: %s" % (fermi_session.owner, sys.exc_value))
@@ -0,0 +1,48 @@
+"""
+    Send pending job submissions to Fermi.
+
+    @author: M. Doucet, Oak Ridge National Laboratory
+    @copyright: 2014 Oak Ridge National Laboratory
+"""
+from django.core.management.base import BaseCommand
+from optparse import make_option
+import logging
+import time
+import sys
+
+from remote import outbox
+from reduction_service.concurrency import iter_bounded
+
+class Command(BaseCommand):
+    help = 'Send the pending job submissions of the outbox to Fermi'
+    option_list = BaseCommand.option_list + (
+        make_option('--loop', action='store_true', dest='loop', default=False,
+                    help='Keep processing instead of exiting after one pass'),
+        make_option('--sleep', type='int', dest='sleep', default=2,
+                    help='Time between passes when looping, in seconds'),
+        make_option('--threads', type='int', dest='threads', default=4,
+                    help='Maximum number of submissions sent at once'),
+    )
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                n_processed = self.process(options['threads'])
+            except:
+                logging.error("Could not process outbox: %s" % sys.exc_value)
+                n_processed = 0
+            if not options['loop']:
+                break
+            # Go straight to the next batch if this one was full
+            if n_processed < options['threads']:
+                time.sleep(options['sleep'])
+
+    def process(self, threads):
+        """
+            Claim a batch of due submissions and send them concurrently
+            @param threads: maximum number of submissions sent at once
+        """
+        submissions = outbox.claim_pending(limit=threads)
+        for _ in iter_bounded(outbox.process, [(s,) for s in submissions], threads):
+            pass
+        return len(submissions)
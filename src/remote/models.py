@@ -1,26 +1,113 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.contrib.auth.signals import user_logged_out
+from django.dispatch import receiver
+from django.utils import timezone
+from django.conf import settings
+import datetime
+
+# Fermi job states for which no further change is expected
+TERMINAL_STATES = ['COMPLETED', 'REMOVED']
+
+# Time after which a stored Fermi session cookie is no longer used, in seconds
+FERMI_SESSION_LIFETIME = getattr(settings, 'FERMI_SESSION_LIFETIME', 24*3600)
+
+class JobStatusManager(models.Manager):
+    
+    def get_status(self, status):
+        """
+            Return the JobStatus entry for a status string, creating it if needed
+            @param status: status string reported by Fermi
+        """
+        status_obj, _ = self.get_or_create(status=status.upper()[:24])
+        return status_obj
 
 class JobStatus(models.Model):
     """
         Table of job status codes
     """ 
     status = models.CharField(max_length=24)
+    objects = JobStatusManager()
     
     def __str__(self):
         return self.status
 
+    def is_terminal(self):
+        return self.status in TERMINAL_STATES
+
 class ReductionJob(models.Model):
     """
-        Table of Fermi jobs
+        Table of Fermi jobs, kept up to date by the poll_jobs command
     """
     job_id = models.IntegerField(unique=True)
     status = models.ForeignKey(JobStatus)
     title = models.CharField(max_length=128)
     owner = models.ForeignKey(User)
-    start_time = models.DateTimeField()
-    end_time = models.DateTimeField()
+    trans_id = models.IntegerField(null=True, blank=True)
+    script_name = models.CharField(max_length=128, blank=True)
+    submit_time = models.DateTimeField(null=True, blank=True)
+    start_time = models.DateTimeField(null=True, blank=True)
+    end_time = models.DateTimeField(null=True, blank=True)
+    # Time of the last status update from Fermi, and of the next scheduled poll
+    last_update = models.DateTimeField(null=True, blank=True)
+    next_poll = models.DateTimeField(null=True, blank=True, db_index=True)
+    
+    def __str__(self):
+        return str(self.job_id)
     
+    def as_dict(self):
+        """
+            Return the job information in the format returned by
+            remote.view_util.query_job
+        """
+        return {'ID': str(self.job_id),
+                'JobName': self.title,
+                'ScriptName': self.script_name,
+                'JobStatus': self.status.status,
+                'TransID': self.trans_id,
+                'SubmitDate': self.submit_time,
+                'StartDate': self.start_time,
+                'CompletionDate': self.end_time}
+
+class FermiSessionManager(models.Manager):
+
+    def active(self):
+        """
+            Return the sessions stored less than FERMI_SESSION_LIFETIME ago
+        """
+        oldest = timezone.now() - datetime.timedelta(seconds=FERMI_SESSION_LIFETIME)
+        return self.filter(updated__gte=oldest)
+
+    def delete_expired(self):
+        """
+            Delete the sessions stored more than FERMI_SESSION_LIFETIME ago
+        """
+        oldest = timezone.now() - datetime.timedelta(seconds=FERMI_SESSION_LIFETIME)
+        self.filter(updated__lt=oldest).delete()
+
+class FermiSession(models.Model):
+    """
+        Latest Fermi session cookie of a user, used by the poll_jobs
+        and process_outbox commands to call Fermi on their behalf.
+        
+        A cookie is only kept while it may still be valid: the entry is
+        deleted when the user logs out or Fermi rejects the cookie, and
+        is ignored, then deleted, FERMI_SESSION_LIFETIME seconds after
+        the cookie was stored.
+    """
+    owner = models.ForeignKey(User, unique=True)
+    cookie = models.TextField()
+    updated = models.DateTimeField(auto_now=True)
+    objects = FermiSessionManager()
+
+@receiver(user_logged_out)
+def _delete_fermi_session(sender, request, user, **kwargs):
+    """
+        Forget the Fermi session of a user logging out
+    """
+    if user is not None:
+        FermiSession.objects.filter(owner=user).delete()
+
 class Transaction(models.Model):
     trans_id = models.IntegerField(unique=True)   
     owner = models.ForeignKey(User)
@@ -29,4 +116,39 @@ class Transaction(models.Model):
     start_time = models.DateTimeField(auto_now = False, auto_now_add = True)
 
     def __str__(self):
-        return str(self.trans_id)
\ No newline at end of file
+        return str(self.trans_id)
+
+
+class Submission(models.Model):
+    """
+        Job submission waiting to be sent to Fermi by the process_outbox command.
+        The handler is the dotted path of a function building and submitting
+        the job script, see remote.outbox.
+    """
+    PENDING = 'pending'
+    SUBMITTING = 'submitting'
+    SUBMITTED = 'submitted'
+    FAILED = 'failed'
+
+    owner = models.ForeignKey(User)
+    idempotency_key = models.CharField(max_length=64, db_index=True)
+    handler = models.CharField(max_length=128)
+    title = models.CharField(max_length=128)
+    payload = models.TextField(blank=True)
+    status = models.CharField(max_length=16, default=PENDING, db_index=True)
+    attempts = models.IntegerField(default=0)
+    next_attempt = models.DateTimeField(null=True, blank=True, db_index=True)
+    last_error = models.TextField(blank=True)
+    # True if a previous attempt may have reached Fermi
+    uncertain = models.BooleanField(default=False)
+    trans_id = models.IntegerField(null=True, blank=True)
+    job_id = models.CharField(max_length=30, blank=True)
+    result_url = models.CharField(max_length=256, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return "%s [%s]" % (self.title, self.status)
+
+    def is_done(self):
+        return self.status in [self.SUBMITTED, self.FAILED]
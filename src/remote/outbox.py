@@ -0,0 +1,201 @@
+"""
+    Outbox of job submissions to Fermi.
+
+    Views add a Submission entry and return immediately. The
+    process_outbox command sends the pending submissions, retrying
+    failed attempts with exponential backoff.
+
+    Each submission names a handler, the dotted path of a function
+    called as handler(submission, transaction, submit). The handler
+    builds the job script, calls submit(code, num_nodes, cores_per_node)
+    to send it, creates any local entries it needs and returns the
+    remote job ID, or None.
+
+    Submissions are protected against duplicates twice: a request
+    repeated with the same idempotency key returns the existing entry,
+    and a retry after an attempt that may have reached Fermi first looks
+    for a job already running the submission's script.
+
+    @author: M. Doucet, Oak Ridge National Laboratory
+    @copyright: 2014 Oak Ridge National Laboratory
+"""
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.importlib import import_module
+import datetime
+import hashlib
+import json
+import logging
+import sys
+
+from models import Submission, FermiSession, Transaction
+import view_util
+logger = logging.getLogger('remote.outbox')
+
+# Number of attempts after which a submission is marked as failed
+OUTBOX_MAX_ATTEMPTS = getattr(settings, 'OUTBOX_MAX_ATTEMPTS', 8)
+
+# Delay before the first retry, in seconds. It doubles with each attempt.
+OUTBOX_RETRY_DELAY = getattr(settings, 'OUTBOX_RETRY_DELAY', 10)
+OUTBOX_MAX_RETRY_DELAY = getattr(settings, 'OUTBOX_MAX_RETRY_DELAY', 600)
+
+# Time after which a submission claimed by a worker that died is retried, in seconds
+_STALE_CLAIM = 600
+
+# Time during which a repeated request without explicit key is ignored, in seconds
+_DUPLICATE_WINDOW = 60
+
+def enqueue(request, handler, title, payload, key=None):
+    """
+        Add a submission to the outbox and return the Submission object.
+        If a submission with the same key is already pending, or was submitted
+        very recently, that submission is returned instead of a new one.
+        @param request: request object
+        @param handler: dotted path of the handler function
+        @param title: description shown to the user
+        @param payload: JSON-serializable parameters for the handler
+        @param key: idempotency key sent by the client, if any
+    """
+    # The worker acts on behalf of the user with their Fermi session
+    view_util.save_fermi_session(request)
+
+    payload = json.dumps(payload, sort_keys=True)
+    query = Q(status__in=[Submission.PENDING, Submission.SUBMITTING])
+    if key is None:
+        key = hashlib.sha1("%s:%s:%s" % (request.user.id, handler, payload)).hexdigest()
+        window_start = timezone.now() - datetime.timedelta(seconds=_DUPLICATE_WINDOW)
+        query = query | Q(status=Submission.SUBMITTED, updated__gte=window_start)
+    else:
+        key = key[:64]
+        query = query | Q(status=Submission.SUBMITTED)
+    existing = Submission.objects.filter(owner=request.user, idempotency_key=key).filter(query)
+    if len(existing)>0:
+        return existing[0]
+
+    submission = Submission(owner=request.user, idempotency_key=key,
+                            handler=handler, title=title[:128], payload=payload,
+                            next_attempt=timezone.now())
+    submission.save()
+    return submission
+
+def _get_handler(path):
+    module_name, function_name = path.rsplit('.', 1)
+    return getattr(import_module(module_name), function_name)
+
+def _find_submitted_job(request, transaction, script_name):
+    """
+        Return the ID of a job of the transaction running the given
+        script, if a previous attempt got through to Fermi
+    """
+    for job_info in view_util.get_remote_jobs(request):
+        if str(job_info.get('TransID', '')) == str(transaction.trans_id) \
+            and job_info.get('ScriptName', '') == script_name:
+            return job_info['ID']
+    return None
+
+def _retry(submission, error):
+    """
+        Schedule another attempt, or give up after OUTBOX_MAX_ATTEMPTS
+        @param submission: Submission object
+        @param error: description of the failure
+    """
+    submission.attempts += 1
+    submission.last_error = error
+    if submission.attempts >= OUTBOX_MAX_ATTEMPTS:
+        logger.error("Giving up on submission %s: %s" % (submission.id, error))
+        submission.status = Submission.FAILED
+        submission.next_attempt = None
+    else:
+        delay = min(OUTBOX_RETRY_DELAY * 2**(submission.attempts-1), OUTBOX_MAX_RETRY_DELAY)
+        submission.status = Submission.PENDING
+        submission.next_attempt = timezone.now() + datetime.timedelta(seconds=delay)
+    submission.save()
+
+def claim_pending(limit=None):
+    """
+        Mark pending submissions that are due as being processed and return
+        them. Each submission is only claimed by one worker.
+        @param limit: maximum number of submissions to claim
+    """
+    now = timezone.now()
+    # Submissions left behind by a worker that stopped are retried
+    Submission.objects.filter(status=Submission.SUBMITTING,
+                              updated__lt=now-datetime.timedelta(seconds=_STALE_CLAIM)) \
+        .update(status=Submission.PENDING, uncertain=True, updated=now)
+
+    due = Submission.objects.filter(status=Submission.PENDING, next_attempt__lte=now).order_by('next_attempt')
+    if limit is not None:
+        due = due[:limit]
+    claimed = []
+    for submission_id in list(due.values_list('id', flat=True)):
+        n = Submission.objects.filter(id=submission_id, status=Submission.PENDING) \
+            .update(status=Submission.SUBMITTING, updated=now)
+        if n == 1:
+            claimed.append(Submission.objects.select_related('owner').get(id=submission_id))
+    return claimed
+
+def process(submission):
+    """
+        Send a claimed submission to Fermi
+        @param submission: Submission object
+    """
+    # Any error up to the handler call puts the submission back in
+    # the queue, rather than leaving it claimed until _STALE_CLAIM
+    try:
+        fermi_sessions = FermiSession.objects.active().filter(owner=submission.owner)
+        if len(fermi_sessions)==0:
+            _retry(submission, "No Fermi session for %s" % submission.owner)
+            return
+        request = view_util.BackgroundRequest(submission.owner, fermi_sessions[0].cookie)
+
+        # Reuse the transaction of a previous attempt
+        transaction = None
+        if submission.trans_id is not None:
+            transactions = Transaction.objects.filter(trans_id=submission.trans_id)
+            if len(transactions)>0:
+                transaction = transactions[0]
+        if transaction is None:
+            transaction = view_util.transaction(request, start=True)
+            if transaction is None:
+                _retry(submission, "Could not start a Fermi transaction")
+                return
+            submission.trans_id = transaction.trans_id
+            submission.save()
+
+        script_name = 'job_%s.py' % submission.id
+        def _submit(code, num_nodes=1, cores_per_node=None):
+            if submission.uncertain:
+                job_id = _find_submitted_job(request, transaction, script_name)
+                if job_id is not None:
+                    logger.info("Submission %s was already received as job %s" % (submission.id, job_id))
+                    return job_id
+            # From here on, we can't be sure whether Fermi got the job
+            submission.uncertain = True
+            submission.save()
+            return view_util.submit_job(request, transaction, code, script_name=script_name,
+                                        num_nodes=num_nodes, cores_per_node=cores_per_node)
+
+        handler = _get_handler(submission.handler)
+        job_id = handler(submission, transaction, _submit)
+    except:
+        logger.error("Submission %s failed: %s" % (submission.id, sys.exc_value))
+        _retry(submission, str(sys.exc_value))
+        return
+    if job_id is None:
+        _retry(submission, "Fermi did not accept the job")
+        return
+    submission.job_id = str(job_id)
+    submission.status = Submission.SUBMITTED
+    submission.next_attempt = None
+    submission.save()
+
+def get_user_submissions(user):
+    """
+        Return the submissions of a user that are waiting,
+        or that failed within the last week
+        @param user: User object
+    """
+    week_ago = timezone.now() - datetime.timedelta(days=7)
+    return Submission.objects.filter(owner=user).exclude(status=Submission.SUBMITTED) \
+        .exclude(status=Submission.FAILED, updated__lt=week_ago).order_by('-created')
@@ -9,4 +9,5 @@ urlpatterns = patterns('',
     url(r'^download/(?P<trans_id>\d+)/(?P<filename>[\w\-\.]+)$', 'remote.views.download_file', name='remote_download'),
     url(r'^download/(?P<trans_id>\d+)/(?P<filename>[\w\-\.]+)/delete$', 'remote.views.download_file_and_delete', name='remote_download_and_delete'),
     url(r'^transaction/(?P<trans_id>\d+)/stop/$', 'remote.views.stop_transaction', name='remote_stop_transaction'),
+    url(r'^submission/(?P<submission_id>\d+)/$', 'remote.views.submission_status', name='remote_submission_status'),
 )
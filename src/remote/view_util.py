@@ -7,13 +7,51 @@
 """
 from django import forms
 from django.utils.dateparse import parse_datetime
-import httplib, urllib
+from django.utils import timezone
+import datetime
+import mimetypes
+import urllib
+import os
 from base64 import b64encode
 import json
 import logging
 import sys
-from models import Transaction
+from models import Transaction, JobStatus, ReductionJob, FermiSession
 from django.conf import settings
+from reduction_service.connection_pool import get_pool
+from reduction_service.concurrency import gather
+import file_cache
+
+# Socket timeout for each Fermi operation, in seconds
+FERMI_TIMEOUTS = {'info': 0.5,
+                  'authenticate': 0.5,
+                  'transaction': 0.5,
+                  'submit': 5,
+                  'query': 1.5,
+                  'query_all': 30,
+                  'files': 1.5,
+                  'download': 60}
+if hasattr(settings, 'FERMI_TIMEOUTS'):
+    FERMI_TIMEOUTS.update(settings.FERMI_TIMEOUTS)
+
+# Maximum number of idle connections to Fermi kept by each worker process
+FERMI_POOL_SIZE = getattr(settings, 'FERMI_POOL_SIZE', 10)
+
+# Size of the chunks relayed to the client when streaming a download, in bytes
+DOWNLOAD_CHUNK_SIZE = getattr(settings, 'DOWNLOAD_CHUNK_SIZE', 64*1024)
+
+# Time between status polls of a job, in seconds, by job status.
+# Jobs in a terminal state are no longer polled.
+JOB_POLL_INTERVALS = {'RUNNING': 15,
+                      'QUEUED': 60}
+if hasattr(settings, 'JOB_POLL_INTERVALS'):
+    JOB_POLL_INTERVALS.update(settings.JOB_POLL_INTERVALS)
+# Poll interval for other non-terminal states
+DEFAULT_POLL_INTERVAL = 300
+
+# Age, in seconds, after which the stored status of an unfinished
+# job is considered stale and Fermi is queried directly
+JOB_STATUS_MAX_AGE = getattr(settings, 'JOB_STATUS_MAX_AGE', 300)
 
 class FermiLoginForm(forms.Form):
     """
@@ -22,6 +60,30 @@ class FermiLoginForm(forms.Form):
     username = forms.CharField()
     password = forms.CharField()
 
+def fermi_request(method, url, endpoint, body=None, headers=None):
+    """
+        Send a request to Fermi over a pooled keep-alive connection and
+        return the response. The response body must be read, or the response
+        released, for the connection to be reused. A CircuitOpenError is
+        raised without contacting Fermi if the endpoint is unhealthy.
+        @param method: HTTP method
+        @param url: path of the resource
+        @param endpoint: name of the remote operation, key into FERMI_TIMEOUTS
+        @param body: request body
+        @param headers: dictionary of request headers
+    """
+    pool = get_pool(settings.FERMI_HOST, secure=True, max_size=FERMI_POOL_SIZE)
+    r = pool.request(method, url, body=body, headers=headers,
+                     timeout=FERMI_TIMEOUTS[endpoint],
+                     endpoint='fermi:%s' % endpoint)
+    # A rejected cookie must no longer be used by the background commands
+    if r.status == 401 and headers is not None and len(headers.get('Cookie', ''))>0:
+        try:
+            FermiSession.objects.filter(cookie=headers['Cookie']).delete()
+        except:
+            logging.error("Could not delete Fermi session: %s" % sys.exc_value)
+    return r
+
 def get_authentication_status(request):
     """
         Get the authentication status of the user on Fermi
@@ -34,12 +96,12 @@ def get_authentication_status(request):
     if len(sessionid)==0:
         return None
     try:
-        conn = httplib.HTTPSConnection(settings.FERMI_HOST, timeout=0.5)
-        conn.request('GET', settings.FERMI_BASE_URL+'info', headers={'Cookie':sessionid})
-        r = conn.getresponse()  
+        r = fermi_request('GET', settings.FERMI_BASE_URL+'info', 'info',
+                          headers={'Cookie':sessionid})
         info = json.loads(r.read())
         if "Authenticated_As" in info:
             request.session['fermi_uid'] = info["Authenticated_As"]
+            save_fermi_session(request)
             return info["Authenticated_As"]
         if "Err_Msg" in info:
             logging.error("MantidRemote: %s" % info["Err_Msg"])
@@ -67,11 +129,10 @@ def authenticate(request):
     """
     reason = ''
     try:
-        conn = httplib.HTTPSConnection(settings.FERMI_HOST, timeout=0.5)
         userAndPass = b64encode(b"%s:%s" % (request.POST['username'], request.POST['password'])).decode("ascii")
         headers = { 'Authorization' : 'Basic %s' %  userAndPass }
-        conn.request('GET', settings.FERMI_BASE_URL+'authenticate', headers=headers)
-        r = conn.getresponse()
+        r = fermi_request('GET', settings.FERMI_BASE_URL+'authenticate', 'authenticate',
+                          headers=headers)
         if not r.status == 200:
             try:
                 info = json.loads(r.read())
@@ -80,10 +141,14 @@ def authenticate(request):
                     reason = info["Err_Msg"]
             except:
                 logging.error("MantidRemote: %s" % sys.exc_value)
+        else:
+            # Read the reply so that the connection can be reused
+            r.read()
         sessionid = r.getheader('set-cookie', '')
         if len(sessionid)>0:
             request.session['fermi']=sessionid
             request.session['fermi_uid']=request.POST['username']
+            save_fermi_session(request)
         return r.status, reason
     except:
         logging.error("Could not authenticate with Fermi: %s" % sys.exc_value)
@@ -102,10 +167,8 @@ def transaction(request, start=False):
             if len(transactions)>0:
                 return transactions[0]
     try:
-        conn = httplib.HTTPSConnection(settings.FERMI_HOST, timeout=0.5)
-        conn.request('GET', settings.FERMI_BASE_URL+'transaction?Action=Start',
-                            headers={'Cookie':request.session.get('fermi', '')})
-        r = conn.getresponse()
+        r = fermi_request('GET', settings.FERMI_BASE_URL+'transaction?Action=Start', 'transaction',
+                          headers={'Cookie':request.session.get('fermi', '')})
         if not r.status == 200:
             logging.error("Fermi transaction call failed: %s" % r.status)
         info = json.loads(r.read())
@@ -151,46 +214,61 @@ def stop_transaction(request, trans_id):
     # Regardless of whether we have a local transaction with that ID,
     # try to stop the remote transaction
     try:
-        conn = httplib.HTTPSConnection(settings.FERMI_HOST, timeout=0.5)
-        conn.request('GET', settings.FERMI_BASE_URL+'transaction?Action=Stop&TransID=%s' % trans_id,
-                            headers={'Cookie':request.session.get('fermi', '')})
-        r = conn.getresponse()
+        r = fermi_request('GET', settings.FERMI_BASE_URL+'transaction?Action=Stop&TransID=%s' % trans_id,
+                          'transaction',
+                          headers={'Cookie':request.session.get('fermi', '')})
         if not r.status == 200:
             logging.error("Could not close Fermi transaction: %s" % r.status)
             info = json.loads(r.read())
             if "Err_Msg" in info:
                 logging.error("MantidRemote: %s" % info["Err_Msg"])
+        else:
+            r.read()
     except:
         logging.error("Could not close Fermi transaction: %s" % sys.exc_value)
 
     
-def submit_job(request, transaction, script_code, script_name='web_submission.py'):
+def submit_job(request, transaction, script_code, script_name='web_submission.py',
+               num_nodes=1, cores_per_node=None, save_in_session=True):
     """
         Submit a job to be executed on Fermi
         @param request: request object
         @param transaction: Transaction object
         @param script_code: code to be executed by the compute node
         @param script_name: name given to the remote script to be executed
+        @param num_nodes: number of compute nodes to request
+        @param cores_per_node: number of cores to request on each node [1 if None]
+        @param save_in_session: if True, keep the job ID in the user's session.
+                                Must be False when submitting from several threads.
     """
     jobID = None
+    if cores_per_node is None:
+        cores_per_node = 1
 
     # Submit job
     post_data = urllib.urlencode({'TransID': transaction.trans_id,
-                                  'NumNodes': 1,
-                                  'CoresPerNode': 1,
+                                  'NumNodes': num_nodes,
+                                  'CoresPerNode': cores_per_node,
                                   'ScriptName': script_name,
                                   script_name: script_code})
     try:
-        conn = httplib.HTTPSConnection(settings.FERMI_HOST, timeout=5)
-        conn.request('POST', settings.FERMI_BASE_URL+'submit',
-                     body=post_data,
-                     headers={'Cookie':request.session.get('fermi', '')})
-        r = conn.getresponse()
+        r = fermi_request('POST', settings.FERMI_BASE_URL+'submit', 'submit',
+                          body=post_data,
+                          headers={'Cookie':request.session.get('fermi', '')})
         resp = json.loads(r.read())
         if "Err_Msg" in resp:
             logging.error("MantidRemote: %s" % resp["Err_Msg"])
         if 'JobID' in resp:
-            jobID = request.session['fermi_jobID'] = resp['JobID']
+            jobID = resp['JobID']
+            if save_in_session:
+                request.session['fermi_jobID'] = jobID
+            # Start tracking the job in the local status table
+            store_job(request.user, {'ID': jobID,
+                                     'JobStatus': 'QUEUED',
+                                     'JobName': script_name,
+                                     'ScriptName': script_name,
+                                     'TransID': transaction.trans_id,
+                                     'SubmitDate': timezone.now()})
     except:
         logging.error("Could not submit job: %s" % sys.exc_value)
     return jobID
@@ -214,10 +292,8 @@ def query_job(request, job_id):
                     "TransID": 136 } }
     """
     try:
-        conn = httplib.HTTPSConnection(settings.FERMI_HOST, timeout=1.5)
-        conn.request('GET', '%squery?JobID=%s' % (settings.FERMI_BASE_URL, job_id),
-                     headers={'Cookie':request.session.get('fermi', '')})
-        r = conn.getresponse()
+        r = fermi_request('GET', '%squery?JobID=%s' % (settings.FERMI_BASE_URL, job_id), 'query',
+                          headers={'Cookie':request.session.get('fermi', '')})
         if r.status == 200:
             job_info = json.loads(r.read())[job_id]
             job_info['CompletionDate'] = parse_datetime(job_info['CompletionDate'])
@@ -226,6 +302,7 @@ def query_job(request, job_id):
             return job_info
         else:
             logging.error("Could not get job info: %s" % r.status)
+            r.release()
     except:
         logging.error("Could not get job info: %s" % sys.exc_value)
     return None
@@ -248,9 +325,8 @@ def get_remote_jobs(request):
     sessionid = request.session.get('fermi', '')
     status_data = []
     try:
-        conn = httplib.HTTPSConnection(settings.FERMI_HOST, timeout=30)
-        conn.request('GET', '%squery' % settings.FERMI_BASE_URL, headers={'Cookie': sessionid})
-        r = conn.getresponse()
+        r = fermi_request('GET', '%squery' % settings.FERMI_BASE_URL, 'query_all',
+                          headers={'Cookie': sessionid})
         # Check to see whether we need authentication
         jobs = json.loads(r.read())
         for key in jobs:
@@ -264,6 +340,152 @@ def get_remote_jobs(request):
     
     return status_data
     
+def save_fermi_session(request):
+    """
+        Remember the Fermi session of the user so that the
+        job poller can query their jobs
+        @param request: request object
+    """
+    cookie = request.session.get('fermi', '')
+    if len(cookie)==0 or not request.user.is_authenticated():
+        return
+    try:
+        session_obj, created = FermiSession.objects.get_or_create(owner=request.user,
+                                                                  defaults={'cookie': cookie})
+        if not created and not session_obj.cookie == cookie:
+            session_obj.cookie = cookie
+            session_obj.save()
+    except:
+        logging.error("Could not store Fermi session: %s" % sys.exc_value)
+
+def _next_poll(status, now):
+    """
+        Return the time of the next status poll for a job
+        @param status: JobStatus object
+        @param now: current time
+    """
+    if status.is_terminal():
+        return None
+    interval = JOB_POLL_INTERVALS.get(status.status, DEFAULT_POLL_INTERVAL)
+    return now + datetime.timedelta(seconds=interval)
+
+def store_job(owner, job_info):
+    """
+        Create or update the local status entry of a job
+        @param owner: User object
+        @param job_info: job information, in the format returned by query_job
+    """
+    try:
+        job_id = int(job_info['ID'])
+    except (KeyError, ValueError):
+        return None
+    now = timezone.now()
+    try:
+        job_obj = ReductionJob.objects.get(job_id=job_id)
+    except ReductionJob.DoesNotExist:
+        job_obj = ReductionJob(job_id=job_id, owner=owner)
+    job_obj.status = JobStatus.objects.get_status(job_info.get('JobStatus', 'UNKNOWN'))
+    job_obj.title = job_info.get('JobName', '')[:128]
+    job_obj.script_name = job_info.get('ScriptName', '')[:128]
+    job_obj.trans_id = job_info.get('TransID', None)
+    job_obj.submit_time = job_info.get('SubmitDate', None)
+    job_obj.start_time = job_info.get('StartDate', None)
+    job_obj.end_time = job_info.get('CompletionDate', None)
+    job_obj.last_update = now
+    job_obj.next_poll = _next_poll(job_obj.status, now)
+    job_obj.save()
+    return job_obj
+
+def _is_current(job_obj):
+    """
+        Return True if the stored status of a job can be used as is
+        @param job_obj: ReductionJob object
+    """
+    if job_obj.status.is_terminal():
+        return True
+    age = timezone.now() - job_obj.last_update
+    return age < datetime.timedelta(seconds=JOB_STATUS_MAX_AGE)
+
+def get_job_info(request, job_id):
+    """
+        Return the status of a job from the local table, which is kept
+        up to date by the poll_jobs command. Fermi is only queried if
+        the job is unknown or its stored status is stale.
+        @param request: request object
+        @param job_id: remote job id string
+    """
+    try:
+        job_obj = ReductionJob.objects.select_related('status').get(job_id=int(job_id))
+        if _is_current(job_obj):
+            return job_obj.as_dict()
+    except (ReductionJob.DoesNotExist, ValueError):
+        pass
+    job_info = query_job(request, str(job_id))
+    if job_info is not None:
+        job_info['ID'] = str(job_id)
+        store_job(request.user, job_info)
+    return job_info
+
+def query_jobs(request, job_ids):
+    """
+        Return the status of several jobs. Stored status entries are used
+        when current; the remaining jobs are resolved with a single call
+        to Fermi, and jobs missing from that reply are queried individually.
+        @param request: request object
+        @param job_ids: list of remote job id strings
+        
+        Returns a dictionary of job info indexed by job ID.
+        Jobs that could not be found are left out.
+    """
+    status = {}
+    job_ids = [str(job_id) for job_id in job_ids]
+    numeric_ids = [int(job_id) for job_id in job_ids if job_id.isdigit()]
+    for job_obj in ReductionJob.objects.filter(job_id__in=numeric_ids).select_related('status'):
+        if _is_current(job_obj):
+            status[str(job_obj.job_id)] = job_obj.as_dict()
+    missing = [job_id for job_id in job_ids if job_id not in status]
+    if len(missing)==0:
+        return status
+
+    jobs = {}
+    for job_info in get_remote_jobs(request):
+        jobs[job_info['ID']] = job_info
+    for job_id in missing:
+        job_info = jobs.get(job_id, None)
+        if job_info is None:
+            job_info = query_job(request, job_id)
+            if job_info is not None:
+                job_info['ID'] = job_id
+        if job_info is not None:
+            store_job(request.user, job_info)
+            status[job_id] = job_info
+    return status
+
+class BackgroundRequest(object):
+    """
+        Minimal stand-in for a request object, used to query
+        Fermi outside of a web request
+    """
+    def __init__(self, user, cookie):
+        self.user = user
+        self.session = {'fermi': cookie}
+
+def poll_user_jobs(fermi_session):
+    """
+        Update the stored status of all the jobs of a user with a single
+        call to Fermi. Used by the poll_jobs command.
+        @param fermi_session: FermiSession object
+    """
+    owner = fermi_session.owner
+    now = timezone.now()
+    jobs = get_remote_jobs(BackgroundRequest(owner, fermi_session.cookie))
+    for job_info in jobs:
+        store_job(owner, job_info)
+    # Jobs that Fermi did not report are checked again later
+    ReductionJob.objects.filter(owner=owner, next_poll__lte=now) \
+        .update(next_poll=now+datetime.timedelta(seconds=DEFAULT_POLL_INTERVAL))
+    return len(jobs)
+
 def query_files(request, trans_id):
     """
         Query files for a given transaction
@@ -280,22 +502,23 @@ def query_files(request, trans_id):
                    "web_submission.py"]}
     """
     try:
-        conn = httplib.HTTPSConnection(settings.FERMI_HOST, timeout=1.5)
-        conn.request('GET', '%sfiles?TransID=%s' % (settings.FERMI_BASE_URL, trans_id),
-                     headers={'Cookie':request.session.get('fermi', '')})
-        r = conn.getresponse()
+        r = fermi_request('GET', '%sfiles?TransID=%s' % (settings.FERMI_BASE_URL, trans_id), 'files',
+                          headers={'Cookie':request.session.get('fermi', '')})
         if r.status == 200:
             file_list = json.loads(r.read())['Files']
             return file_list
         else:
             logging.error("Could not get files for transaction: %s" % r.status)
+            r.release()
     except:
         logging.error("Could not get files for transaction: %s" % sys.exc_value)
     return None
 
-def download_file(request, trans_id, filename):
+def open_download(request, trans_id, filename):
     """
-        Download a file from the compute node.
+        Start downloading a file from the compute node and return the
+        response, or None if the file could not be obtained. The caller
+        must read the body or release the response.
         @param request: request object
         @param trans_id: remote name for the transaction
         @param filename: name of the file to be downloaded
@@ -304,24 +527,146 @@ def download_file(request, trans_id, filename):
           https://fermi.ornl.gov/MantidRemote/download?TransID=90&File=submit.sh
     """
     try:
-        conn = httplib.HTTPSConnection(settings.FERMI_HOST, timeout=60)
-        conn.request('GET', '%sdownload?TransID=%s&File=%s' % (settings.FERMI_BASE_URL, trans_id, filename),
-                     headers={'Cookie':request.session.get('fermi', '')})
-        r = conn.getresponse()
+        r = fermi_request('GET', '%sdownload?TransID=%s&File=%s' % (settings.FERMI_BASE_URL, trans_id, filename),
+                          'download',
+                          headers={'Cookie':request.session.get('fermi', '')})
         if r.status == 200:
-            return r.read()
+            return r
         else:
             logging.error("Could not get file from compute node: %s" % r.status)
+            r.release()
     except:
         logging.error("Could not get file from compute node: %s" % sys.exc_value)
     return None
 
-def fill_job_dictionary(request, remote_job_id, **template_values):
+def iter_download(response, chunk_size=DOWNLOAD_CHUNK_SIZE, cache_writer=None):
+    """
+        Generator relaying the body of a download in fixed-size chunks.
+        The response is released when the generator is exhausted or closed.
+        @param response: response returned by open_download
+        @param chunk_size: size of each chunk, in bytes
+        @param cache_writer: if given, file_cache.CacheWriter receiving a copy of the data
+    """
+    completed = False
+    try:
+        while True:
+            chunk = response.read(chunk_size)
+            if len(chunk)==0:
+                completed = True
+                break
+            if cache_writer is not None:
+                cache_writer.write(chunk)
+            yield chunk
+    except GeneratorExit:
+        raise
+    except:
+        logging.error("Download from compute node interrupted: %s" % sys.exc_value)
+    finally:
+        response.release()
+        if cache_writer is not None:
+            if completed:
+                cache_writer.commit()
+            else:
+                cache_writer.abort()
+
+def _iter_file(fd, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """
+        Generator reading a local file in fixed-size chunks
+        @param fd: open file object, closed when done
+        @param chunk_size: size of each chunk, in bytes
+    """
+    try:
+        while True:
+            chunk = fd.read(chunk_size)
+            if len(chunk)==0:
+                break
+            yield chunk
+    finally:
+        fd.close()
+
+def _use_cache(request, trans_id, filename):
+    """
+        Return True if a file should be read through the local download cache.
+        Cached files are only served to the owner of the transaction, since
+        serving them does not go through Fermi's access control.
+        @param request: request object
+        @param trans_id: remote name for the transaction
+        @param filename: name of the file
+    """
+    if not file_cache.is_enabled(filename):
+        return False
+    return Transaction.objects.filter(trans_id=trans_id, owner=request.user).count()>0
+
+def stream_file(request, trans_id, filename):
+    """
+        Return an iterator over the content of a transaction file, along with
+        its content type and length, or None if the file could not be obtained.
+        The file is read from the local cache if possible, and otherwise
+        relayed from Fermi and added to the cache.
+        @param request: request object
+        @param trans_id: remote name for the transaction
+        @param filename: name of the file
+    """
+    use_cache = _use_cache(request, trans_id, filename)
+    if use_cache:
+        path = file_cache.get_path(trans_id, filename)
+        if path is not None:
+            try:
+                fd = open(path, 'rb')
+                content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+                return _iter_file(fd), content_type, str(os.fstat(fd.fileno()).st_size)
+            except (IOError, OSError):
+                # The file was evicted since we found it
+                pass
+
+    r = open_download(request, trans_id, filename)
+    if r is None:
+        return None
+    cache_writer = None
+    if use_cache:
+        try:
+            cache_writer = file_cache.CacheWriter(trans_id, filename)
+        except:
+            logging.error("Could not write to download cache: %s" % sys.exc_value)
+    return iter_download(r, cache_writer=cache_writer), \
+        r.getheader('content-type', 'application/octet-stream'), \
+        r.getheader('content-length', None)
+
+def download_file(request, trans_id, filename):
+    """
+        Download a file from the compute node and return its content.
+        The local download cache is used when possible.
+        @param request: request object
+        @param trans_id: remote name for the transaction
+        @param filename: name of the file to be downloaded
+    """
+    use_cache = _use_cache(request, trans_id, filename)
+    if use_cache:
+        content = file_cache.read(trans_id, filename)
+        if content is not None:
+            return content
+    r = open_download(request, trans_id, filename)
+    if r is None:
+        return None
+    try:
+        content = r.read()
+    except:
+        logging.error("Could not get file from compute node: %s" % sys.exc_value)
+        return None
+    if use_cache:
+        file_cache.store(trans_id, filename, content)
+    return content
+
+def fill_job_dictionary(request, remote_job_id, trans_id=None, **template_values):
     """
         Fill in a dictionary with job information
         @param request: request object
         @param remote_job_id: remote job id string
+        @param trans_id: remote transaction ID of the job, if known
         @param template_values: dictionary to fill
+        
+        When the transaction is known, either from the caller or from the
+        local job table, the job status and the file list are queried concurrently.
     """
     # Verify whether we are dealing with a test job.
     # There is only one allowed test job and it has '-1' as its ID.
@@ -332,8 +677,18 @@ def fill_job_dictionary(request, remote_job_id, **template_values):
     template_values['title'] = 'Job %s' % remote_job_id
     template_values['job_id'] = remote_job_id
 
-    # Query basic job info
-    job_info = query_job(request, remote_job_id)
+    if trans_id is None and str(remote_job_id).isdigit():
+        job_objs = ReductionJob.objects.filter(job_id=int(remote_job_id))
+        if len(job_objs)>0:
+            trans_id = job_objs[0].trans_id
+
+    # Query basic job info, and the list of files if we know the transaction
+    job_files = None
+    if trans_id is not None:
+        job_info, job_files = gather([(get_job_info, (request, remote_job_id)),
+                                      (query_files, (request, trans_id))])
+    else:
+        job_info = get_job_info(request, remote_job_id)
     if job_info is None:
         template_values['user_alert'] = ["Could not find job on Fermi"]
         template_values['job_not_found'] = True
@@ -344,8 +699,9 @@ def fill_job_dictionary(request, remote_job_id, **template_values):
     transactions = Transaction.objects.filter(trans_id=job_info['TransID'])
     if len(transactions)>0:
         transaction = transactions[0]
-        template_values['job_files'] = query_files(request, transaction.trans_id)
+        if job_files is None or not transaction.trans_id == trans_id:
+            job_files = query_files(request, transaction.trans_id)
+        template_values['job_files'] = job_files
         template_values['trans_id'] = transaction.trans_id
         template_values['job_directory'] = transaction.directory
     return template_values
-
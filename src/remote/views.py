@@ -4,14 +4,15 @@
     @author: M. Doucet, Oak Ridge National Laboratory
     @copyright: 2014 Oak Ridge National Laboratory
 """
-from django.http import HttpResponse
-from django.shortcuts import render_to_response, redirect
+from django.http import HttpResponse, StreamingHttpResponse
+from django.shortcuts import render_to_response, redirect, get_object_or_404
 from django.core.urlresolvers import reverse
 from django.contrib.auth.decorators import login_required
 from django.conf import settings
 
 import reduction_service.view_util
 import remote.view_util
+from remote.models import Submission
 
 @login_required
 def query_remote_jobs(request):
@@ -68,15 +69,34 @@ def download_file(request, trans_id, filename, delete=False):
     """
         Get a file from the compute node. The transaction name
         corresponds to the name it is given by the remote submission service.
+        The file is relayed to the client as it is received,
+        or read from the local download cache.
         @param request: request object
         @param trans_id: remote name of the transaction
         @param filename: name of the file to download
         @param delete: if True, the transaction will be deleted
     """
-    file_content = remote.view_util.download_file(request, trans_id, filename)
+    download = remote.view_util.stream_file(request, trans_id, filename)
+    if download is None:
+        if delete is True:
+            remote.view_util.stop_transaction(request, trans_id)
+        return HttpResponse(status=502)
+    chunks, content_type, content_length = download
+
+    def _stream():
+        try:
+            for chunk in chunks:
+                yield chunk
+        finally:
+            if delete is True:
+                remote.view_util.stop_transaction(request, trans_id)
+    # The session is saved before the body is sent, so forget the transaction now
     if delete is True:
-        remote.view_util.stop_transaction(request, trans_id)
-    response = HttpResponse(file_content)
+        request.session['fermi_transID'] = None
+
+    response = StreamingHttpResponse(_stream(), content_type=content_type)
+    if content_length is not None:
+        response['Content-Length'] = content_length
     response['Content-Disposition'] = 'attachment; filename="%s"' % filename
     return response
  
@@ -103,3 +123,24 @@ def stop_transaction(request, trans_id):
     if 'back_url' in request.GET:
         redirect_url = request.GET['back_url']
     return redirect(redirect_url)
+
+@login_required
+def submission_status(request, submission_id):
+    """
+        Waiting page for a submission in the outbox. The user is sent
+        to the result page of the job once it has been submitted.
+        @param request: request object
+        @param submission_id: pk of the Submission object
+    """
+    submission = get_object_or_404(Submission, pk=submission_id, owner=request.user)
+    if submission.status == Submission.SUBMITTED and len(submission.result_url)>0:
+        return redirect(submission.result_url)
+    breadcrumbs = "<a href='%s'>home</a>" % reverse(settings.LANDING_VIEW)
+    breadcrumbs += " &rsaquo; submission %s" % submission_id
+    template_values = {'submission': submission,
+                       'title': 'Job submission',
+                       'breadcrumbs': breadcrumbs,
+                       'back_url': reverse(settings.LANDING_VIEW)}
+    template_values = reduction_service.view_util.fill_template_values(request, **template_values)
+    return render_to_response('remote/submission_status.html',
+                              template_values)
@@ -1,3 +1,132 @@
+// Fetch arrays served in binary form by the plotting app. The response
+// holds little-endian float32 arrays packed one after the other, and the
+// X-Array-Shapes header gives their shapes, e.g. '128;128;127,127'.
+// The callback receives a list of {values: Float32Array, shape: [...]}.
+function fetch_plot_arrays(url, callback) {
+    var xhr = new XMLHttpRequest();
+    xhr.open('GET', url, true);
+    xhr.responseType = 'arraybuffer';
+    xhr.onload = function() {
+        if (xhr.status != 200) { return; }
+        var shapes = xhr.getResponseHeader('X-Array-Shapes').split(';');
+        var arrays = [];
+        var offset = 0;
+        for (var i=0; i<shapes.length; i++) {
+            var shape = shapes[i].split(',').map(Number);
+            var size = shape.reduce(function(a, b) { return a*b; }, 1);
+            // Float32Array uses the platform byte order, which is little-endian for all browsers we support
+            arrays.push({'values': new Float32Array(xhr.response, offset, size), 'shape': shape});
+            offset += 4*size;
+        }
+        callback(arrays);
+    };
+    xhr.send();
+}
+
+// Split a flat array into rows of n_cols values, without copying
+function to_rows(values, n_cols) {
+    var rows = [];
+    for (var i=0; i+n_cols<=values.length; i+=n_cols) {
+        rows.push(values.subarray(i, i+n_cols));
+    }
+    return rows;
+}
+
+// Fetch the (q, I, dI) points of a 1D plot and pass them to callback(data)
+function fetch_plot_1d(url, callback) {
+    fetch_plot_arrays(url, function(arrays) {
+        if (arrays[0].shape.length<2) { callback([]); return; }
+        callback(to_rows(arrays[0].values, arrays[0].shape[1]));
+    });
+}
+
+// Plot a 1D data set served by the plotting app at the resolution of the plot.
+// Selecting a q range with the mouse loads that range in more detail,
+// and a double-click goes back to the full range.
+function plot_1d_lod(url, anchor, options) {
+    options = (typeof options === "undefined") ? {} : options;
+    var plot_width = (typeof options.width === "undefined") ? 500 : options.width;
+    function load(q_range) {
+        var query = '?width=' + plot_width;
+        if (q_range !== null) { query += '&q_min=' + q_range[0] + '&q_max=' + q_range[1]; }
+        fetch_plot_1d(url + query, function(data) {
+            plot_1d(data, anchor, $.extend({}, options, {'on_zoom': load}));
+        });
+    }
+    load(null);
+}
+
+// Return the [first, last+1) range of cells of a level that cover
+// a range of values along an axis, or all cells if the range is null
+function cell_range(axis, n_cells, range) {
+    if (range === null) { return [0, n_cells]; }
+    var first = 0;
+    while (first<n_cells-1 && axis[first+1]<=range[0]) { first++; }
+    var last = first;
+    while (last<n_cells-1 && axis[last+1]<=range[1]) { last++; }
+    // Keep at least two cells so that the plot can size them
+    if (last==first) {
+        if (last<n_cells-1) { last++; } else if (first>0) { first--; }
+    }
+    return [first, last+1];
+}
+
+// Plot a 2D data set using its tile pyramid. The plot starts with the
+// overview (the top level of the pyramid), and selecting an area with the mouse loads the tiles of the
+// finest level that shows it within view_cells cells on each side.
+// A double-click goes back to the overview.
+function plot_2d_tiled(pyramid_url, options) {
+    options = (typeof options === "undefined") ? {} : options;
+    $.getJSON(pyramid_url, function(pyramid) {
+        var tile_size = pyramid.tile_size;
+        function show(view) {
+            var x_range = (view === null) ? null : [view[0][0], view[1][0]];
+            var y_range = (view === null) ? null : [view[0][1], view[1][1]];
+            var level, rows, cols;
+            // The full view is always the overview, a single tile
+            var first_level = (view === null) ? pyramid.levels.length-1 : 0;
+            for (var l=first_level; l<pyramid.levels.length; l++) {
+                level = pyramid.levels[l];
+                rows = cell_range(level.qy, level.shape[0], y_range);
+                cols = cell_range(level.qx, level.shape[1], x_range);
+                if (rows[1]-rows[0]<=pyramid.view_cells && cols[1]-cols[0]<=pyramid.view_cells) { break; }
+            }
+            var tile_rows = [Math.floor(rows[0]/tile_size), Math.floor((rows[1]-1)/tile_size)];
+            var tile_cols = [Math.floor(cols[0]/tile_size), Math.floor((cols[1]-1)/tile_size)];
+            var n_tiles = (tile_rows[1]-tile_rows[0]+1)*(tile_cols[1]-tile_cols[0]+1);
+            var tiles = {};
+            var n_loaded = 0;
+            for (var tr=tile_rows[0]; tr<=tile_rows[1]; tr++) {
+                for (var tc=tile_cols[0]; tc<=tile_cols[1]; tc++) {
+                    (function(tr, tc) {
+                        var url = pyramid.tile_url + '?level=' + level.level + '&row=' + tr + '&col=' + tc;
+                        fetch_plot_arrays(url, function(arrays) {
+                            tiles[tr+','+tc] = arrays[0];
+                            n_loaded++;
+                            if (n_loaded==n_tiles) { draw(); }
+                        });
+                    })(tr, tc);
+                }
+            }
+            // Copy the cells of the view out of the tiles
+            function draw() {
+                var data = [];
+                for (var r=rows[0]; r<rows[1]; r++) {
+                    var row = new Float32Array(cols[1]-cols[0]);
+                    for (var c=cols[0]; c<cols[1]; c++) {
+                        var tile = tiles[Math.floor(r/tile_size)+','+Math.floor(c/tile_size)];
+                        row[c-cols[0]] = tile.values[(r%tile_size)*tile.shape[1] + c%tile_size];
+                    }
+                    data.push(row);
+                }
+                plot_2d(data, level.qx.slice(cols[0], cols[1]+1), level.qy.slice(rows[0], rows[1]+1),
+                        pyramid.z_max, $.extend({}, options, {'on_zoom': show}));
+            }
+        }
+        show(null);
+    });
+}
+
 function plot_1d(raw_data, anchor, options) {
     options = (typeof options === "undefined") ? {} : options;
     color = (typeof options.color === "undefined") ? '#0077cc' : options.color;
@@ -160,11 +289,23 @@ function plot_1d(raw_data, anchor, options) {
   focus.append("text")
 	.attr("x", 9)
 	.attr("dy", "-.15em");
-  svg.append("rect")
+  var overlay;
+  if (typeof options.on_zoom === "undefined") {
+    overlay = svg.append("rect")
 	.attr("class", "overlay")
 	.attr("width", width)
-	.attr("height", height)
-	.on("mouseover", function() { focus.style("display", null); })
+	.attr("height", height);
+  } else {
+    // Select a q range to zoom in, double-click to zoom out
+    var brush = d3.svg.brush().x(x)
+	.on("brushend", function() { if (!brush.empty()) { options.on_zoom(brush.extent()); } });
+    overlay = svg.append("g")
+	.attr("class", "brush")
+	.call(brush)
+	.on("dblclick", function() { options.on_zoom(null); });
+    overlay.selectAll("rect").attr("height", height);
+  }
+  overlay.on("mouseover", function() { focus.style("display", null); })
 	.on("mouseout", function() { focus.style("display", "none"); })
 	.on("mousemove", mousemove);
   function mousemove(){
@@ -306,4 +447,13 @@ function plot_2d(data, qx, qy, max_iq, options) {
     svg.append("g").attr("class", "x axis").attr("transform", "translate(0," + height + ")").call(xAxis);
     svg.append("g").attr("class", "y axis").call(yAxis)
 
+    // Select an area to zoom in, double-click to zoom out
+    if (typeof options.on_zoom !== "undefined") {
+      var brush = d3.svg.brush().x(x).y(y)
+        .on("brushend", function() { if (!brush.empty()) { options.on_zoom(brush.extent()); } });
+      svg.append("g")
+        .attr("class", "brush")
+        .call(brush)
+        .on("dblclick", function() { options.on_zoom(null); });
+    }
 }